@@ -0,0 +1,169 @@
+#Gate activity for power estimation (-e): the gate-level machine runs its compiled netlists with probes
+#counting the gates evaluated and the gate outputs that toggled per component, and every tick is charged
+#to the instruction running. Toggles are what dynamic power scales with, so microcode and ISA changes can
+#be compared by switching activity as well as by cycles
+#   meter = ActivityMeter(machine, asm.OPS); meter.attach(); machine.run(); meter.detach()
+#   print(meter.report()); meter.save("run.activity.json")
+import json
+from pathlib import Path
+import netlist
+from cpu import Gate, Machine
+
+#decoders and bus buffers aren't on the compiled tick path, their activity comes from precomputed gate counts
+COMPONENTS = ("alu", "adder", "pc counter", "step counter", "step decoder", "ram decoder", "buffers")
+ALU, ADDER, PC_COUNTER, STEP_COUNTER, STEP_DECODER, RAM_DECODER, BUFFERS = range(len(COMPONENTS))
+#gates of the bus buffers driven by each control wire (the Gate.logic_gate_count calls of cpu.py)
+BUFFER_GATES = {1: 16, 2: 16, 3: 8, 4: 8, 5: 12, 6: 12, 8: 8, 9: 8, 15: 8, 16: 8, 17: 8, 18: 8}
+
+def decoder_toggles(old: int, new: int) -> int:
+    #inverters of the address bits that changed, plus the output that falls and the one that rises
+    return (old ^ new).bit_count() + 2 if old != new else 0
+
+class ActivityMeter:
+    """Gate evaluations and output toggles of one gate-level Machine, per component and per opcode
+
+    attach() gives the ALU, program counter and control unit probed netlists
+    and shadows machine.step. Each tick's counts are charged to the instruction
+    running, when the next one starts (the previous values of the gate outputs
+    start at 0, as at power on)."""
+    def __init__(self, machine: Machine, ops: dict[str, int] | None = None):
+        self.machine = machine
+        self.mnemonics = {}
+        for name, op in (ops or {}).items():
+            self.mnemonics.setdefault(op, name)
+        self.evaluations = [0] * len(COMPONENTS) #running instruction, written by the probed netlists
+        self.toggles = [0] * len(COMPONENTS)
+        self.state: list[int] = [] #packed gate outputs each component held last, see netlist.Netlist.activity
+        self.slots: dict[str, int] = {} #component -> index in state
+        namespace = {"evaluations": self.evaluations, "toggles": self.toggles, "state": self.state}
+        self.alu = netlist.define("alu", netlist.alu_source(self), dict(namespace))
+        self.pc_write = netlist.define("pc_write", netlist.pc_write_source(self), dict(namespace))
+        self.control_unit = netlist.define("control_unit", netlist.control_unit_source(self), dict(namespace))
+        self.step_gates = sum(netlist.decoder_netlist(3).gates().values())
+        self.ram_gates = sum(netlist.decoder_netlist(12).gates().values())
+        self.clear()
+    def clear(self):
+        """Forgets every count"""
+        self.ops: dict[int, list] = {} #ir -> [instructions, ticks, evaluations per component, toggles per component]
+        self.ticks = 0 #ticks of the running instruction
+        self.counted = 0 #evaluations of the running instruction already in Gate.count
+        for i in range(len(COMPONENTS)):
+            self.evaluations[i] = self.toggles[i] = 0
+        self.step = 0 #decoded by the step and RAM decoders last
+        self.address = 0
+        self.bus = self.mbus = 0
+    def index(self, component: str) -> int:
+        return COMPONENTS.index(component)
+    def slot(self, component: str) -> int:
+        #one state entry per component, shared by every netlist and optype branch driving it
+        if component not in self.slots:
+            self.slots[component] = len(self.state)
+            self.state.append(0)
+        return self.slots[component]
+    def attach(self):
+        m = self.machine
+        m.alu.tables = None #would bypass the probed gates
+        m.alu.netlist, m.pc.netlist, m.cu.netlist = self.alu, self.pc_write, self.control_unit
+        self.buffers = [(m.control_wires[wire], gates) for wire, gates in BUFFER_GATES.items()]
+        self.step_unprobed = Machine.step.__get__(m)
+        m.step = self.tick
+    def detach(self):
+        self.machine.__dict__.pop("step", None)
+        Gate.logic_gate_count(sum(self.evaluations) - self.counted)
+        self.counted = sum(self.evaluations)
+        netlist.detach(self.machine)
+    def tick(self, display = True, ends = True, debug = False, screen = False) -> bool:
+        m = self.machine
+        counter = m.cu.counter.byte
+        step = counter[0].state | counter[1].state << 1 | counter[2].state << 2
+        if step == 0 and self.ticks:
+            self.flush(m.ir.data.uint())
+        self.evaluations[STEP_DECODER] += self.step_gates
+        self.toggles[STEP_DECODER] += decoder_toggles(self.step, step)
+        self.step = step
+        running = self.step_unprobed(display, ends, debug, screen)
+        if not running:
+            return False
+        self.ticks += 1
+        if m.ram.RI.state or m.ram.RO.state:
+            address = m.ram.value()
+            self.evaluations[RAM_DECODER] += self.ram_gates
+            self.toggles[RAM_DECODER] += decoder_toggles(self.address, address)
+            self.address = address
+        for wire, gates in self.buffers:
+            if wire.state:
+                self.evaluations[BUFFERS] += gates
+        bus = m.bus.uint()
+        mbus = sum(bit.state << i for i, bit in enumerate(m.mbus))
+        self.toggles[BUFFERS] += (bus ^ self.bus).bit_count() + (mbus ^ self.mbus).bit_count()
+        self.bus, self.mbus = bus, mbus
+        return True
+    def flush(self, ir: int):
+        #charges the counts of the instruction that ended to its opcode
+        entry = self.ops.get(ir)
+        if entry is None:
+            entry = self.ops[ir] = [0, 0, [0] * len(COMPONENTS), [0] * len(COMPONENTS)]
+        entry[0] += 1
+        entry[1] += self.ticks
+        Gate.logic_gate_count(sum(self.evaluations) - self.counted)
+        self.counted = 0
+        for i in range(len(COMPONENTS)):
+            entry[2][i] += self.evaluations[i]
+            entry[3][i] += self.toggles[i]
+            self.evaluations[i] = self.toggles[i] = 0
+        self.ticks = 0
+    def mnemonic(self, ir: int) -> str:
+        return self.mnemonics.get(ir if ir >= 0xe0 else ir & 0xf0, f"${ir:02x}")
+    def opcodes(self) -> dict[str, list]:
+        """[instructions, ticks, evaluations per component, toggles per component] of each mnemonic run,
+        the running instruction included"""
+        ops = {ir: entry for ir, entry in self.ops.items()}
+        if self.ticks:
+            ir = self.machine.ir.data.uint()
+            entry = ops.get(ir, [0, 0, [0] * len(COMPONENTS), [0] * len(COMPONENTS)])
+            ops[ir] = [entry[0] + 1, entry[1] + self.ticks, [a + b for a, b in zip(entry[2], self.evaluations)],
+                       [a + b for a, b in zip(entry[3], self.toggles)]]
+        totals = {}
+        for ir, (executed, ticks, evaluations, toggles) in ops.items():
+            total = totals.setdefault(self.mnemonic(ir), [0, 0, [0] * len(COMPONENTS), [0] * len(COMPONENTS)])
+            total[0] += executed
+            total[1] += ticks
+            for i in range(len(COMPONENTS)):
+                total[2][i] += evaluations[i]
+                total[3][i] += toggles[i]
+        return dict(sorted(totals.items(), key=lambda item: -sum(item[1][3])))
+    def components(self) -> dict[str, tuple[int, int]]:
+        """(evaluations, toggles) of each component over the whole run"""
+        evaluations, toggles = [0] * len(COMPONENTS), [0] * len(COMPONENTS)
+        for executed, ticks, op_evaluations, op_toggles in self.opcodes().values():
+            for i in range(len(COMPONENTS)):
+                evaluations[i] += op_evaluations[i]
+                toggles[i] += op_toggles[i]
+        return {name: (evaluations[i], toggles[i]) for i, name in enumerate(COMPONENTS)}
+    def report(self) -> str:
+        ops = self.opcodes()
+        components = self.components()
+        instructions = sum(entry[0] for entry in ops.values())
+        ticks = sum(entry[1] for entry in ops.values())
+        evaluations = sum(counts[0] for counts in components.values())
+        toggles = sum(counts[1] for counts in components.values())
+        lines = [f"Gate activity: {instructions} instructions, {ticks} ticks, {evaluations} gate evaluations, "
+                 f"{toggles} toggles ({toggles / max(instructions, 1):.1f} per instruction, {toggles / max(ticks, 1):.1f} per tick)",
+                 f"{'opcode':<8}{'instr':>9}{'ticks':>10}{'evals/instr':>13}{'toggles/instr':>15}{'toggles/tick':>14}{'share':>8}"]
+        for name, (executed, op_ticks, op_evaluations, op_toggles) in ops.items():
+            lines.append(f"{name:<8}{executed:>9}{op_ticks:>10}{sum(op_evaluations) / executed:>13.1f}"
+                         f"{sum(op_toggles) / executed:>15.1f}{sum(op_toggles) / max(op_ticks, 1):>14.1f}"
+                         f"{sum(op_toggles) / max(toggles, 1):>8.1%}")
+        lines.append(f"{'component':<14}{'evaluations':>14}{'toggles':>12}{'toggle rate':>13}{'share':>8}")
+        for name, (component_evaluations, component_toggles) in components.items():
+            lines.append(f"{name:<14}{component_evaluations:>14}{component_toggles:>12}"
+                         f"{component_toggles / max(component_evaluations, 1):>13.3f}{component_toggles / max(toggles, 1):>8.1%}")
+        return "\n".join(lines)
+    def save(self, path):
+        """JSON of the counts per opcode and per component"""
+        ops = {name: {"instructions": executed, "ticks": ticks, "evaluations": dict(zip(COMPONENTS, evaluations)),
+                      "toggles": dict(zip(COMPONENTS, toggles))}
+               for name, (executed, ticks, evaluations, toggles) in self.opcodes().items()}
+        components = {name: {"evaluations": evaluations, "toggles": toggles}
+                      for name, (evaluations, toggles) in self.components().items()}
+        Path(path).write_text(json.dumps({"opcodes": ops, "components": components}, indent=1))
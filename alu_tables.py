@@ -0,0 +1,114 @@
+import os
+import sys
+from array import array
+from cpu import CACHE_DIR
+
+#Each table maps (A << 8) | B to a packed entry:
+#   bits 0-7 result on the bus, bit 8 carry, bit 9 zero, bit 10 sign, bit 11 set if the carry is written
+CF_BIT = 1 << 8
+ZF_BIT = 1 << 9
+SF_BIT = 1 << 10
+CW_BIT = 1 << 11
+
+TABLE_MAGIC = b"SBBALU"
+TABLE_VERSION = 1
+TABLE_LEN = 1 << 16
+ALU_OPS = range(1, 13) #optype 0 leaves the bus and flags untouched
+
+def multiply(a: int, b: int) -> tuple[int, int]:
+    #Mirrors Alu.multiply: each adder pass keeps the carry out of the previous pass as its carry in
+    low = a & b & 1
+    high = (b >> 1) if a & 1 else 0
+    carry = 0
+    for i in range(1, 8):
+        sum = high + (b if (a >> i) & 1 else 0) + carry
+        carry = sum >> 8
+        low |= (sum & 1) << i
+        high = ((sum & 255) >> 1) | (carry << 7)
+    return low, high
+
+def reference(optype: int, a: int, b: int) -> tuple[int, int | None]:
+    """Outputs: bus value, carry (None when the carry flag is left untouched)"""
+    match optype:
+        case 1: return (a + b) & 255, (a + b) >> 8
+        case 2: return (a + (b ^ 255) + 1) & 255, (a + (b ^ 255) + 1) >> 8
+        case 3: return (a + 1) & 255, int(a == 255)
+        case 4: return (a - 1) & 255, int(a == 0)
+        case 5: return a & b, None
+        case 6: return a | b, None
+        case 7: return a ^ 255, None
+        case 8: return a >> 1, None
+        case 9: return (a << 1) & 255, a >> 7
+        case 10:
+            low, high = multiply(a, b)
+            return low, high & 1
+        case 11: return multiply(a, b)[1], None
+        case 12: return a ^ b, None
+    raise ValueError(f"No ALU table for optype {optype}")
+
+def build_table(optype: int) -> array:
+    table = array('H', bytes(2 * TABLE_LEN))
+    for a in range(256):
+        for b in range(256):
+            result, carry = reference(optype, a, b)
+            entry = result | (result == 0) << 9 | (result >> 7) << 10
+            if carry is not None:
+                entry |= carry << 8 | CW_BIT
+            table[(a << 8) | b] = entry
+    return table
+
+def table_path(optype: int):
+    return CACHE_DIR / f"alu{optype:02}.tbl"
+
+def load_table(optype: int) -> array | None:
+    try:
+        data = table_path(optype).read_bytes()
+    except OSError:
+        return None
+    header = TABLE_MAGIC + bytes([TABLE_VERSION, optype])
+    if not data.startswith(header) or len(data) != len(header) + 2 * TABLE_LEN:
+        return None
+    table = array('H')
+    table.frombytes(data[len(header):])
+    if sys.byteorder == "big":
+        table.byteswap()
+    return table
+
+def save_table(optype: int, table: array):
+    data = array('H', table)
+    if sys.byteorder == "big":
+        data.byteswap()
+    path = table_path(optype)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    #write then rename so concurrent runs never read half a table
+    temp = path.with_suffix(f".{os.getpid()}.tmp")
+    temp.write_bytes(TABLE_MAGIC + bytes([TABLE_VERSION, optype]) + data.tobytes())
+    os.replace(temp, path)
+
+class AluTables(dict):
+    """optype -> table, each table is built (or read from the disk cache) the first time it is used"""
+    def __init__(self, cache = True):
+        super().__init__()
+        self.cache = cache
+    def __missing__(self, optype: int) -> array:
+        table = load_table(optype) if self.cache else None
+        if table is None:
+            table = build_table(optype)
+            if self.cache:
+                try:
+                    save_table(optype, table)
+                except OSError:
+                    pass #read-only install, the table is simply rebuilt next run
+        self[optype] = table
+        return table
+
+#shared by every ALU so tables are only built once per process
+TABLES = AluTables()
+
+if __name__ == '__main__':
+    #prebuild every table into the disk cache
+    tables = AluTables(cache = False)
+    for optype in ALU_OPS:
+        save_table(optype, tables[optype])
+        print('[' + ('='*optype).ljust(len(ALU_OPS), ' ') + ']', end='\r')
+    print(f"\nDone. ({CACHE_DIR})")
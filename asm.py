@@ -1,9 +1,26 @@
 #https://eater.net/8bit/pc
 from cpu import *
+from fastcpu import FastCPU, FusedCPU
+from translate import BlockCPU
+from reverse import ReverseCPU
+from framebuffer import FrameScreen
+from display import ThreadedScreen
+from host_profiler import HostProfiler
+from guest_profiler import GuestProfiler
+from alu_tables import TABLES
+import netlist
+from activity import ActivityMeter
 from time import perf_counter, sleep
 from pathlib import Path
-__version__ = "1.1.2"
-__last_update__ = "Nov. 3rd 2024"
+from array import array
+import hashlib
+import os
+import re
+import struct
+import sys
+import zlib
+__version__ = "1.2.0"
+__last_update__ = "Oct. 18th 2026"
 
 #Assemble the program
 OPS = {
@@ -83,373 +100,752 @@ def split(string: str) -> list[str]:
             output[-1] += char
     return output[:-1] if output[-1] == "" else output
         
-def run_program(lines: list[str], *special_mode):
-    data_section = True
-    program_ends = False
-    tokenList: list[Token] = []
-    refList: list[Token] = [] #list of references for jumps (*here and &here)
-    mem_ptr = RAM_SIZE #memory pointer starts at the end and moves back
+#Assembled program file (.sbbo, little-endian), cached in sbb_cache/ by hash of the source and assembler version
+#   header: magic, version, crc32 of everything after the header
+#   counts: program ends, program size, lines, symbols
+#   RAM_SIZE bytes of RAM, then int32 line pointers, int32 symbol addresses and the symbol names (one per line)
+IMAGE_MAGIC = b"SBBOBJ"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<6sBI")
+IMAGE_COUNTS = struct.Struct("<?III")
+
+class Image:
+    """Assembled program: RAM image, symbol addresses, address of each line and whether it halts"""
+    def __init__(self, mem: bytearray, symbols: dict[str, int], line_ptr: list[int],
+                 program_ends: bool, program_size: int):
+        self.mem = mem
+        self.symbols = symbols
+        self.line_ptr = line_ptr
+        self.program_ends = program_ends
+        self.program_size = program_size
+        self.cached = False #read from the disk cache
+    def dumps(self) -> bytes:
+        numbers = array('i', self.line_ptr + list(self.symbols.values()))
+        if sys.byteorder == "big":
+            numbers.byteswap()
+        body = IMAGE_COUNTS.pack(self.program_ends, self.program_size, len(self.line_ptr), len(self.symbols)) + \
+            bytes(self.mem) + numbers.tobytes() + "\n".join(self.symbols).encode("utf-8")
+        return IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, zlib.crc32(body)) + body
+    @classmethod
+    def loads(cls, data: bytes):
+        """Image from dumps() output, None if it isn't a valid one"""
+        if len(data) < IMAGE_HEADER.size + IMAGE_COUNTS.size + RAM_SIZE:
+            return None
+        magic, version, checksum = IMAGE_HEADER.unpack_from(data)
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION or zlib.crc32(data[IMAGE_HEADER.size:]) != checksum:
+            return None
+        start = IMAGE_HEADER.size + IMAGE_COUNTS.size
+        program_ends, program_size, n_lines, n_symbols = IMAGE_COUNTS.unpack_from(data, IMAGE_HEADER.size)
+        numbers = array('i')
+        numbers.frombytes(data[start + RAM_SIZE:start + RAM_SIZE + 4 * (n_lines + n_symbols)])
+        if sys.byteorder == "big":
+            numbers.byteswap()
+        names = data[start + RAM_SIZE + 4 * (n_lines + n_symbols):].decode("utf-8")
+        names = names.split("\n") if n_symbols else []
+        return cls(bytearray(data[start:start + RAM_SIZE]), dict(zip(names, numbers[n_lines:])),
+                   numbers[:n_lines].tolist(), program_ends, program_size)
+
+def image_path(lines: list[str]) -> Path:
+    source = hashlib.sha256(__version__.encode("utf-8") + b"\0" + "".join(lines).encode("utf-8"))
+    return CACHE_DIR / f"{source.hexdigest()[:32]}.sbbo"
+
+def load_program(lines: list[str], *special_mode, cache = True) -> Image:
+    """Assembled program, read from the disk cache if this source was assembled before"""
+    #the printing modes show the assembling itself
+    cache &= not (special_mode and (special_mode[0] or special_mode[1] or special_mode[5]))
+    path = image_path(lines)
+    if cache:
+        try:
+            image = Image.loads(path.read_bytes())
+        except OSError:
+            image = None
+        if image is not None:
+            image.cached = True
+            return image
+    image = assemble(lines, *special_mode)
+    if cache:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            #write then rename so concurrent runs never read half an image
+            temp = path.with_suffix(f".{os.getpid()}.tmp")
+            temp.write_bytes(image.dumps())
+            os.replace(temp, path)
+        except OSError:
+            pass #read-only install, the program is simply assembled again next run
+    return image
+
+ENGINES = {"gate": None, "int": FastCPU, "fused": FusedCPU, "block": BlockCPU, "reverse": ReverseCPU,
+           "profile": GuestProfiler}
+FAST: FastCPU | None = None
+MACHINE: Machine | None = None #gate-level computer of the running program
+UNITS = {"hz": 1, "khz": 1e3, "mhz": 1e6}
+CLOCK_SLICE = 0.01 #emulated seconds per batch with a clock frequency
+CLOCK_LAG = 0.1 #seconds behind after which the clock stops catching up
+
+def frequency(text: str) -> float:
+    """Clock frequency in Hz from "250kHz", "1.5MHz", "33hz" or "100" (Hz)"""
+    text = text.strip().lower()
+    unit = next((unit for unit in ("khz", "mhz", "hz") if text.endswith(unit)), "hz")
+    value = float(text[:-len(unit)] if text.endswith(unit) else text)
+    if not value > 0 or value == float("inf"):
+        raise ValueError(f"Invalid clock frequency <{text}>")
+    return value * UNITS[unit]
+
+#one tick of the integer engine, with the same outputs as cpu.run()
+def run_fast(display = True, ends = True, debug = False, screen = False):
+    if FAST.run(1) == 0 or not MACHINE.screen.power:
+        return False
+    if screen:
+        if FAST.refresh:
+            MACHINE.ram.load(FAST.mem[Ram.SCREEN_START:Ram.SCREEN_END], Ram.SCREEN_START)
+        MACHINE.screen.scp.equal(FAST.scp)
+        MACHINE.screen.refresh(FAST.refresh)
+
+    if debug and ends:
+        print(f"\n > [Debugger] Tick {FAST.count - 1}")
+        print(FAST)
+    if display:
+        print(" > OUT :", Byte(FAST.out), "              ", end='\r')
+    return True
+
+#the integer engine with the headless screen (-c): whole batches stopping after each refresh tick, whose
+#frame is decoded from the engine's screen memory instead of refreshing the gate-level screen every tick
+def run_frames(max_ticks = -1) -> int:
+    ticks = 0
+    while ticks != max_ticks and MACHINE.screen.power:
+        ticks += FAST.run(max_ticks - ticks if max_ticks >= 0 else -1, True)
+        if not FAST.refresh: #halted or max_ticks reached
+            break
+        MACHINE.screen.draw(FAST.mem[Ram.SCREEN_START:Ram.SCREEN_END], FAST.scp, FAST.count)
+    return ticks
+
+#ticks in batches, returns the ticks run: the threaded screen (-w) gets a copy of the screen memory between
+#batches, and with a clock frequency (--clock) each batch waits for its time against perf_counter
+def run_batches(max_ticks = -1, hz: float | None = None, display = False, debug = False, screen = False) -> int:
+    threaded = screen and isinstance(MACHINE.screen, ThreadedScreen)
+    framed = screen and isinstance(MACHINE.screen, FrameScreen)
+    tick_by_tick = FAST is None or debug or (screen and not (threaded or framed)) #else the engine runs whole batches
+    clock = MACHINE.step if FAST is None else run_fast
+    batch = 64 if FAST is None else 4096 #a few milliseconds either way
+    if hz is not None:
+        batch = max(1, min(batch, round(hz * CLOCK_SLICE)))
+    ticks = 0
+    lost = 0.0 #seconds the clock gave up catching up
     start = perf_counter()
-
-    #Create line pointers
-    line_ptr = [0] * len(lines)
-    start_section = False
-    section = []
-    for l, line in enumerate(lines):
-        #remove empty lines or comment lines
-        if line.strip() == '' or line.strip()[0] == '/': continue
-
-        #remove end-of-line comments
-        comment = line.find('/')
-        if comment != -1:
-            line = line[:comment].strip()
-        
-        #create references
-        ref = len(line) - line[::-1].find('*') - 1
-        if ref != len(line) and line.find('"', ref) == -1:
-            valid = len(split(line[ref:])) == 1 and line[ref:][1].isalpha()
-            assert valid, f"[line {l+1}] Invalid reference <{line[ref+1:-1]}>"
-            name = split(line)[-1][1:]
-            refList.append(Token(name, l+1))
-            refList[-1].content.append(mem_ptr)
-            refList[-1].contentstr.append(str(mem_ptr))
-
-        #check if line is a new function
-        if split(line)[0].endswith(':'):
-            data_section = False
-            ptr = mem_ptr
-            if len(section) != 0:
-                for k, offset in enumerate(section):
-                    line_ptr[section[0] + k] = ptr
-                    if k == 0: continue
-                    for ref in refList:
-                        if ref.addr-1 == section[0] + k:
-                            ref.content[0] = ptr
-                            ref.contentstr[0] = str(ptr)
-                    ptr += offset
-                for ref in refList:
-                    if ref.addr-1 == section[0]:
-                        ref.content[0] = line_ptr[section[0]]
-                        ref.contentstr[0] = str(line_ptr[section[0]])
-            section = [l]
-            if line == "start:\n":
-                if len(refList) != 0:
-                    if refList[-1].addr == l:
-                        refList[-1].content[0] = 0
-                        refList[-1].contentstr[0] = '0'
-                mem_ptr = 0
-                start_section = True
-            
-        #data section
-        elif data_section:
-            args = split(line)
-            arg0 = number(args[0])
-            if arg0 == None:
-                if len(args) < 3:
-                    line_ptr[l] = mem_ptr - 1
-                    mem_ptr -= 1
-                else:
-                    size = 0
-                    for i in range(2, len(args)):
-                        try:
-                            size += len(num2byte(number(args[i])))
-                        except:
-                            size += 1 #error here
-                    line_ptr[l] = mem_ptr - size
-                    mem_ptr -= size
-
-            #rest of the cases    
+    MACHINE.halted = False
+    try:
+        while MACHINE.screen.power and ticks != max_ticks:
+            n = batch if max_ticks < 0 else min(batch, max_ticks - ticks)
+            if tick_by_tick:
+                ran = 0
+                while ran < n and clock(False, True, debug, screen): ran += 1
             else:
-                line_ptr[l] = arg0
-            if len(refList) != 0 and refList[-1].addr == l+1:
-                refList[-1].content = [line_ptr[l]]
-                refList[-1].contentstr = [str(line_ptr[l])]
-            
-
-        #start function section
-        elif start_section:
-            line_ptr[l] = mem_ptr
-            mem_ptr += 2 if OPS[split(line)[0]] < 0xf0 else 1
-
-        #other function sections
+                ran = run_frames(n) if framed else FAST.run(n)
+            ticks += ran
+            if threaded:
+                if FAST is None:
+                    MACHINE.screen.post(MACHINE.ram.screen(), MACHINE.screen.scp.uint())
+                else:
+                    MACHINE.screen.post(FAST.mem[Ram.SCREEN_START:Ram.SCREEN_END], FAST.scp)
+            if display:
+                print(" > OUT :", MACHINE.out if FAST is None else Byte(FAST.out), "              ", end='\r')
+            if ran < n: #halted or the screen was closed
+                break
+            if hz is not None:
+                ahead = start + lost + ticks / hz - perf_counter()
+                if ahead > 0:
+                    sleep(ahead)
+                elif ahead < -CLOCK_LAG:
+                    lost -= ahead
+    except KeyboardInterrupt:
+        print("\n > Stopped")
+    if hz is not None:
+        time = perf_counter() - start
+        drift = time - ticks / hz
+        if drift > CLOCK_LAG:
+            print(f"\n > [Warning] The host can't keep up with the {hz/1000:.2f}kHz clock: "
+                  f"{drift:.2f}s behind after {time:.2f}s ({ticks/time/1000:.2f}kHz)")
+    return ticks
+
+#manual clock commands of the reverse engine: "back [ticks]" and "write <address>"
+def rewind(command: list[str], debug = False):
+    if not isinstance(FAST, ReverseCPU):
+        print(" > [Error] Going back needs the reverse engine (-x)")
+        return
+    arg = number(command[1]) if len(command) > 1 else None
+    if command[0] == "back":
+        ticks = FAST.step_back(1 if arg is None else arg)
+        print(f" > Back {ticks} ticks")
+    elif arg is None:
+        print(" > [Error] Expected an address")
+        return
+    else:
+        ticks = FAST.back_to_write(arg & (RAM_SIZE - 1))
+        if ticks is None:
+            print(f" > No write to {arg} in the history")
         else:
-            section.append(2 if OPS[split(line)[0]] < 0xf0 else 1)
-            mem_ptr -= 2 if OPS[split(line)[0]] < 0xf0 else 1
+            print(f" > Back {ticks} ticks, before the write to {arg}")
+    if debug:
+        print(f"\n > [Debugger] Tick {FAST.count - 1}")
+        print(FAST)
+    print(" > OUT :", Byte(FAST.out), "              ", end='\r')
+
+def lex_line(line: str) -> tuple | None:
+    """Splits one line: (line, words, line reference position, valid reference, words without the reference),
+    None if there is no code"""
+    #remove empty lines or comment lines
+    stripped = line.strip()
+    if stripped == '' or stripped[0] == '/': return None
+
+    #remove end-of-line comments
+    comment = line.find('/')
+    if comment != -1:
+        line = line[:comment].strip()
+
+    #line reference (ex.: *here), not inside a string
+    args = split(line)
+    ref = line.rfind('*')
+    if ref != -1 and line.find('"', ref) == -1:
+        valid = len(split(line[ref:])) == 1 and line[ref+1:ref+2].isalpha()
+        return line, args, ref, valid, split(line[:ref].strip())
+    return line, args, -1, False, args
+
+def lex(lines: list[str]) -> list[tuple]:
+    """Splits the program once: (line index, *lex_line(line)) of each line with code"""
+    lexed = []
+    for l, line in enumerate(lines):
+        words = lex_line(line)
+        if words is not None:
+            lexed.append((l, *words))
+    return lexed
+
+class Program:
+    """Assembler state, the first pass (layout) gives the address of each line and the
+    line references, the second pass turns each section into tokens"""
+    def __init__(self):
+        self.line_ptr: list[int] = []
+        self.refList: list[Token] = [] #list of references for jumps (*here and &here)
+        self.refs: dict[str, list[Token]] = {} #name -> references
+        self.sections: list[list[tuple]] = [[]] #lexed lines of the data section, then of each function
+        self.groups: list[list[Token]] = [] #a function followed by the variables it created, or a data token
+        self.symbols: dict[str, list[Token]] = {} #name -> tokens, in declaration order
+        self.fills: list[tuple[int, int]] = [] #nameless data (ex.: $2ea %10010010) as (address, byte)
+        self.mem_ptr = RAM_SIZE - 1
+        self.data_section = True
+        self.program_ends = False
+        self.line = 0 #line being assembled
+        self.reads: dict | None = None #values the current section read from the others, when recorded
+    def layout(self, lexed: list[tuple], size: int):
+        """First pass: line pointers, references and sections"""
+        data_section = True
+        refList, refs = self.refList, self.refs
+        line_refs: dict[int, Token] = {} #line index -> reference on that line
+        mem_ptr = RAM_SIZE #memory pointer starts at the end and moves back
+
+        #Create line pointers
+        line_ptr = self.line_ptr = [0] * size
+        start_section = False
+        section = []
+        for entry in lexed:
+            l, line, args, ref, valid, code = entry
+            self.line = l
+            if code and code[0].endswith(':'):
+                self.sections.append([entry])
+            else:
+                self.sections[-1].append(entry)
+
+            #create references
+            if ref != -1:
+                assert valid, f"[line {l+1}] Invalid reference <{line[ref+1:-1]}>"
+                name = args[-1][1:]
+                refList.append(Token(name, l+1))
+                refList[-1].content.append(mem_ptr)
+                refList[-1].contentstr.append(str(mem_ptr))
+                refs.setdefault(name, []).append(refList[-1])
+                line_refs[l] = refList[-1]
+
+            #check if line is a new function
+            if args[0].endswith(':'):
+                data_section = False
+                ptr = mem_ptr
+                if len(section) != 0:
+                    for k, offset in enumerate(section):
+                        line_ptr[section[0] + k] = ptr
+                        if k == 0: continue
+                        if section[0] + k in line_refs:
+                            line_refs[section[0] + k].content[0] = ptr
+                            line_refs[section[0] + k].contentstr[0] = str(ptr)
+                        ptr += offset
+                    if section[0] in line_refs:
+                        line_refs[section[0]].content[0] = line_ptr[section[0]]
+                        line_refs[section[0]].contentstr[0] = str(line_ptr[section[0]])
+                section = [l]
+                if line == "start:\n":
+                    if len(refList) != 0:
+                        if refList[-1].addr == l:
+                            refList[-1].content[0] = 0
+                            refList[-1].contentstr[0] = '0'
+                    mem_ptr = 0
+                    start_section = True
+                
+            #data section
+            elif data_section:
+                arg0 = number(args[0])
+                if arg0 == None:
+                    if len(args) < 3:
+                        line_ptr[l] = mem_ptr - 1
+                        mem_ptr -= 1
+                    else:
+                        size = 0
+                        for i in range(2, len(args)):
+                            try:
+                                size += len(num2byte(number(args[i])))
+                            except:
+                                size += 1 #error here
+                        line_ptr[l] = mem_ptr - size
+                        mem_ptr -= size
+
+                #rest of the cases    
+                else:
+                    line_ptr[l] = arg0
+                if len(refList) != 0 and refList[-1].addr == l+1:
+                    refList[-1].content = [line_ptr[l]]
+                    refList[-1].contentstr = [str(line_ptr[l])]
+                
 
-    if special_mode[0]:
-        print("[Debugger] Line pointers: ")
-        for l, line in enumerate(lines):
-            if l+1 == len(lines):
-                print(f"    line {l+1} -> {line_ptr[l]}:\t{line.strip()}")
+            #start function section
+            elif start_section:
+                line_ptr[l] = mem_ptr
+                mem_ptr += 2 if OPS[args[0]] < 0xf0 else 1
+
+            #other function sections
             else:
-                print(f"    line {l+1} -> {line_ptr[l]}:\t{line[:-1].strip()}")
-        if len(refList) == 0:
-            print()
-        else:
-            print("[Debugger] Ref list: ")
-            for ref in refList:
-                print(f"    {ref}")
+                section.append(2 if OPS[args[0]] < 0xf0 else 1)
+                mem_ptr -= 2 if OPS[args[0]] < 0xf0 else 1
+    def declare(self, token: Token, group: list[Token]):
+        group.append(token)
+        self.symbols.setdefault(token.name, []).append(token)
+    def read(self, key: tuple, value):
+        #first time the section reads a value it doesn't declare itself
+        if self.reads is not None and key not in self.reads:
+            self.reads[key] = value
+        return value
+    def section(self, entries: list[tuple]):
+        """Second pass over the data section or one function section"""
+        groups, line_ptr, refs = self.groups, self.line_ptr, self.refs
+        data_section = self.data_section
+        mem_ptr = self.mem_ptr
+        program_ends = False
+        for l, line, _, _, _, args in entries:
+            self.line = l
+            #function section begin, creates a function token
+            if args[0].endswith(':'):
+                assert args[0][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
+                data_section = False
+                groups.append([])
+                self.declare(Token(args[0].strip(':'), mem_ptr + 1), groups[-1])
+
+            #data section
+            elif data_section:
+                #if an address is given
+                arg0 = number(args[0])
+                if type(arg0) == int:
+                    assert len(args) != 1, f"[line {l+1}] Unexpected <{args[0]}>"
+                    arg1 = number(args[1])
 
-    #Create program tokens
-    data_section = True
-    mem_ptr = RAM_SIZE - 1
-    for l, line in enumerate(lines):
-        #remove empty lines or comment lines
-        if line.strip() == '' or line.strip()[0] == '/': continue
+                    #data starts with 2 numbers
+                    if type(arg1) == int:
+                        #set data at a nameless address (ex.: $2ea %10010010)
+                        if len(args) == 2:
+                            for i, byte in enumerate(num2byte(arg1)):
+                                self.fills.append((arg0 + i, byte & 255))
 
-        #remove end-of-line comments
-        comment = line.find('/')
-        if comment != -1:
-            line = line[:comment].strip()
-        
-        #remove line references
-        ref = len(line) - line[::-1].find('*') - 1
-        if ref != len(line) and line.find('"', ref) == -1:
-            line = line[:ref].strip()
-
-        args = split(line)
-
-        #function section begin, creates a function token
-        if args[0].endswith(':'):
-            assert args[0][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
-            data_section = False
-            tokenList.insert(0, Token(args[0].strip(':'), mem_ptr + 1))
-
-        #data section
-        elif data_section:
-            #if an address is given
-            arg0 = number(args[0])
-            if type(arg0) == int:
-                assert len(args) != 1, f"[line {l+1}] Unexpected <{args[0]}>"
-                arg1 = number(args[1])
-
-                #data starts with 2 numbers
-                if type(arg1) == int:
-                    #set data at a nameless address (ex.: $2ea %10010010)
-                    if len(args) == 2:
-                        for i, byte in enumerate(num2byte(arg1)):
-                            RAM.mem[arg0 + i].equal(byte)
-
-                    #set multiple data to a range of addresses (ex.: $100 $200 x = 1500 3200)
+                        #set multiple data to a range of addresses (ex.: $100 $200 x = 1500 3200)
+                        else:
+                            assert args[2][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
+                            token = Token(args[2], arg0)
+                            groups.append([])
+                            self.declare(token, groups[-1])
+                            if len(args) > 3:
+                                assert args[3] == '=', f"[line {l+1}] Syntax error expected '='"
+                                assert len(args) > 4, f"[line {l+1}] Expected data after '='"
+                                for i in range(4, len(args)):
+                                    num = number(args[i])
+                                    assert type(num) == int, f"[line {l+1}] Invalid initialization <{args[i]}>"
+                                    num = num2byte(num)
+                                    for byte in num:
+                                        token.content.append(byte)
+                                        token.contentstr.append(str(byte))
+                            empty_len = 1 + arg1 - arg0 - len(token.content)
+                            token.content += [0] * (empty_len)
+                            token.contentstr += ["<Empty>"] * (empty_len)
+                    
+                    #set data to named address
                     else:
-                        assert args[2][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
-                        tokenList.insert(0, Token(args[2], arg0))
-                        if len(args) > 3:
-                            assert args[3] == '=', f"[line {l+1}] Syntax error expected '='"
-                            assert len(args) > 4, f"[line {l+1}] Expected data after '='"
-                            for i in range(4, len(args)):
+                        assert args[1][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
+                        token = Token(args[1], arg0)
+                        groups.append([])
+                        self.declare(token, groups[-1])
+                        if len(args) == 2:
+                            token.content.append(0)
+                            token.contentstr.append("<Empty>")
+                        else:
+                            assert args[2] == '=', f"[line {l+1}] Syntax error expected '='"
+                            assert len(args) > 3, f"[line {l+1}] Expected data after '='"
+                            for i in range(3, len(args)):
                                 num = number(args[i])
                                 assert type(num) == int, f"[line {l+1}] Invalid initialization <{args[i]}>"
                                 num = num2byte(num)
                                 for byte in num:
-                                    tokenList[0].content.append(byte)
-                                    tokenList[0].contentstr.append(str(byte))
-                        empty_len = 1 + arg1 - arg0 - len(tokenList[0].content)
-                        tokenList[0].content += [0] * (empty_len)
-                        tokenList[0].contentstr += ["<Empty>"] * (empty_len)
-                
-                #set data to named address
+                                    token.content.append(byte)
+                                    token.contentstr.append(str(byte))
+
+
+                #if an addressless-variable is declared
                 else:
-                    assert args[1][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
-                    tokenList.insert(0, Token(args[1], arg0))
-                    if len(args) == 2:
-                        tokenList[0].content.append(0)
-                        tokenList[0].contentstr.append("<Empty>")
+                    assert args[0][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
+                    token = Token(args[0], mem_ptr)
+                    groups.append([])
+                    self.declare(token, groups[-1])
+                    if len(args) == 1:
+                        token.content.append(0)
+                        token.contentstr.append("<Empty>")
+                        mem_ptr -= 1
                     else:
-                        assert args[2] == '=', f"[line {l+1}] Syntax error expected '='"
-                        assert len(args) > 3, f"[line {l+1}] Expected data after '='"
-                        for i in range(3, len(args)):
+                        token.addr += 1
+                        assert args[1] == '=', f"[line {l+1}] Syntax error expected '='"
+                        assert len(args) > 2, f"[line {l+1}] Expected data after '='"
+                        for i in range(2, len(args)):
                             num = number(args[i])
                             assert type(num) == int, f"[line {l+1}] Invalid initialization <{args[i]}>"
                             num = num2byte(num)
                             for byte in num:
-                                tokenList[0].content.append(byte)
-                                tokenList[0].contentstr.append(str(byte))
+                                token.content.append(byte)
+                                token.contentstr.append(str(byte))
+                                token.addr -= 1
+                                mem_ptr -= 1
 
-
-            #if an addressless-variable is declared
+            #if data section is complete, add ops to function token
             else:
-                assert args[0][0].isalpha(), f"[line {l+1}] Invalid declaration <{args[0]}>"
-                tokenList.insert(0, Token(args[0], mem_ptr))
-                if len(args) == 1:
-                    tokenList[0].content.append(0)
-                    tokenList[0].contentstr.append("<Empty>")
+                group = groups[-1]
+                function = group[0]
+                function.content.append(OPS[args[0]])
+                OPS_LEN = 2 if OPS[args[0]] < 0b11110000 else 1
+                assert OPS_LEN == len(args), f"[line {l+1}] Incorrect use of <{args[0]}>"
+                function.contentstr.append(' '.join(args))
+
+                #want to know if the program is intended to loop or not
+                program_ends |= args[0] in ["halt", "hlta", "halt#"]
+
+                #ops with number arguments
+                if 0xf0 > OPS[args[0]] >= 0xe0:
+                    assert len(args) == 2, f"[line {l+1}] Incorrect use of <{args[0]}>"
+                    function.content.append(number(args[1]) & 255)
+                    if function.name != "start":
+                        function.addr -= 1
+                        mem_ptr -= 1
+
+                #ops with address arguments
+                elif 0xe0 > OPS[args[0]]:
+                    assert len(args) == 2, f"[line {l+1}] Incorrect use of <{args[0]}>"
+                    #if second word is a number, store it directly as a number
+                    arg0 = number(args[1])
+                    if type(arg0) == int:
+                        arg0 &= RAM_SIZE-1
+                        function.content[-1] += arg0 >> 8
+                        function.content.append(arg0 & 255)
+
+                    #line reference (ex.: l123 -> means to find the address at line 123)
+                    elif args[1][0].lower() == 'l' and args[1][1:].isdecimal():
+                        index = int(args[1][1:]) - 1
+                        arg0 = self.read(("line", index), line_ptr[index])
+                        function.content[-1] += arg0 >> 8
+                        function.content.append(arg0 & 255)
+
+                    #line pointer reference (ex.: &&loop finds the address at 1 more than line marked *loop)
+                    elif args[1][0] == '&':
+                        offset = 1
+                        while args[1][offset:][0] == '&': offset += 1
+                        ref_named = args[1][offset:]
+
+                        #if ref is known set value to corresponding line address
+                        found = self.read(("ref", ref_named), [ref.content[0] for ref in refs.get(ref_named, [])])
+                        assert found, f"[line {l+1}] Invalid reference <{ref_named}>"
+                        for addr in found:
+                            arg0 = addr + offset - 1
+                            function.content[-1] += arg0 >> 8
+                            function.content.append(arg0 & 255)
+
+                    #if second word has a name
+                    else:
+                        #if word is a know token, add its address to token content
+                        known = [token for token in reversed(self.symbols.get(args[1], [])) if token is not function]
+                        self.read(("symbol", args[1]), [token.addr for token in known])
+                        for token in known:
+                            arg0 = token.addr
+                            function.content[-1] += arg0 >> 8
+                            function.content.append(arg0 & 255)
+
+                        #if word is an invalid token, create this token
+                        if not known:
+                            assert function.name != args[1], f"[line {l+1}] Invalid declaration <{args[1]}>"
+
+                            #determine ram address of created token
+                            if function.name == "start":
+                                if len(group) > 1:
+                                    invalid_token_addr = group[-1].addr - 1
+                                else:
+                                    invalid_token_addr = self.read(("previous",), groups[-2][0].addr) - 1
+                            else:
+                                invalid_token_addr = function.addr + len(function.content) - 2
+                                function.addr -= 1
+
+                            #add token right after its function
+                            token = Token(args[1], invalid_token_addr)
+                            self.declare(token, group)
+                            token.content.append(None)
+                            token.contentstr.append("<Empty>")
+                            arg0 = token.addr
+                            function.content[-1] += arg0 >> 8
+                            function.content.append(arg0 & 255)
+
+                    if function.name != "start":
+                        function.addr -= 1
+                        mem_ptr -= 1
+                if function.name != "start":
+                    function.addr -= 1
                     mem_ptr -= 1
-                else:
-                    tokenList[0].addr += 1
-                    assert args[1] == '=', f"[line {l+1}] Syntax error expected '='"
-                    assert len(args) > 2, f"[line {l+1}] Expected data after '='"
-                    for i in range(2, len(args)):
-                        num = number(args[i])
-                        assert type(num) == int, f"[line {l+1}] Invalid initialization <{args[i]}>"
-                        num = num2byte(num)
-                        for byte in num:
-                            tokenList[0].content.append(byte)
-                            tokenList[0].contentstr.append(str(byte))
-                            tokenList[0].addr -= 1
-                            mem_ptr -= 1
-
-        #if data section is complete, add ops to function token
+            assert mem_ptr > 0, "Program unable to fit in memory"
+        self.mem_ptr = mem_ptr
+        self.data_section = data_section
+        self.program_ends |= program_ends
+    def tokens(self) -> list[Token]:
+        """Tokens in writing order, the last declared first"""
+        tokenList = [token for group in reversed(self.groups) for token in group[:1] + group[:0:-1]]
+        if len(tokenList) > 1:
+            assert tokenList[1].addr >= len(tokenList[0].content), "Too many variable or declared function after start"
+        return tokenList
+    def image(self, *special_mode) -> Image:
+        tokenList = self.tokens()
+        mem = bytearray(RAM_SIZE)
+        for addr, byte in self.fills:
+            mem[addr] = byte
+
+        #Write program to RAM
+        mem_ptr = 0
+        program_size = 0
+        for token in tokenList:
+            if len(token.content) == 0: continue
+            mem_ptr = token.addr
+            for content in token.content:
+                if type(content) is int:
+                    mem[mem_ptr] = content & 255
+                program_size += 1
+                mem_ptr += 1
+            if special_mode[5] or special_mode[1]:
+                print("[Asm]", token)
+                if special_mode[1]:
+                    print_chunk(mem, token.addr, token.addr + len(token.content) - 1)
+        program_size = max(RAM_SIZE - mem.count(0), program_size)
+        symbols = {token.name: token.addr for token in reversed(tokenList)} #a name declared twice keeps its last address
+        return Image(mem, symbols, self.line_ptr, self.program_ends, program_size)
+
+def assemble(lines: list[str], *special_mode) -> Image:
+    """Assembles the program into a RAM image"""
+    program = Program()
+    program.layout(lex(lines), len(lines))
+
+    if special_mode[0]:
+        print("[Debugger] Line pointers: ")
+        for l, line in enumerate(lines):
+            if l+1 == len(lines):
+                print(f"    line {l+1} -> {program.line_ptr[l]}:\t{line.strip()}")
+            else:
+                print(f"    line {l+1} -> {program.line_ptr[l]}:\t{line[:-1].strip()}")
+        if len(program.refList) == 0:
+            print()
         else:
-            tokenList[0].content.append(OPS[args[0]])
-            OPS_LEN = 2 if OPS[args[0]] < 0b11110000 else 1
-            assert OPS_LEN == len(args), f"[line {l+1}] Incorrect use of <{args[0]}>"
-            tokenList[0].contentstr.append(' '.join(split(line)))
-
-            #want to know if the program is intended to loop or not
-            program_ends |= args[0] in ["halt", "hlta", "halt#"]
-
-            #ops with number arguments
-            if 0xf0 > OPS[args[0]] >= 0xe0:
-                assert len(args) == 2, f"[line {l+1}] Incorrect use of <{args[0]}>"
-                tokenList[0].content.append(number(args[1]) & 255)
-                if tokenList[0].name != "start":
-                    tokenList[0].addr -= 1
-                    mem_ptr -= 1
+            print("[Debugger] Ref list: ")
+            for ref in program.refList:
+                print(f"    {ref}")
 
-            #ops with address arguments
-            elif 0xe0 > OPS[args[0]]:
-                assert len(args) == 2, f"[line {l+1}] Incorrect use of <{args[0]}>"
-                #if second word is a number, store it directly as a number
-                arg0 = number(args[1])
-                if type(arg0) == int:
-                    arg0 &= RAM_SIZE-1
-                    tokenList[0].content[-1] += arg0 >> 8
-                    tokenList[0].content.append(arg0 & 255)
-
-                #line reference (ex.: l123 -> means to find the address at line 123)
-                elif args[1][0].lower() == 'l' and args[1][1:].isdecimal():
-                    arg0 = line_ptr[int(args[1][1:]) - 1]
-                    tokenList[0].content[-1] += arg0 >> 8
-                    tokenList[0].content.append(arg0 & 255)
-
-                #line pointer reference (ex.: &&loop finds the address at 1 more than line marked *loop)
-                elif args[1][0] == '&':
-                    offset = 1
-                    while args[1][offset:][0] == '&': offset += 1
-                    invalid_ref = True
-                    ref_named = args[1][offset:]
-
-                    #if ref is known set value to corresponding line address
-                    for ref in refList:
-                        if ref.name == ref_named:
-                            arg0 = ref.content[0] + offset - 1
-                            tokenList[0].content[-1] += arg0 >> 8
-                            tokenList[0].content.append(arg0 & 255)
-                            invalid_ref = False
-
-                    assert not invalid_ref, f"[line {l+1}] Invalid reference <{ref_named}>"
-
-                #if second word has a name
-                else:
-                    invalid_token = True
-
-                    #if word is a know token, add its address to token content
-                    for l in range(1, len(tokenList)):
-                        if tokenList[l].name == args[1]:
-                            arg0 = tokenList[l].addr
-                            tokenList[0].content[-1] += arg0 >> 8
-                            tokenList[0].content.append(arg0 & 255)
-                            invalid_token = False
-
-                    #if word is an invalid token, create this token
-                    if invalid_token:
-                        assert tokenList[0].name != args[1], f"[line {l+1}] Invalid declaration <{args[1]}>"
-
-                        #determine ram address of created token
-                        if tokenList[0].name == "start":
-                            invalid_token_addr = tokenList[1].addr - 1
-                        else:
-                            invalid_token_addr = tokenList[0].addr + len(tokenList[0].content) - 2
-                            tokenList[0].addr -= 1
-
-                        #add token at second to last in token list
-                        tokenList.insert(1, Token(args[1], invalid_token_addr))
-                        tokenList[1].content.append(None)
-                        tokenList[1].contentstr.append("<Empty>")
-                        arg0 = tokenList[1].addr
-                        tokenList[0].content[-1] += arg0 >> 8
-                        tokenList[0].content.append(arg0 & 255)
-
-                if tokenList[0].name != "start":
-                    tokenList[0].addr -= 1
-                    mem_ptr -= 1
-            if tokenList[0].name != "start":
-                tokenList[0].addr -= 1
-                mem_ptr -= 1
-        assert mem_ptr > 0, "Program unable to fit in memory"
-
-    #Write program to RAM
-    mem_ptr = 0
-    program_size = 0
-    if len(tokenList) > 1:
-        assert tokenList[1].addr >= len(tokenList[0].content), "Too many variable or declared function after start"
-    for token in tokenList:
-        if len(token.content) == 0: continue
-        mem_ptr = token.addr
-        for content in token.content:
-            if type(content) is int:
-                RAM.mem[mem_ptr].equal(content)
-            program_size += 1
-            mem_ptr += 1
-        if special_mode[5] or special_mode[1]:
-            print("[Asm]", token)
-            if special_mode[1]:
-                RAM.chunk(token.addr, token.addr + len(token.content) - 1)
-    program_size = max(len(RAM), program_size)
-    print(f"Compiled successfully ({round((perf_counter() - start)*1000,2)}ms)")
+    for section in program.sections:
+        program.section(section)
+    return program.image(*special_mode)
+
+def run_program(lines: list[str], *special_mode, engine = "gate", tables = False, machine: Machine | None = None,
+                capture: str | None = None, threaded_screen = False, hz: float | None = None,
+                max_ticks: int | None = None, profile: str | None = None, guest_profile: str | None = None,
+                compiled = False, activity: str | None = None):
+    global FAST, MACHINE
+    assert engine in ENGINES, f"Unknown engine <{engine}>"
+    if machine is None and capture is not None:
+        machine = Machine(screen=FrameScreen) #headless screen
+    elif machine is None and threaded_screen:
+        machine = Machine(screen=ThreadedScreen)
+    MACHINE = default_machine() if machine is None else machine
+    RAM, SCREEN, OUT = MACHINE.ram, MACHINE.screen, MACHINE.out
+    start = perf_counter()
+    image = load_program(lines, *special_mode)
+    RAM.load(image.mem)
+    program_ends, program_size = image.program_ends, image.program_size
+    print(f"Compiled successfully ({round((perf_counter() - start)*1000,2)}ms{', cached' if image.cached else ''})")
     print(f"Program size: {program_size} bytes ({round(program_size/RAM_SIZE*100,2)}%)\n")
 
-    if special_mode[6]:
+    screen = special_mode[6] or capture is not None or threaded_screen
+    if capture is not None:
+        print(f"Capturing the screen to {capture}")
+        SCREEN.on(capture)
+    elif threaded_screen:
+        assert isinstance(SCREEN, ThreadedScreen), "The threaded screen needs a Machine(screen=ThreadedScreen)"
+        print(f"Initializing Screen ({ThreadedScreen.FPS} fps, the CPU on its own thread)")
+        SCREEN.on()
+    elif special_mode[6]:
         print("Initializing Screen")
         SCREEN.on()
 
-    #manual clock cycle mode
-    if special_mode[4]:
-        if input(" > ").lower() != "stop":
-            while run(True, True, special_mode[0], special_mode[6]):
-                if input("\n > ").lower() == "stop": break
-        print("\n_________________________________                               \n"
-              "OUT :", OUT,)
-
-    #if program contains a halt (careful bc some programs might no end)
-    elif program_ends:
-        start = perf_counter()
-        tick = 0
-        while run(False, True, special_mode[0], special_mode[6]): tick += 1
-        time = perf_counter() - start
-        units = 1000 if time < 10 else 1
-        print(f"_________________________________\n"
-              f"Program execution: {time*units:.2f}{'ms' if time < 10 else 's'}, "
-              f"{tick/time/1000:.2f}kHz\n"
-              "OUT :", OUT)
-
-    #program contains no loops
+    profiler = None
+    if profile is not None:
+        if engine != "gate":
+            print("[Warning] The host profiler only covers the gate engine")
+        else:
+            profiler = HostProfiler(MACHINE) #before clock takes MACHINE.step
+            profiler.attach()
+    meter = None
+    if activity is not None and (engine != "gate" or profiler is not None):
+        print("[Warning] Gate activity is only counted on the gate engine, without the host profiler")
+        activity = None
+
+    if engine != "gate":
+        FAST = ENGINES[engine](MACHINE.cu.rom)
+        FAST.load(RAM)
+        if isinstance(FAST, GuestProfiler):
+            FAST.source(lex(lines), image.line_ptr, OPS)
+        clock = run_fast
     else:
-        l = 0
-        while run(True, False, special_mode[0], special_mode[6]) and \
-            (l<2**20 if special_mode[3] else l<2**14):
-            if not special_mode[3]:
-                sleep(0.03)
-            l += 1
-        print("_________________________________                               \n"
-              "OUT :", OUT)
+        FAST = None
+        MACHINE.alu.tables = TABLES if tables else None
+        if compiled:
+            netlist.attach(MACHINE)
+        else:
+            netlist.detach(MACHINE)
+        if activity is not None:
+            meter = ActivityMeter(MACHINE, OPS) #probed netlists, replaces the plain ones
+            meter.attach()
+            Gate.reset()
+        clock = MACHINE.step
+
+    #runs the program, on a worker thread with the threaded screen: its window belongs to the main thread
+    def execute():
+        nonlocal max_ticks
+        #manual clock cycle mode
+        if special_mode[4]:
+            command = input(" > ").lower().split()
+            while command[:1] != ["stop"]:
+                if command[:1] in (["back"], ["write"]):
+                    rewind(command, special_mode[0])
+                elif not clock(True, True, special_mode[0], screen):
+                    break
+                command = input("\n > ").lower().split()
+            print("\n_________________________________                               \n"
+                  "OUT :", OUT if FAST is None else Byte(FAST.out))
+
+        #if program contains a halt (careful bc some programs might no end)
+        elif program_ends:
+            start = perf_counter()
+            tick = 0
+            if hz is not None or threaded_screen or max_ticks is not None:
+                tick = run_batches(-1 if max_ticks is None else max_ticks, hz, False, special_mode[0], screen)
+            elif engine != "gate" and not (special_mode[0] or screen):
+                tick = FAST.run()
+            elif engine != "gate" and not special_mode[0] and isinstance(SCREEN, FrameScreen):
+                tick = run_frames()
+            else:
+                while clock(False, True, special_mode[0], screen): tick += 1
+            time = perf_counter() - start
+            units = 1000 if time < 10 else 1
+            print(f"_________________________________\n"
+                  f"Program execution: {time*units:.2f}{'ms' if time < 10 else 's'}, "
+                  f"{tick/time/1000:.2f}kHz\n"
+                  "OUT :", OUT if FAST is None else Byte(FAST.out))
+
+        #program contains no loops
+        else:
+            l = 0
+            if max_ticks is None: #no limit with a clock frequency
+                max_ticks = -1 if hz is not None else 2**20 if special_mode[3] else 2**14
+            if hz is not None or (threaded_screen and special_mode[3]):
+                l = run_batches(max_ticks, hz, True, special_mode[0], screen)
+            else:
+                while clock(True, False, special_mode[0], screen) and l != max_ticks:
+                    if not special_mode[3]:
+                        sleep(0.03)
+                    l += 1
+            print("_________________________________                               \n"
+                  "OUT :", OUT if FAST is None else Byte(FAST.out))
+
+    if threaded_screen:
+        SCREEN.run(execute)
+    else:
+        execute()
 
     if special_mode[2]:
+        if FAST is not None:
+            RAM.load(FAST.mem[0x500:0x504], 0x500)
         RAM.chunk(0x500,0x503)
-        result = RAM.mem[0x500].uint()\
-        | RAM.mem[0x501].uint() << 8  \
-        | RAM.mem[0x502].uint() << 16 \
-        | RAM.mem[0x503].uint() << 24
+        result = int.from_bytes(RAM.view(0x500, 0x504), "little")
         print("Result:", result)
-    #print(Gate.count, "logic gates used\n")
+    if capture is not None:
+        SCREEN.off()
+        print(f"{SCREEN.frames} frames captured")
+    elif threaded_screen:
+        SCREEN.off()
+        print(f"{SCREEN.frames} frames drawn")
+    if isinstance(FAST, GuestProfiler):
+        print(FAST.report())
+        if guest_profile:
+            FAST.save(guest_profile)
+            print(f"Profile saved to {guest_profile}")
+    if profiler is not None:
+        profiler.detach()
+        print(profiler.table())
+        if profile:
+            profiler.save(profile)
+            print(f"Profile saved to {profile}")
+    if meter is not None:
+        meter.detach()
+        print(meter.report())
+        print(Gate.count, "logic gates used\n")
+        meter.save(activity)
+        print(f"Activity saved to {activity}")
 
 #if program is run as a main file ask for a file
 if __name__ == "__main__":
     print(f'SBB Computer & SBBasm {__version__} by Charles Benoit ({__last_update__})')
     special_mode = [False] * 7
+    engine = "gate"
+    tables = False
+    compiled = False
+    activity = False
+    capture = False
+    threaded_screen = False
+    profile = False
+    hz = max_ticks = None
     program = input("Run >>> ").strip()
 
+    #options with a value, anywhere on the line: --clock 250kHz (real-time clock), --ticks 1000000 (-1: no limit)
+    option = re.search(r"\s*--clock\s+(\S+)", program)
+    if option:
+        hz = frequency(option[1])
+        program = program.replace(option[0], "")
+        print(f"[Special mode] Clock set to {hz/1000:g}kHz")
+    option = re.search(r"\s*--ticks\s+(-?\d+)", program)
+    if option:
+        max_ticks = int(option[1])
+        program = program.replace(option[0], "")
+        print(f"[Special mode] Run limited to {max_ticks} ticks" if max_ticks >= 0 else "[Special mode] Unlimited run")
+    program = program.strip()
+
     #debug tools
     while True:
         match program[-2:]:
@@ -474,6 +870,39 @@ if __name__ == "__main__":
             case "-v":
                 print("[Special mode] Screen visuals enabled")
                 special_mode[6] = True
+            case "-i":
+                print("[Special mode] Integer engine enabled")
+                engine = "int"
+            case "-u":
+                print("[Special mode] Fused instruction engine enabled")
+                engine = "fused"
+            case "-b":
+                print("[Special mode] Block translation engine enabled")
+                engine = "block"
+            case "-x":
+                print("[Special mode] Reverse stepping enabled (back [ticks], write <address>)")
+                engine = "reverse"
+            case "-a":
+                print("[Special mode] ALU tables enabled")
+                tables = True
+            case "-n":
+                print("[Special mode] Compiled gate netlist enabled")
+                compiled = True
+            case "-e":
+                print("[Special mode] Gate activity counters enabled (.activity.json next to the program)")
+                activity = True
+            case "-w":
+                print("[Special mode] Threaded screen enabled (drawn at a fixed frame rate, the CPU runs in batches on its own thread)")
+                threaded_screen = True
+            case "-g":
+                print("[Special mode] Program profiler enabled (.folded flamegraph next to the program)")
+                engine = "profile"
+            case "-p":
+                print("[Special mode] Host profiler enabled (.speedscope.json next to the program)")
+                profile = True
+            case "-c":
+                print("[Special mode] Headless screen capture enabled (.sbbcap next to the program)")
+                capture = True
             case _:
                 print()
                 break
@@ -487,7 +916,14 @@ if __name__ == "__main__":
             program = cwd + "\\sbbasm_program_files\\" + program
     else:
         program = cwd + "\\sbbasm_program_files\\" + program + ".sbbasm"
+    capture = str(Path(program).with_suffix(".sbbcap")) if capture else None
+    profile = str(Path(program).with_suffix(".speedscope.json")) if profile else None
+    guest_profile = str(Path(program).with_suffix(".folded")) if engine == "profile" else None
+    activity = str(Path(program).with_suffix(".activity.json")) if activity else None
     program = open(program, "r")
     lines = program.readlines()
     program.close()
-    run_program(lines, *special_mode)
\ No newline at end of file
+    run_program(lines, *special_mode, engine=engine, tables=tables, capture=capture, threaded_screen=threaded_screen,
+                hz=hz, max_ticks=max_ticks, profile=profile,
+                guest_profile=guest_profile, compiled=compiled,
+                activity=activity)
\ No newline at end of file
@@ -0,0 +1,81 @@
+#Assembler benchmark on generated programs, the time per line should stay flat as programs grow
+#   python asm_bench.py [lines] [runs]
+import random
+import sys
+from time import perf_counter
+import asm
+
+QUIET = [False] * 7 #no special mode while assembling
+MONOS = ["noop", "inc", "dec", "rsh", "lsh", "not", "incb", "pusha", "popa", "move"]
+NUMBERS = ["ldi", "add#", "sub#", "and#", "or#", "ldib", "xor#", "push#"]
+ADDRESSES = ["lda", "add", "sub", "sta", "and", "or"]
+
+def generate(size: int = 4000, seed: int = 0) -> list[str]:
+    """Program of size lines using every kind of operand: variables, functions, line references, comments"""
+    rng = random.Random(seed)
+    lines = ["/generated program\n"]
+    variables = []
+    for i in range(size // 4):
+        if i % 8 == 0:
+            lines.append(f"v{i} = {rng.randrange(256)}\n")
+        else:
+            lines.append(f"${rng.randrange(0x400, 0x500):x} v{i}\n") #screen memory, out of the code's way
+        variables.append(f"v{i}")
+    functions = []
+    refs = []
+    while len(lines) < size - 8:
+        name = f"f{len(functions)}"
+        lines.append(f"{name}:\n")
+        for j in range(rng.randrange(8, 24)):
+            kind = rng.random()
+            if kind < 0.3:
+                lines.append(rng.choice(["\n", "/comment\n", "  / indented comment\n"]))
+                continue
+            if kind < 0.55:
+                line = rng.choice(MONOS)
+            elif kind < 0.68:
+                line = f"{rng.choice(NUMBERS)} {rng.randrange(256)}"
+            elif kind < 0.8:
+                line = f"{rng.choice(ADDRESSES)} {rng.choice(variables)}"
+            elif kind < 0.85:
+                line = f"sta t{len(functions)}_{j}" #created on first use
+            elif kind < 0.9 and functions:
+                line = f"jsr {rng.choice(functions)}"
+            elif kind < 0.95 and refs:
+                line = f"jmpz {'&' * rng.randrange(1, 3)}{rng.choice(refs)}"
+            else:
+                line = f"lda l{rng.randrange(1, len(lines) + 1)}"
+            if rng.random() < 0.15:
+                refs.append(f"r{len(refs)}")
+                line += f"    *{refs[-1]}"
+            if rng.random() < 0.1:
+                line += "    /end of line comment"
+            lines.append(line + "\n")
+        lines.append("ret\n")
+        functions.append(name)
+    lines.append("start:\n")
+    for name in functions[-3:]:
+        lines.append(f"jsr {name}\n")
+    lines.append("hlta")
+    return lines
+
+def bench(lines: list[str], runs: int = 5) -> float:
+    """Best assembling time in seconds"""
+    best = float("inf")
+    for i in range(runs):
+        start = perf_counter()
+        asm.assemble(lines, *QUIET)
+        best = min(best, perf_counter() - start)
+    return best
+
+def main(argv: list[str]) -> int:
+    size = int(argv[0]) if argv else 4000
+    runs = int(argv[1]) if len(argv) > 1 else 5
+    for n in (size // 4, size // 2, size):
+        lines = generate(n)
+        seconds = bench(lines, runs)
+        print(f"{len(lines):6} lines: {seconds * 1000:8.2f} ms, {seconds / len(lines) * 1e6:6.2f} us/line")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
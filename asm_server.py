@@ -0,0 +1,136 @@
+#Assembler service for editors: one JSON request per line on stdin, one JSON reply per line on stdout
+#   {"id": 1, "method": "open", "text": "..."}                              whole program (or "path": file)
+#   {"id": 2, "method": "change", "start": 4, "end": 5, "text": "lda x\n"}   replaces lines start to end (0-based, end excluded)
+#   {"id": 3, "method": "shutdown"}
+#Each reply holds the first error (assembling stops there, as when running), the address of each line,
+#of each name and reference, and how many sections had to be assembled again:
+#   {"id": 2, "errors": [{"line": 12, "message": "[line 12] Incorrect use of <lda>"}], "lines": [...],
+#    "symbols": {"start": 0, ...}, "refs": {"loop": 4, ...}, "sections": [1, 40], "ms": 0.9}
+import json
+import sys
+from pathlib import Path
+from time import perf_counter
+import asm
+
+class Session:
+    """A program kept assembled between edits
+
+    Lines are lexed once, when they change. A section (the data section or a
+    function) is only assembled again if one of its lines changed or moved, or
+    if something it used from the other sections did: its start address, or the
+    address of a name, reference or line it reads."""
+    def __init__(self, text: str = ""):
+        self.lines: list[str] = []
+        self.entries: list[tuple | None] = [] #lexed line (as in asm.lex), None without code
+        self.cache = {} #(first line, last line) -> (start address, data section, reads, outputs)
+        self.program: asm.Program | None = None #last assembled
+        self.change(0, 0, text)
+    def change(self, start: int, end: int, text: str):
+        """Replaces lines start to end (excluded) with the lines of text"""
+        start = max(0, min(start, len(self.lines)))
+        end = max(start, min(end, len(self.lines)))
+        new = text.replace("\r\n", "\n").splitlines(keepends=True)
+        self.lines[start:end] = new
+        entries = []
+        for l, line in enumerate(new, start):
+            words = asm.lex_line(line)
+            entries.append(None if words is None else (l, *words))
+        self.entries[start:end] = entries
+        shift = len(new) - (end - start)
+        if shift:
+            #the following lines moved, so did their line numbers
+            for l in range(start + len(new), len(self.entries)):
+                if self.entries[l] is not None:
+                    self.entries[l] = (l, *self.entries[l][1:])
+            end = len(self.lines) + 1
+        for key in list(self.cache):
+            if key[1] >= start and key[0] < end:
+                del self.cache[key]
+    def read(self, program: asm.Program, key: tuple):
+        #current value of something a section read from the others, before running it
+        kind = key[0]
+        if kind == "line":
+            try:
+                return program.line_ptr[key[1]]
+            except IndexError:
+                return None
+        if kind == "ref":
+            return [ref.content[0] for ref in program.refs.get(key[1], [])]
+        if kind == "symbol":
+            return [token.addr for token in reversed(program.symbols.get(key[1], []))]
+        return program.groups[-1][0].addr if program.groups else None #"previous"
+    def section(self, program: asm.Program, entries: list[tuple]) -> bool:
+        """Second pass over one section, reused from the last time if possible, returns True if assembled again"""
+        key = (entries[0][0], entries[-1][0])
+        cached = self.cache.pop(key, None)
+        if cached is not None:
+            mem_ptr, data_section, reads, outputs = cached
+            if mem_ptr == program.mem_ptr and data_section == program.data_section and \
+                all(self.read(program, read) == value for read, value in reads.items()):
+                groups, fills, program.mem_ptr, program.data_section, ends = outputs
+                for group in groups:
+                    program.groups.append([])
+                    for token in group:
+                        program.declare(token, program.groups[-1])
+                program.fills += fills
+                program.program_ends |= ends
+                self.cache[key] = cached
+                return False
+        inputs = (program.mem_ptr, program.data_section)
+        groups, fills, ends = len(program.groups), len(program.fills), program.program_ends
+        program.reads = {}
+        program.program_ends = False
+        program.section(entries)
+        outputs = (program.groups[groups:], program.fills[fills:], program.mem_ptr, program.data_section,
+                   program.program_ends)
+        self.cache[key] = (*inputs, program.reads, outputs)
+        program.reads = None
+        program.program_ends |= ends
+        return True
+    def assemble(self) -> dict:
+        start = perf_counter()
+        program = self.program = asm.Program()
+        errors = []
+        assembled = 0
+        try:
+            program.layout([entry for entry in self.entries if entry is not None], len(self.lines))
+            for entries in program.sections:
+                if entries:
+                    assembled += self.section(program, entries)
+            program.line = None
+            program.tokens()
+        except Exception as error: #anything assembling would stop on
+            message = str(error) if isinstance(error, AssertionError) else f"{type(error).__name__}: {error}"
+            errors.append({"line": None if program.line is None else program.line + 1, "message": message})
+        return {"errors": errors, "lines": program.line_ptr,
+                "symbols": {name: tokens[-1].addr for name, tokens in program.symbols.items()},
+                "refs": {ref.name: ref.content[0] for ref in program.refList},
+                "sections": [assembled, sum(1 for entries in program.sections if entries)],
+                "ms": round((perf_counter() - start) * 1000, 3)}
+
+def main(stdin = sys.stdin, stdout = sys.stdout) -> int:
+    session = Session()
+    for line in stdin:
+        if not line.strip():
+            continue
+        request = {}
+        try:
+            request = json.loads(line)
+            method = request.get("method")
+            if method == "open":
+                text = Path(request["path"]).read_text() if "path" in request else request.get("text", "")
+                session = Session(text)
+            elif method == "change":
+                session.change(request["start"], request["end"], request.get("text", ""))
+            elif method == "shutdown":
+                break
+            else:
+                raise ValueError(f"Unknown method <{method}>")
+            reply = session.assemble()
+        except (ValueError, KeyError, TypeError, AttributeError, OSError) as error:
+            reply = {"error": f"Invalid request: {type(error).__name__}: {error}"}
+        print(json.dumps({"id": request.get("id"), **reply}), file=stdout, flush=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#Non-interactive runner: assembles and runs many .sbbasm programs across a process pool,
+#printing one JSON line per program
+#   python batch.py tests/ "homework/**/*.sbbasm" --engine block --max-ticks 1000000 --timeout 30
+import argparse
+import glob
+import json
+import os
+import sys
+from multiprocessing import Pool
+from pathlib import Path
+from time import perf_counter
+import asm
+from alu_tables import TABLES
+from cpu import Machine
+
+CHUNK = 2**14 #ticks run between two wall-clock budget checks
+GATE_CHUNK = 2**10 #same for the (much slower) gate-level engine
+QUIET = [False] * 7 #no special mode while assembling
+
+MACHINE: Machine | None = None #one per worker, reused (and reset) between programs
+
+def worker_init(tables = False):
+    #loads the ROM once per worker
+    global MACHINE
+    MACHINE = Machine()
+    MACHINE.alu.tables = TABLES if tables else None
+
+def programs(patterns: list[str]) -> list[Path]:
+    """Expands directories (their .sbbasm files) and glob patterns, in order without duplicates"""
+    paths = {}
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            found = sorted(path.glob("*.sbbasm"))
+        elif path.is_file():
+            found = [path]
+        else:
+            found = [Path(p) for p in sorted(glob.glob(pattern, recursive=True))]
+        for p in found:
+            paths.setdefault(p.resolve(), p)
+    return list(paths.values())
+
+def run_job(job: tuple) -> dict:
+    path, engine, max_ticks, timeout, cache = job
+    result = {"program": str(path), "engine": engine, "out": None, "ticks": 0, "wall": 0.0, "khz": 0.0,
+              "asm_time": 0.0, "status": "error", "error": None}
+    machine = MACHINE
+    machine.reset()
+    start = perf_counter()
+    try:
+        with open(path, "r") as program:
+            lines = program.readlines()
+        machine.load(asm.load_program(lines, *QUIET, cache=cache).mem)
+    except AssertionError as error:
+        result["error"] = str(error) #the assembler's messages hold the line number
+        return result
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+        return result
+    result["asm_time"] = round(perf_counter() - start, 6)
+
+    chunk = CHUNK
+    if engine == "gate":
+        cpu = machine
+        chunk = GATE_CHUNK
+    else:
+        cpu = asm.ENGINES[engine](machine.cu.rom)
+        cpu.load(machine.ram)
+    ticks = 0
+    start = perf_counter()
+    deadline = start + timeout if timeout > 0 else None
+    while True:
+        ticks += cpu.run(chunk if max_ticks < 0 else min(chunk, max_ticks - ticks))
+        if cpu.halted:
+            result["status"] = "halted"
+            break
+        if ticks == max_ticks:
+            result["status"] = "max_ticks"
+            break
+        if deadline is not None and perf_counter() > deadline:
+            result["status"] = "timeout"
+            break
+    wall = perf_counter() - start
+    result["out"] = machine.out.data.uint() if engine == "gate" else cpu.out
+    result["ticks"] = ticks
+    result["wall"] = round(wall, 6)
+    result["khz"] = round(ticks / wall / 1000, 2) if wall > 0 else 0.0
+    return result
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Assemble and run .sbbasm programs in parallel")
+    parser.add_argument("programs", nargs="+", help=".sbbasm files, directories or glob patterns")
+    parser.add_argument("-e", "--engine", choices=list(asm.ENGINES), default="block")
+    parser.add_argument("-a", "--tables", action="store_true", help="ALU tables for the gate engine")
+    parser.add_argument("-n", "--max-ticks", type=int, default=10**8, help="tick budget per program (-1: none)")
+    parser.add_argument("-t", "--timeout", type=float, default=60.0, help="wall-clock budget per program in seconds (0: none)")
+    parser.add_argument("--no-cache", action="store_true", help="assemble every program, even unchanged ones")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args(argv)
+
+    jobs = [(path, args.engine, args.max_ticks, args.timeout, not args.no_cache) for path in programs(args.programs)]
+    if not jobs:
+        print("[Error] No program found", file=sys.stderr)
+        return 2
+    statuses = {}
+    start = perf_counter()
+    if args.jobs <= 1:
+        worker_init(args.tables)
+        results = map(run_job, jobs)
+        pool = None
+    else:
+        pool = Pool(min(args.jobs, len(jobs)), worker_init, (args.tables,))
+        results = pool.imap(run_job, jobs)
+    try:
+        for result in results:
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+            print(json.dumps(result), flush=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+    print(f"{len(jobs)} programs in {perf_counter() - start:.2f}s ({summary})", file=sys.stderr)
+    return 1 if "error" in statuses else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,11 @@
-import pygame as app
+from array import array
+from pathlib import Path
+from rom import ROM_SIZE, shared_rom
+
+app = None #pygame, imported when a screen is turned on
 
 RAM_SIZE = 2**12
+CACHE_DIR = Path(__file__).parent / "sbb_cache"
 
 class Bit:
     def __init__(self, state: bool | int = False):
@@ -73,6 +78,7 @@ class Gate:
     @classmethod
     def logic_gate_count(cls, inc = 1):
         cls.count += inc
+    @classmethod
     def reset(cls):
         cls.count = 0
 
@@ -159,6 +165,9 @@ class Alu:
         self.ZF = Bit() #zero flag
         self.SF = Bit() #sign flag
 
+        self.tables = None #lookup tables replacing the gates (see alu_tables.py)
+        self.netlist = None #compiled gates (see netlist.py)
+
     def optype(self) -> int:
         return (self.L4() << 3) | (self.L3() << 2) | (self.L2() << 1) | self.L1()
     
@@ -180,8 +189,20 @@ class Alu:
             self.bus.copy(output)
             self.CF.copy(in1.byte[0])
 
+    def lookup(self, optype):
+        entry = self.tables[optype][(self.A.uint() << 8) | self.B.uint()]
+        self.bus.equal(entry & 255)
+        if entry & 0x800: #carry written
+            self.CF.equal(entry & 0x100)
+        self.ZF.equal(entry & 0x200)
+        self.SF.equal(entry & 0x400)
+
     def __call__(self):
         optype = self.optype()
+        if self.tables is not None and 0 < optype < 13:
+            return self.lookup(optype)
+        if self.netlist is not None:
+            return self.netlist(self, optype)
         match optype:
             case 1: #addition L1
                 self.adder.A, self.adder.B = self.A, self.B
@@ -246,7 +267,56 @@ class Alu:
             self.ZF.copy(Nor(*self.bus))
             self.SF.copy(self.bus.byte[7])
 
+class Cell:
+    """Byte-like handle on one RAM address, for code written against Ram.mem[i]"""
+    __slots__ = ("data", "addr")
+    def __init__(self, data: bytearray, addr: int):
+        self.data = data
+        self.addr = addr
+    def __str__(self):
+        return str(Byte(self.data[self.addr]))
+    @property
+    def byte(self):
+        return Byte(self.data[self.addr]).byte
+    def uint(self):
+        return self.data[self.addr]
+    def int(self):
+        value = self.data[self.addr]
+        return value - 256 if value & 128 else value
+    def equal(self, new_value, signed = False):
+        if signed and new_value < 0:
+            new_value = (new_value % 128) + 128
+        self.data[self.addr] = new_value % 256
+    def copy(self, new_value):
+        self.data[self.addr] = new_value.uint()
+
+class Cells:
+    """Ram.mem: indexing gives a Cell, iterating gives every Cell"""
+    __slots__ = ("data",)
+    def __init__(self, data: bytearray):
+        self.data = data
+    def __getitem__(self, addr: int) -> Cell:
+        if not -len(self.data) <= addr < len(self.data):
+            raise IndexError("RAM address out of range")
+        return Cell(self.data, addr % len(self.data))
+    def __len__(self):
+        return len(self.data)
+    def __iter__(self):
+        return (Cell(self.data, addr) for addr in range(len(self.data)))
+
+def print_chunk(data, start = 0, end = 16):
+    #addresses start to end (included) of a RAM image
+    msg = f"RAM -> {start}\n" if start == end else f"RAM -> ({start} to {end})\n"
+    msg += "[ Addr ][   Data   ]\n"
+    start = max(start, 0)
+    end = min(end, RAM_SIZE - 1)
+    for i, value in enumerate(memoryview(data)[start:end+1], start):
+        msg += f"| {str(i).rjust(4, '0')} || {value:08b} |\n"
+    print(msg)
+
 class Ram:
+    SCREEN_START = 0x400 #characters shown by the screen
+    SCREEN_END   = 0x500
     def __init__(self, mbus: list[Bit], bus: Byte):
         self.mbus = mbus
         self.A = [Bit() for i in range(len(mbus))]
@@ -254,26 +324,25 @@ class Ram:
         self.RI = Bit() #RAM write
         self.RO = Bit() #RAM read
         self.MI = Bit() #MAR in
-        self.mem = [Byte() for i in range(RAM_SIZE)]
+        self.data = bytearray(RAM_SIZE)
+        self.mem = Cells(self.data)
+    def view(self, start = 0, end = RAM_SIZE) -> memoryview:
+        """Zero-copy window on addresses start to end (excluded)"""
+        return memoryview(self.data)[start:end]
+    def screen(self) -> memoryview:
+        return self.view(Ram.SCREEN_START, Ram.SCREEN_END)
+    def load(self, image, start = 0):
+        #bulk copy of bytes (or any buffer) from address start
+        self.data[start:start + len(image)] = image
     def chunk(self, start = 0, end = 16):
-        msg = f"RAM -> {start}\n" if start == end else f"RAM -> ({start} to {end})\n"
-        msg += "[ Addr ][   Data   ]\n"
-        start = max(start, 0)
-        end = min(end, RAM_SIZE - 1)
-        for i in range(start, end+1):
-            msg += f"| {str(i).rjust(4, '0')} || {str(self.mem[i])[2:10]} |\n"
-        print(msg)
+        print_chunk(self.data, start, end)
     def __str__(self):
         string = ""
         for i in range(12):
             string += str(int(self.A[i].state))
         return string[::-1]
     def __len__(self):
-        count = 0
-        for byte in self.mem:
-            if byte.uint() != 0:
-                count += 1
-        return count
+        return RAM_SIZE - self.data.count(0)
     def decoder(self):
         inv = [Bit(self.A[i]()).flip() for i in range(len(self.A))]
         outputs = []
@@ -300,11 +369,11 @@ class Ram:
         #         self.bus.copy(self.mem[i])
         if self.RI():
             # Gate.logic_gate_count(16)
-            self.mem[self.value()].copy(self.bus)
+            self.data[self.value()] = self.bus.uint()
         if self.RO():
             # Gate.logic_gate_count(16)
-            # print(f"Wrote {self.mem[self.value()].uint()} from {self.value()}")
-            self.bus.copy(self.mem[self.value()])
+            # print(f"Wrote {self.data[self.value()]} from {self.value()}")
+            self.bus.equal(self.data[self.value()])
         if self.MI():
             self.write()
 
@@ -326,6 +395,7 @@ class ProgCounter:
         self.JP = Bit() #Jump (program counter in)
         self.CE = Bit() #Count enable
         self.counter = [Bit() for i in range(12)]
+        self.netlist = None #compiled write() (see netlist.py)
     def __str__(self):
         string = ""
         for i in range(len(self.counter)):
@@ -337,6 +407,8 @@ class ProgCounter:
             sum |= int(self.counter[i].state) << i
         return sum
     def write(self):
+        if self.netlist is not None:
+            return self.netlist(self)
         if self.CE():
             # Gate.logic_gate_count(12)
             bin_counter(self.counter, 12)
@@ -371,8 +443,8 @@ class Register:
             self.bus.copy(self.data)
 
 class ControlUnit:
-    ROM_SIZE = 2**14
-    def __init__(self, ir: Byte, ir2: Byte, controls: list[Bit], cond: list[Bit], mbus: list[Bit]):
+    ROM_SIZE = ROM_SIZE
+    def __init__(self, ir: Byte, ir2: Byte, controls: list[Bit], cond: list[Bit], mbus: list[Bit], rom = None):
         self.counter = Byte()
         self.ins = ir.byte[4:]
         self.addr = ir2.byte + ir.byte[:4]
@@ -380,12 +452,8 @@ class ControlUnit:
         self.cond = cond
         self.mbus = mbus
         self.IO = self.controls[4]
-        self.rom = [0] * ControlUnit.ROM_SIZE
-        control_signals = open("control_signals.rom", "r")
-        for i in range(ControlUnit.ROM_SIZE):
-            line = control_signals.readline()
-            self.rom[i] = int(line, 2)
-        control_signals.close()
+        self.rom = shared_rom() if rom is None else rom
+        self.netlist = None #compiled __call__ (see netlist.py)
     def __str__(self):
         return f"Op: {(self.value.uint() & 0b11110000) >> 4}"
     def decoder(self):
@@ -410,6 +478,8 @@ class ControlUnit:
             sum |= int(self.addr[i+8].state) << (i+4)
         return sum
     def __call__(self):
+        if self.netlist is not None:
+            return self.netlist(self)
         rom_addr = (self.counter.uint() & 7) | (self.value() << 3)
         rom_addr |= int(self.cond[0]()) << 11
         rom_addr |= int(self.cond[1]()) << 12
@@ -426,48 +496,62 @@ class ControlUnit:
             for i in range(12):
                 self.mbus[i].state = self.addr[i].state
 
+class StackError(Exception):
+    pass
+
 class StackMemory:
+    SIZE = 256
     def __init__(self, bus: Byte, mbus: list[Bit]):
         self.bus = bus
         self.mbus = mbus
         self.SI = Bit() #Stack in (increment)
         self.SO = Bit() #Stack out (decrement)
         self.SA = Bit() #Stack address output (false: takes from bus, true: takes from mbus)
-        self.sp = Byte() #Stack pointer
-        self.mem = [[Bit() for j in range(12)] for i in range(256)]
+        self.strict = False #raise StackError instead of wrapping around
+        self.reset()
+    def reset(self):
+        self.sp = 0 #Stack pointer
+        self.mem = array('H', bytes(2 * StackMemory.SIZE)) #12 bit entries
+        self.overflow = False #a push wrapped sp back to 0
+        self.underflow = False #a pop wrapped sp to 255
     def __str__(self):
-        msg = f"[   sp = {str(self.sp.uint()).rjust(3, '0')}   ]\n"
-        for i in range(1, self.sp.uint()+1):
-            msg += f"| {bin(self.uint(self.sp.uint() - i))[2:].rjust(12, '0')} |\n"
-        return msg
+        #live frames only, top of the stack first
+        lines = [f"[   sp = {str(self.sp).rjust(3, '0')}   ]"]
+        lines += [f"| {entry:012b} |" for entry in reversed(self.mem[:self.sp])]
+        if self.overflow or self.underflow:
+            lines.append(f"[ {'overflow' if self.overflow else 'underflow'} ]")
+        return "\n".join(lines) + "\n"
     def uint(self, n):
-        sum = 0
-        for i in range(len(self.mem[n])):
-            sum |= int(self.mem[n][i].state) << i
-        return sum
+        return self.mem[n]
     def inc(self):
-        bin_counter(self.sp.byte, 8)
+        if self.sp == StackMemory.SIZE - 1:
+            if self.strict:
+                raise StackError("Stack overflow")
+            self.overflow = True
+        self.sp = (self.sp + 1) % StackMemory.SIZE
     def dec(self):
-        borrow = Bit(1)
-        for bit in self.sp.byte:
-            bit.copy(Xor(bit, borrow))
-            borrow = And(bit, borrow)
+        if self.sp == 0:
+            if self.strict:
+                raise StackError("Stack underflow")
+            self.underflow = True
+        self.sp = (self.sp - 1) % StackMemory.SIZE
     def __call__(self):
         if self.SO():
             self.dec()
+            entry = self.mem[self.sp]
             if self.SA():
                 for i in range(12):
-                    self.mbus[i].copy(self.mem[self.sp.uint()][i])
+                    self.mbus[i].state = bool((entry >> i) & 1)
             else:
-                for i in range(8):
-                    self.bus.byte[i].copy(self.mem[self.sp.uint()][i])
+                self.bus.equal(entry & 255)
         elif self.SI():
             if self.SA():
+                entry = 0
                 for i in range(12):
-                    self.mem[self.sp.uint()][i].copy(self.mbus[i])
+                    entry |= int(self.mbus[i].state) << i
+                self.mem[self.sp] = entry
             else:
-                for i in range(8):
-                    self.mem[self.sp.uint()][i].copy(self.bus.byte[i])
+                self.mem[self.sp] = (self.mem[self.sp] & 0xf00) | self.bus.uint()
             self.inc()
 
 class Screen:
@@ -487,6 +571,8 @@ class Screen:
         self.bus = bus
     
     def on(self):
+        global app
+        import pygame as app
         app.init()
         self.font = app.font.SysFont("Monospace", 70)
         app.display.set_caption("SBB Computer by Charles Benoit")
@@ -496,6 +582,8 @@ class Screen:
             app.quit()
             print("[Error] Screen disconnected from RAM")
             exit()
+        self.atlas = self.glyphs()
+        self.shown = None #screen memory and scp as last drawn
         self.refresh()
 
         # while self.power:
@@ -514,22 +602,192 @@ class Screen:
 
         if self.power:
             if render:
-                self.grid()
-            app.display.update()
-
-    def grid(self):
-        self.display.fill(Screen.BACK_COLOR)
-        for x in range(0, Screen.SCREEN_DIM[0]):
-            for y in range(0, Screen.SCREEN_DIM[1]):
-                rect = app.Rect(x*Screen.CHAR_SIZE[0]*self.scale, y*Screen.CHAR_SIZE[1]*self.scale,
-                                Screen.CHAR_SIZE[0]*self.scale, Screen.CHAR_SIZE[1]*self.scale)
-                app.draw.rect(self.display, (0,0,0), rect, 1)
-                addr = (x + Screen.SCREEN_DIM[0]*y - self.scp.uint())%256 + 1024 
-                char = self.ram.mem[addr].uint() % 128
-                if char != 0:
-                    char = self.font.render(chr(char), False, Screen.LETTER_COLOR)
-                    self.display.blit(char, ((x*Screen.CHAR_SIZE[0]-0.3)*self.scale,
-                                             (y*Screen.CHAR_SIZE[1]-1.3)*self.scale))
+                app.display.update(self.grid())
+            else:
+                app.display.update()
+
+    def glyphs(self):
+        #the 128 ASCII characters rendered once, each drawn in its cell (background, border and letter)
+        width, height = Screen.CHAR_SIZE[0]*self.scale, Screen.CHAR_SIZE[1]*self.scale
+        atlas = app.Surface((128*width, height)).convert()
+        atlas.fill(Screen.BACK_COLOR)
+        for char in range(128):
+            cell = atlas.subsurface(app.Rect(char*width, 0, width, height))
+            app.draw.rect(cell, (0,0,0), cell.get_rect(), 1)
+            if char != 0:
+                cell.blit(self.font.render(chr(char), False, Screen.LETTER_COLOR), (-0.3*self.scale, -1.3*self.scale))
+        return atlas
+
+    def grid(self) -> list:
+        return self.draw(bytes(self.ram.screen()), self.scp.uint())
+
+    def draw(self, window: bytes, scp: int) -> list:
+        """Draws the cells whose character changed since the last frame (every cell when scp changed),
+        returns the rectangles drawn"""
+        if self.shown is None or self.shown[1] != scp:
+            cells = range(len(window))
+        elif window == self.shown[0]:
+            cells = ()
+        else:
+            last = self.shown[0]
+            cells = [addr for addr in range(len(window)) if window[addr] != last[addr]]
+        self.shown = (window, scp)
+        width, height = Screen.CHAR_SIZE[0]*self.scale, Screen.CHAR_SIZE[1]*self.scale
+        rects = []
+        for addr in cells:
+            x, y = (addr + scp) % Screen.SCREEN_DIM[0], (addr + scp) % 256 // Screen.SCREEN_DIM[0]
+            rect = app.Rect(x*width, y*height, width, height)
+            self.display.blit(self.atlas, rect, app.Rect(window[addr] % 128 * width, 0, width, height))
+            rects.append(rect)
+        return rects
+
+class Machine:
+    """One simulated computer: every component, the control wires and the clock
+
+    Machines are independent, so one process can keep several of them and
+    reuse them between programs with reset() and load()."""
+    def __init__(self, rom = None, screen: type = Screen):
+        self.bus  = Byte()
+        self.hlt  = Bit() #Halt signal
+        self.rfh  = Bit() #Refresh signal
+
+        #    Registers    #
+        self.rega = Register(self.bus)
+        self.regb = Register(self.bus)
+        self.ir   = Register(self.bus) #write only
+        self.ir2  = Register(self.bus)
+        self.out  = Register(self.bus) #write only
+        self.mbus = [Bit() for i in range(12)]
+
+        #    Components    #
+        self.alu  = Alu(self.rega.data, self.regb.data, self.bus)
+        self.ram  = Ram(self.mbus, self.bus)
+        self.pc   = ProgCounter(self.mbus)
+        self.st   = StackMemory(self.bus, self.mbus)
+        self.screen = screen(self.bus, self.ram)
+        self.control_wires = [
+            self.ram.MI,    #0
+            self.ram.RI,    #1
+            self.ram.RO,    #2
+            self.ir.IN,     #3
+            self.ir2.OUT,   #4
+            self.pc.CO,     #5
+            self.pc.JP,     #6
+            self.pc.CE,     #7
+            self.rega.IN,   #8
+            self.rega.OUT,  #9
+
+            self.alu.L1,    #10
+            self.alu.L2,    #11
+            self.alu.L3,    #12
+            self.alu.L4,    #13
+
+            self.hlt,       #14
+            self.regb.IN,   #15
+            self.regb.OUT,  #16
+            self.out.IN,    #17
+            self.ir2.IN,    #18
+            self.st.SI,     #19
+            self.st.SO,     #20
+            self.st.SA,     #21
+            self.rfh,       #22
+            self.screen.PI  #23
+        ]
+        self.flags = [
+            self.alu.CF,    #0, carry flag
+            self.alu.ZF,    #1, zero flag
+            self.alu.SF     #2, sign flag
+        ]
+        self.cu = ControlUnit(self.ir.data, self.ir2.data, self.control_wires, self.flags, self.mbus, rom)
+        self.count = 0
+        self.halted = False
+    def reset(self):
+        """Clears every register, flag, wire and memory cell, the ROM stays loaded"""
+        for bit in [self.hlt, self.rfh, *self.mbus, *self.control_wires, *self.flags, *self.pc.counter, *self.ram.A]:
+            bit.off()
+        for byte in [self.bus, self.rega.data, self.regb.data, self.ir.data, self.ir2.data, self.out.data,
+                     self.screen.scp, self.cu.counter]:
+            byte.equal(0)
+        self.ram.data[:] = bytes(RAM_SIZE)
+        self.st.reset()
+        self.count = 0
+        self.halted = False
+    def load(self, mem):
+        #mem is a Ram or a RAM image (bytes or any buffer)
+        self.ram.load(mem.data if isinstance(mem, Ram) else mem)
+    def print_mbus(self):
+        string = ""
+        sum = 0
+        for i in range(len(self.mbus)):
+            string += str(int(self.mbus[i].state))
+            sum |= int(self.mbus[i].state) << i
+        print("0b" + string[::-1] + f" (u12: {str(sum)})")
+    def step(self, display = True, ends = True, debug = False, screen = False) -> bool:
+        """One clock tick, returns False on a halt"""
+        self.cu()
+        if self.hlt() or not self.screen.power:
+            self.halted = True
+            return False
+        self.alu()
+        self.pc  .read()
+        self.rega.read()
+        self.regb.read()
+        self.ir2 .read()
+        self.cu  .read()
+        self.ram()
+        self.st()
+        self.rega.write()
+        self.regb.write()
+        self.ir  .write()
+        self.ir2 .write()
+        self.out .write()
+        self.pc  .write()
+        if screen:
+            self.screen.refresh(self.rfh())
+        if display or debug:
+            self.show(display, debug and ends)
+        self.count += 1
+        return True
+    def show(self, display = True, debug = False):
+        #tick outputs of step(), before count moves to the next tick
+        if debug:
+            print(f"\n > [Debugger] Tick {self.count}")
+            print(" > BUS:", self.bus)
+            print(" > REGA:", self.rega)
+            print(" > REGB:", self.regb)
+            print(" > I1:", self.ir)
+            print(" > I2:", self.ir2)
+            print(self.st)
+        if display:
+            print(" > OUT :", self.out, "              ", end='\r')
+    def run(self, max_ticks = -1) -> int:
+        """Runs until a halt or max_ticks, returns the number of ticks executed (halt tick excluded)"""
+        ticks = 0
+        self.halted = False
+        while ticks != max_ticks and self.step(False, False):
+            ticks += 1
+        return ticks
+
+#Module level computer used by asm.py (BUS, RAM, CU, run()...), only built the
+#first time one of these names is imported so importing cpu stays cheap
+MACHINE: Machine | None = None
+LEGACY_NAMES = {
+    "BUS": "bus", "HLT": "hlt", "RFH": "rfh", "REGA": "rega", "REGB": "regb", "IR": "ir", "IR2": "ir2",
+    "OUT": "out", "MBUS": "mbus", "ALU": "alu", "RAM": "ram", "PC": "pc", "ST": "st", "SCREEN": "screen",
+    "control_wires": "control_wires", "flags": "flags", "CU": "cu", "count": "count",
+    "run": "step", "print_mbus": "print_mbus"
+}
+
+def default_machine() -> Machine:
+    global MACHINE
+    if MACHINE is None:
+        MACHINE = Machine()
+    return MACHINE
+
+def __getattr__(name):
+    if name in LEGACY_NAMES:
+        return getattr(default_machine(), LEGACY_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 #    MAIN PROGRAM    #
 if __name__ == '__main__':
@@ -544,100 +802,3 @@ if __name__ == '__main__':
     SCREEN.on()
     while SCREEN.power:
         SCREEN.refresh()
-
-else:
-    BUS  = Byte()
-    HLT  = Bit() #Halt signal
-    RFH  = Bit() #Refresh signal
-
-    #    Registers    #
-    REGA = Register(BUS)
-    REGB = Register(BUS)
-    IR   = Register(BUS) #write only
-    IR2  = Register(BUS)
-    OUT  = Register(BUS) #write only
-    MBUS = [Bit() for i in range(12)]
-
-    def print_mbus():
-        string = ""
-        sum = 0
-        for i in range(len(MBUS)):
-            string += str(int(MBUS[i].state))
-            sum |= int(MBUS[i].state) << i
-        print("0b" + string[::-1] + f" (u12: {str(sum)})")
-
-    #    Components    #
-    ALU  = Alu(REGA.data, REGB.data, BUS)
-    RAM  = Ram(MBUS, BUS)
-    PC   = ProgCounter(MBUS)
-    ST   = StackMemory(BUS, MBUS)
-    SCREEN = Screen(BUS, RAM)
-    control_wires = [
-        RAM.MI,     #0
-        RAM.RI,     #1
-        RAM.RO,     #2
-        IR.IN,      #3
-        IR2.OUT,    #4
-        PC.CO,      #5
-        PC.JP,      #6
-        PC.CE,      #7
-        REGA.IN,    #8
-        REGA.OUT,   #9
-
-        ALU.L1,     #10
-        ALU.L2,     #11
-        ALU.L3,     #12
-        ALU.L4,     #13
-        
-        HLT,        #14
-        REGB.IN,    #15
-        REGB.OUT,   #16
-        OUT.IN,     #17
-        IR2.IN,     #18
-        ST.SI,      #19
-        ST.SO,      #20
-        ST.SA,      #21
-        RFH,        #22
-        SCREEN.PI   #23
-    ]
-    flags = [
-        ALU.CF,     #0, carry flag
-        ALU.ZF,     #1, zero flag
-        ALU.SF      #2, sign flag
-    ]
-    CU = ControlUnit(IR.data, IR2.data, control_wires, flags, MBUS)
-    count = 0
-    def run(display = True, ends = True, debug = False, screen = False):
-        global count
-        CU()
-        if HLT() or not SCREEN.power:
-            return False
-        ALU()
-        PC  .read()
-        REGA.read()
-        REGB.read()
-        IR2 .read()
-        CU  .read()
-        RAM()
-        ST()
-        REGA.write()
-        REGB.write()
-        IR  .write()
-        IR2 .write()
-        OUT .write()
-        PC  .write()
-        if screen:
-            SCREEN.refresh(RFH())
-        
-        if debug and ends:
-            print(f"\n > [Debugger] Tick {count}")
-            print(" > BUS:", BUS)
-            print(" > REGA:", REGA)
-            print(" > REGB:", REGB)
-            print(" > I1:", IR)
-            print(" > I2:", IR2)
-            print(ST)
-        count += 1
-        if display:
-            print(" > OUT :", OUT, "              ", end='\r')
-        return True
\ No newline at end of file
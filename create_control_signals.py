@@ -1,4 +1,4 @@
-from pathlib import Path
+from rom import ROM_TEXT, ROM_BIN, write_rom
 
 CS_NUM = 24
 FLAGS_NUM = 3
@@ -81,12 +81,12 @@ controls_list = [
     [],
 ]
 
-doc = open(str(Path.cwd()) + "\\control_signals.rom", "w")
+words: list[int] = []
 
 def writeROM(flags: int, al: int):
     #Common fetching instructions
-    fetch1 = bin(CO|MI)[2:].rjust(CS_NUM, '0') + '\n'
-    fetch2 = bin(RO|II|CE)[2:].rjust(CS_NUM, '0') + '\n'
+    fetch1 = CO|MI
+    fetch2 = RO|II|CE
 
     #Carry flag conditional controls
     CF = bool(flags & 1)
@@ -183,12 +183,10 @@ def writeROM(flags: int, al: int):
         controls_list[15] = [HT]
         
     for controls in controls_list:
-        doc.write(fetch1)
-        doc.write(fetch2)
-        for control in controls:
-            doc.write(bin(control)[2:].rjust(CS_NUM, '0') + '\n')
-        for i in range(6 - len(controls)):
-            doc.write('0'.rjust(CS_NUM, '0') + '\n')
+        words.append(fetch1)
+        words.append(fetch2)
+        words.extend(controls)
+        words.extend([0] * (6 - len(controls)))
 
 if __name__ == '__main__':
     print('[                ]', end='\r')
@@ -199,6 +197,10 @@ if __name__ == '__main__':
         # sleep(0.1)
         print('['+ ('=='*(flags+1)).ljust(1<<(FLAGS_NUM+1), ' ') + ']', end='\r')
 
-    print("\nDone.")
+    doc = open(ROM_TEXT, "w")
+    for word in words:
+        doc.write(bin(word)[2:].rjust(CS_NUM, '0') + '\n')
+    doc.close()
+    write_rom(words, ROM_BIN)
 
-doc.close()
\ No newline at end of file
+    print("\nDone.")
\ No newline at end of file
@@ -0,0 +1,88 @@
+#Screen drawn at a fixed frame rate (-w) by the main thread while the CPU runs in batches on a worker thread,
+#posting a copy of the screen memory and scp between them, so polling and drawing the window never slow the
+#clock down (pygame windows can only be driven from the main thread on macOS, so the CPU is the one moved)
+import threading
+from time import perf_counter
+from cpu import Screen
+
+class ThreadedScreen(Screen):
+    """Screen whose window is drawn by the main thread while the CPU runs on a worker
+
+    on() opens the window. run(work) calls work, the CPU loop, on a worker
+    thread: the CPU side only latches scp on each tick and posts (screen
+    memory, scp) snapshots with post(), and the main thread draws the latest
+    one FPS times per second until work returns. Closing the window (or
+    Ctrl-C) clears power, which stops the CPU loop."""
+    FPS = 60
+
+    def __init__(self, bus, mem_access = None, scale = 10):
+        super().__init__(bus, mem_access, scale)
+        self.posted = None #(screen memory, scp), replaced as a whole so the renderer never sees half a frame
+        self.drawn = None #posted snapshot on the window
+        self.frames = 0 #frames drawn
+
+    def on(self):
+        self.power = True
+        self.post(self.ram.screen(), self.scp.uint())
+        Screen.on(self)
+        self.show()
+
+    def off(self):
+        #draws the last frame posted then closes the window
+        import pygame as app
+        if self.power:
+            self.show()
+        self.power = False
+        app.quit()
+
+    def post(self, window, scp: int):
+        self.posted = (bytes(window), scp)
+
+    def refresh(self, render=False):
+        #called by the CPU loop, a refresh instruction posts the screen memory as it is
+        if self.PI():
+            self.scp.copy(self.bus)
+        if render:
+            self.post(self.ram.screen(), self.scp.uint())
+
+    def show(self):
+        #polls the window and draws the last snapshot posted if it wasn't yet
+        import pygame as app
+        for event in app.event.get():
+            if event.type == app.QUIT:
+                self.power = False
+        posted = self.posted
+        if self.power and posted is not self.drawn:
+            app.display.update(self.draw(*posted))
+            self.frames += 1
+            self.drawn = posted
+
+    def run(self, work):
+        """Returns work() run on a worker thread, the window drawn meanwhile"""
+        result = error = None
+        def worker():
+            nonlocal result, error
+            try:
+                result = work()
+            except BaseException as exception: #reraised on the main thread
+                error = exception
+        thread = threading.Thread(target=worker, name="cpu", daemon=True)
+        thread.start()
+        period = 1 / self.FPS
+        deadline = perf_counter()
+        while thread.is_alive():
+            try:
+                self.show()
+                deadline += period
+                delay = deadline - perf_counter()
+                if delay > 0:
+                    thread.join(delay)
+                else:
+                    deadline = perf_counter() #late, don't try to catch up
+            except KeyboardInterrupt:
+                print("\n > Stopped")
+                self.power = False #the CPU loop stops at its next batch
+        thread.join()
+        if error is not None:
+            raise error
+        return result
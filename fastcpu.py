@@ -0,0 +1,397 @@
+import re
+from textwrap import dedent
+from cpu import RAM_SIZE, Byte
+from alu_tables import TABLES, CW_BIT, AluTables
+
+#Control signal bits, same order as create_control_signals.py and cpu.control_wires
+MI = 1 << 0     #mem address register in
+RI = 1 << 1     #ram data in
+RO = 1 << 2     #ram data out
+II = 1 << 3     #instruction register in
+IO = 1 << 4     #instruction register out
+CO = 1 << 5     #program counter register out
+JP = 1 << 6     #program counter register in
+CE = 1 << 7     #program counter increment enable
+AI = 1 << 8     #A register in
+AO = 1 << 9     #A register out
+L1 = 1 << 10    #ALU signal 1
+L2 = 1 << 11    #ALU signal 2
+L3 = 1 << 12    #ALU signal 3
+L4 = 1 << 13    #ALU signal 4
+HT = 1 << 14    #halt signal enable
+BI = 1 << 15    #B register in
+BO = 1 << 16    #B register out
+OI = 1 << 17    #output register in
+XI = 1 << 18    #extended instruction content in
+SI = 1 << 19    #Stack in (increments)
+SO = 1 << 20    #Stack out (decrements)
+SA = 1 << 21    #Stack address (linked w bus if false and mbus if true)
+RF = 1 << 22    #refresh signal
+PI = 1 << 23    #screen pointer in
+
+ALU_MASK = L1|L2|L3|L4
+READ_MASK = CO|AO|BO|IO
+RAM_MASK = MI|RI|RO
+STACK_MASK = SI|SO
+WRITE_MASK = AI|BI|II|XI|OI|CE|JP|PI|RF
+
+def rom_base(ir: int) -> int:
+    #ROM address bits 3-10 for an instruction register value (op nibble, then arg nibble)
+    return ((ir >> 4) << 3) | ((ir & 15) << 7)
+
+#FastCPU.run as source, shared by the engines recording more of each tick: every "#@hook" line is
+#replaced by the statements an engine gives for that hook (run_function), so the microcode semantics
+#are written once. Hooks: setup (locals), top (every loop iteration), tick (a tick that doesn't halt,
+#before it runs), ram_write/ram_read (around the RAM access), push (before a stack write), call/ret
+#(stack address push and pop), finish (after the loop, before the registers are stored back)
+RUN_SOURCE = """\
+def run(self, max_ticks = -1, until_refresh = False) -> int:
+    \"\"\"Runs until a halt or max_ticks, returns the number of ticks executed (halt tick excluded)
+
+    With until_refresh it also stops right after a tick raising RF, the screen
+    memory and scp as that frame shows them (refresh is then True).\"\"\"
+    rom = self.rom
+    tables = self.tables
+    mem = self.mem
+    stack = self.stack
+    #@setup
+    a, b, ir, ir2, out = self.a, self.b, self.ir, self.ir2, self.out
+    bus, mbus, mar, pc, sp = self.bus, self.mbus, self.mar, self.pc, self.sp
+    step, scp = self.step, self.scp
+    base = rom_base(ir)
+    flags = self.flags << 11
+    refresh = self.refresh
+    self.halted = False
+    now = first = self.count
+    end = now + max_ticks if max_ticks >= 0 else -1
+    while now != end:
+        #@top
+        w = rom[step | base | flags]
+        if w & HT:
+            step = (step + 1) & 7
+            self.halted = True
+            refresh = False
+            break
+        #@tick
+        if not w:
+            #end of instruction, control unit resets
+            step = 0
+            refresh = False
+            now += 1
+            continue
+        step = (step + 1) & 7
+
+        if w & ALU_MASK:
+            optype = (w >> 10) & 15
+            if optype < 13:
+                entry = tables[optype][(a << 8) | b]
+                bus = entry & 255
+                if entry & CW_BIT:
+                    flags = (entry & 0x700) << 3
+                else:
+                    flags = (flags & 1 << 11) | (entry & 0x600) << 3
+            else: #unused optypes leave the bus as is
+                flags = (flags & 1 << 11) | (bus == 0) << 12 | (bus >> 7) << 13
+
+        if w & READ_MASK:
+            if w & CO: mbus = pc
+            if w & AO: bus = a
+            if w & BO: bus = b
+            if w & IO:
+                bus = ir2
+                mbus = ((ir & 15) << 8) | ir2
+
+        if w & RAM_MASK:
+            if w & RI:
+                #@ram_write
+                mem[mar] = bus
+            if w & RO:
+                bus = mem[mar]
+                #@ram_read
+            if w & MI: mar = mbus
+
+        if w & STACK_MASK:
+            if w & SO:
+                sp = (sp - 1) & 255
+                if w & SA:
+                    mbus = stack[sp]
+                    #@ret
+                else: bus = stack[sp] & 255
+            else:
+                #@push
+                if w & SA:
+                    stack[sp] = mbus
+                    #@call
+                else: stack[sp] = (stack[sp] & 0xf00) | bus
+                sp = (sp + 1) & 255
+
+        if w & WRITE_MASK:
+            if w & AI: a = bus
+            if w & BI: b = bus
+            if w & II:
+                ir = bus
+                base = rom_base(ir)
+            if w & XI: ir2 = bus
+            if w & OI: out = bus
+            if w & CE: pc = (pc + 1) & (RAM_SIZE - 1)
+            if w & JP: pc = mbus
+            if w & PI: scp = bus
+            refresh = bool(w & RF)
+            if refresh and until_refresh:
+                now += 1
+                break
+        else:
+            refresh = False
+        now += 1
+
+    #@finish
+    self.a, self.b, self.ir, self.ir2, self.out = a, b, ir, ir2, out
+    self.bus, self.mbus, self.mar, self.pc, self.sp = bus, mbus, mar, pc, sp
+    self.step, self.scp = step, scp
+    self.flags = flags >> 11
+    self.refresh = refresh
+    self.count = now
+    return now - first
+"""
+
+def run_function(name: str, namespace: dict | None = None, **hooks: str):
+    """The run method of RUN_SOURCE with the hooks' statements (any indentation) spliced in,
+    compiled with this module's globals and namespace (the names the hooks use)"""
+    lines = []
+    for line in RUN_SOURCE.splitlines():
+        if line.lstrip().startswith("#@"):
+            indent = line[:len(line) - len(line.lstrip())]
+            lines += [indent + l for l in dedent(hooks.pop(line.strip()[2:], "")).strip("\n").splitlines()]
+        else:
+            lines.append(line)
+    assert not hooks, f"Unknown hooks {list(hooks)}"
+    namespace = {**globals(), **(namespace or {})}
+    exec(compile("\n".join(lines) + "\n", f"<sbb {name}.run>", "exec"), namespace)
+    return namespace["run"]
+
+class FastCPU:
+    """Integer-backed engine running the same microcode as cpu.run()"""
+    def __init__(self, rom: list[int], tables: AluTables = TABLES):
+        self.rom = rom
+        self.tables = tables
+        self.mem = bytearray(RAM_SIZE)
+        self.stack = [0] * 256
+        self.reset()
+    def reset(self):
+        self.a = self.b = self.ir = self.ir2 = self.out = 0
+        self.bus = self.mbus = self.mar = self.pc = self.sp = 0
+        self.step = 0 #control unit microstep counter
+        self.flags = 0 #carry | zero << 1 | sign << 2
+        self.scp = 0
+        self.refresh = False #RF was raised during the last tick
+        self.halted = False
+        self.count = 0
+    @property
+    def cf(self): return self.flags & 1
+    @property
+    def zf(self): return (self.flags >> 1) & 1
+    @property
+    def sf(self): return (self.flags >> 2) & 1
+    def load(self, mem):
+        #mem is a gate-level Ram or a RAM image (bytes or any buffer)
+        if hasattr(mem, "data"):
+            mem = mem.data
+        mem = mem[:RAM_SIZE] #addresses are 12 bits, the rest of a longer image is never reached
+        self.mem[:len(mem)] = mem
+    def __str__(self):
+        return (f" > BUS: {Byte(self.bus)}\n"
+                f" > REGA: {Byte(self.a)}\n"
+                f" > REGB: {Byte(self.b)}\n"
+                f" > I1: {Byte(self.ir)}\n"
+                f" > I2: {Byte(self.ir2)}\n"
+                f"{self.stack_str()}")
+    def stack_str(self):
+        msg = f"[   sp = {str(self.sp).rjust(3, '0')}   ]\n"
+        for i in range(1, self.sp+1):
+            msg += f"| {bin(self.stack[self.sp - i])[2:].rjust(12, '0')} |\n"
+        return msg
+    run = run_function("FastCPU")
+
+FETCH = (CO|MI, RO|II|CE) #first two microsteps of every instruction
+REGISTERS = ("a", "b", "ir", "ir2", "out", "bus", "mbus", "mar", "pc", "sp", "scp", "flags")
+STORE = "STORE"
+
+class FusedCPU(FastCPU):
+    """Integer engine running a whole instruction per dispatch
+
+    Each (instruction, flags) microcode sequence of the ROM is compiled into one
+    Python function the first time it is executed. Instructions whose sequence
+    can't be known in advance run tick by tick like FastCPU."""
+    def __init__(self, rom: list[int], tables: AluTables = TABLES):
+        super().__init__(rom, tables)
+        #the next instruction is only known in advance if every sequence starts with the common fetch
+        self.fusable = all(rom[i] == FETCH[i & 7] for i in range(len(rom)) if i & 7 < 2)
+        self.units = [None] * (256 << 3) #(ir << 3) | flags -> (function, ticks, halts, refresh)
+        self.until_refresh = False #read by the compiled units, see run()
+    def microcode(self, ir: int, flags: int | None) -> tuple[list[int], bool] | None:
+        """Outputs: control words executed from the fetch (the reset step included as 0), halts
+
+        flags is None when they aren't known yet. Returns None if the sequence
+        depends on values only known while running."""
+        base = rom_base(ir)
+        words = []
+        step = 0
+        while True:
+            row = {self.rom[step | base | f << 11] for f in (range(8) if flags is None else (flags,))}
+            if len(row) != 1:
+                return None
+            w = row.pop()
+            if w & HT:
+                return words, True
+            words.append(w)
+            if not w:
+                return words, False
+            if w & II and step != 1:
+                return None
+            if w & ALU_MASK:
+                flags = None #the ALU sets the flags while running
+            step = (step + 1) & 7
+            if step == 0: #8 microsteps, the counter wraps without a reset
+                return words, False
+    def tick_lines(self, w: int, ir: int, tables: dict) -> list[str]:
+        #Python statements for one microstep, in the same order as FastCPU.run
+        lines = []
+        if w & ALU_MASK:
+            optype = (w >> 10) & 15
+            if optype < 13:
+                tables[f"t{optype}"] = self.tables[optype]
+                lines.append(f"entry = t{optype}[(a << 8) | b]")
+                lines.append("bus = entry & 255")
+                if self.tables[optype][0] & CW_BIT:
+                    lines.append("flags = (entry >> 8) & 7")
+                else:
+                    lines.append("flags = (flags & 1) | ((entry >> 8) & 6)")
+            else:
+                lines.append("flags = (flags & 1) | (bus == 0) << 1 | (bus >> 7) << 2")
+
+        if w & CO: lines.append("mbus = pc")
+        if w & AO: lines.append("bus = a")
+        if w & BO: lines.append("bus = b")
+        if w & IO:
+            lines.append("bus = ir2")
+            lines.append(f"mbus = {(ir & 15) << 8} | ir2")
+
+        if w & RI: lines.append("mem[mar] = bus")
+        if w & RO: lines.append("bus = mem[mar]")
+        if w & MI: lines.append("mar = mbus")
+
+        if w & SO:
+            lines.append("sp = (sp - 1) & 255")
+            lines.append("mbus = stack[sp]" if w & SA else "bus = stack[sp] & 255")
+        elif w & SI:
+            lines.append("stack[sp] = mbus" if w & SA else "stack[sp] = (stack[sp] & 0xf00) | bus")
+            lines.append("sp = (sp + 1) & 255")
+
+        if w & AI: lines.append("a = bus")
+        if w & BI: lines.append("b = bus")
+        if w & II: lines.append("ir = bus")
+        if w & XI: lines.append("ir2 = bus")
+        if w & OI: lines.append("out = bus")
+        if w & CE: lines.append(f"pc = (pc + 1) & {RAM_SIZE - 1}")
+        if w & JP: lines.append("pc = mbus")
+        if w & PI: lines.append("scp = bus")
+        return lines
+    def function(self, name: str, args: str, lines: list[str], tables: dict, result = None):
+        #wraps statements in a function loading and storing the registers they use,
+        #a STORE line is replaced by the register stores (for early returns)
+        names = set(re.findall(r"\b[a-z_][a-z0-9_]*\b", "\n".join(lines)))
+        used = [r for r in REGISTERS if r in names]
+        written = [r for r in used if any(line.strip().startswith(r + " = ") for line in lines)]
+        source = f"def {name}({args}{''.join(f', {t}={t}' for t in tables)}):\n"
+        source += "".join(f"    {r} = c.{r}\n" for r in used)
+        for line in lines:
+            if line.strip() == STORE:
+                indent = line[:len(line) - len(line.lstrip())]
+                source += "".join(f"    {indent}c.{r} = {r}\n" for r in written)
+            else:
+                source += f"    {line}\n"
+        source += "".join(f"    c.{r} = {r}\n" for r in written)
+        if result is not None:
+            source += f"    return {result}\n"
+        namespace = dict(tables)
+        exec(compile(source, f"<sbb {name}>", "exec"), namespace)
+        return namespace[name]
+    def compile(self, key: int) -> tuple:
+        ir, flags = key >> 3, key & 7
+        code = self.microcode(ir, flags)
+        if code is None:
+            return (None, 0, False, False)
+        words, halts = code
+        if halts and words and words[-1] & RF:
+            return (None, 0, False, False) #a refresh right before the halt, run(until_refresh) stops between them
+        lines = []
+        tables = {}
+        for i, w in enumerate(words):
+            lines += self.tick_lines(w, ir, tables)
+            if w & RF and i < len(words) - 1:
+                #leave after the refresh tick for run(until_refresh)
+                lines += ["if c.until_refresh:",
+                          f"    c.step = {i + 1}",
+                          "    c.refresh = True",
+                          f"    {STORE}",
+                          f"    return {i + 1}"]
+        if halts:
+            lines.append(f"c.step = {(len(words) + 1) & 7}")
+        refresh = not halts and bool(words[-1] & RF)
+        return (self.function(f"unit_{ir:02x}_{flags}", "c, mem, stack", lines, tables, len(words)),
+                len(words), halts, refresh)
+    def finish(self, max_ticks = -1, until_refresh = False) -> int:
+        #runs tick by tick until the end of the current instruction (or a refresh tick with until_refresh)
+        ticks = 0
+        while ticks != max_ticks:
+            if FastCPU.run(self, 1) == 0:
+                break
+            ticks += 1
+            if self.step == 0 or (until_refresh and self.refresh):
+                break
+        return ticks
+    def run(self, max_ticks = -1, until_refresh = False) -> int:
+        if not self.fusable:
+            return FastCPU.run(self, max_ticks, until_refresh)
+        ticks = 0
+        self.halted = False
+        self.until_refresh = until_refresh
+        if self.step:
+            ticks = self.finish(max_ticks, until_refresh)
+            if until_refresh and self.refresh:
+                return ticks
+        units = self.units
+        mem = self.mem
+        stack = self.stack
+        fused = 0
+        refresh = self.refresh
+        while ticks + fused != max_ticks and not self.halted:
+            key = (mem[self.pc] << 3) | self.flags
+            unit = units[key]
+            if unit is None:
+                unit = units[key] = self.compile(key)
+            function, length, halts, refresh = unit
+            #a halting instruction only halts once the tick after its last one is reached
+            if function is None or (max_ticks >= 0 and ticks + fused + length + halts > max_ticks):
+                #unknown sequence or not enough ticks left for the whole instruction
+                self.count += fused
+                ticks += fused
+                fused = 0
+                ticks += self.finish(max_ticks - ticks if max_ticks >= 0 else -1, until_refresh)
+                refresh = self.refresh
+                if until_refresh and refresh:
+                    break
+                continue
+            done = function(self, mem, stack)
+            fused += done
+            if done != length:
+                #left after a refresh tick (until_refresh)
+                refresh = True
+                break
+            if halts:
+                self.halted = True
+            elif refresh and until_refresh:
+                break
+        self.count += fused
+        self.refresh = refresh
+        return ticks + fused
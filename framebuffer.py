@@ -0,0 +1,133 @@
+#Screen without a window: every refresh decodes the character window into a framebuffer, and the
+#frames that differ from the previous one are streamed to a capture file
+#   python framebuffer.py program.sbbcap [--fps 30] [--last]      plays a capture back in the terminal
+import argparse
+import struct
+import sys
+from pathlib import Path
+from time import sleep
+from cpu import Screen
+
+#Capture file (.sbbcap, little-endian): header then one record per frame
+#   header: magic, version, columns, rows
+#   frame: tick, number of cells that changed, then (cell, character) byte pairs
+CAPTURE_MAGIC = b"SBBCAP"
+CAPTURE_VERSION = 1
+HEADER = struct.Struct("<6sBBB")
+FRAME = struct.Struct("<QH")
+CELLS = Screen.SCREEN_DIM[0] * Screen.SCREEN_DIM[1]
+DECODE = bytes(char % 128 for char in range(256)) #characters as drawn by the window
+TEXT = bytes(char if 32 <= char < 127 else 32 for char in range(256))
+
+class CaptureError(Exception):
+    pass
+
+def text(frame: bytes) -> str:
+    """One line per screen row, unprintable characters as spaces"""
+    columns = Screen.SCREEN_DIM[0]
+    frame = frame.translate(TEXT).decode("ascii")
+    return "\n".join(frame[i:i + columns] for i in range(0, len(frame), columns))
+
+class FrameScreen(Screen):
+    """Screen decoding into a framebuffer instead of a window, for headless runs and tests
+
+    frame holds one character per cell, row by row, as the window would show
+    it (scp is the cell of the first screen memory byte)."""
+    def __init__(self, bus, mem_access = None, scale = 10):
+        super().__init__(bus, mem_access, scale)
+        self.frame = bytes(CELLS)
+        self.frames = 0 #frames that differed from the previous one
+        self.ticks = 0 #refresh calls, once per tick while the screen is on
+        self.capture = None
+    def on(self, capture = None):
+        assert self.ram is not None, "Screen disconnected from RAM"
+        self.power = True
+        if capture is not None:
+            self.capture = open(capture, "wb")
+            self.capture.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, *Screen.SCREEN_DIM))
+    def off(self):
+        self.power = False
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+    def refresh(self, render=False):
+        if self.PI():
+            self.scp.copy(self.bus)
+        self.ticks += 1
+        if render:
+            self.grid()
+    def grid(self):
+        self.draw(self.ram.screen(), self.scp.uint())
+    def draw(self, window, scp: int, ticks: int | None = None):
+        """Decodes a screen memory window (Ram.SCREEN_START to SCREEN_END) shown from cell scp, what refresh
+        does on a refresh tick, for the integer engines (ticks: ticks run so far, the frame's capture time)"""
+        if ticks is not None:
+            self.ticks = ticks
+        start = CELLS - scp
+        frame = (bytes(window[start:]) + bytes(window[:start])).translate(DECODE)
+        if frame == self.frame:
+            return
+        if self.capture is not None:
+            last = self.frame
+            changed = bytearray()
+            for cell in range(CELLS):
+                if frame[cell] != last[cell]:
+                    changed += bytes((cell, frame[cell]))
+            self.capture.write(FRAME.pack(self.ticks, len(changed) >> 1) + changed)
+        self.frame = frame
+        self.frames += 1
+    def text(self) -> str:
+        return text(self.frame)
+    def array(self):
+        """Frame as a rows x columns NumPy array"""
+        import numpy as np
+        return np.frombuffer(self.frame, dtype=np.uint8).reshape(Screen.SCREEN_DIM[1], Screen.SCREEN_DIM[0])
+
+def frames(path) -> list[tuple[int, bytes]]:
+    """(tick, frame) of every frame of a capture file"""
+    data = Path(path).read_bytes()
+    if len(data) < HEADER.size:
+        raise CaptureError("Not a capture file")
+    magic, version, columns, rows = HEADER.unpack_from(data)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise CaptureError(f"Not a version {CAPTURE_VERSION} capture file")
+    frame = bytearray(columns * rows)
+    result = []
+    offset = HEADER.size
+    while offset < len(data):
+        if offset + FRAME.size > len(data):
+            raise CaptureError("Truncated capture file")
+        tick, count = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+        changed = data[offset:offset + 2 * count]
+        if len(changed) != 2 * count:
+            raise CaptureError("Truncated capture file")
+        offset += 2 * count
+        for i in range(0, len(changed), 2):
+            frame[changed[i]] = changed[i + 1]
+        result.append((tick, bytes(frame)))
+    return result
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Play a screen capture back in the terminal")
+    parser.add_argument("capture", help=".sbbcap file")
+    parser.add_argument("--fps", type=float, default=30.0, help="frames per second (0: no delay)")
+    parser.add_argument("--last", action="store_true", help="only print the last frame")
+    args = parser.parse_args(argv)
+    try:
+        captured = frames(args.capture)
+    except (OSError, CaptureError) as error:
+        print(f"[Error] {error}", file=sys.stderr)
+        return 1
+    if args.last:
+        captured = captured[-1:]
+    for i, (tick, frame) in enumerate(captured):
+        if i and args.fps > 0:
+            sleep(1 / args.fps)
+            print(f"\x1b[{Screen.SCREEN_DIM[1] + 1}A", end="") #back over the previous frame
+        print(f"tick {tick}, frame {i + 1}/{len(captured)}")
+        print(text(frame), flush=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#Where an SBBasm program spends its cycles: integer engine (-g) counting microsteps per address and per
+#opcode, RAM reads and writes per address, and the call stack rebuilt from jsr/ret stack traffic
+#   profiler = GuestProfiler(rom); profiler.source(lex(lines), image.line_ptr, OPS); profiler.load(image.mem)
+#   profiler.run(); print(profiler.report())
+#   profiler.save("run.folded")    flamegraph.pl/speedscope folded stacks, any other suffix: JSON report
+import json
+from array import array
+from pathlib import Path
+from cpu import RAM_SIZE
+from fastcpu import FastCPU, AluTables, TABLES, run_function
+
+SHADES = " .:-=+*#%@" #heatmap characters, from no access to the most accessed address
+
+class GuestProfiler(FastCPU):
+    """Integer engine keeping cycle counts of the program it runs
+
+    Cycles of an instruction go to its address and opcode when it ends. A stack
+    address push (jsr) starts a frame at the next instruction, a stack address
+    pop (ret, ret#) ends it, and every tick is charged to the call stack it ran
+    in, so functions get inclusive and exclusive cycles. source() maps addresses
+    back to function labels and source lines."""
+    def __init__(self, rom: list[int], tables: AluTables = TABLES):
+        self.labels: dict[int, str] = {} #function address -> label
+        self.lines: dict[int, int] = {} #instruction address -> source line index
+        self.texts: dict[int, str] = {} #source line index -> line
+        self.mnemonics: dict[int, str] = {}
+        super().__init__(rom, tables)
+    def reset(self):
+        super().reset()
+        self.clear()
+    def clear(self):
+        """Forgets every count, the stack starts over from the current address"""
+        self.cycles = array('Q', bytes(8 * RAM_SIZE)) #microsteps per instruction address
+        self.executed = array('Q', bytes(8 * RAM_SIZE)) #instructions per address
+        self.op_cycles = array('Q', bytes(8 * 256))
+        self.op_executed = array('Q', bytes(8 * 256))
+        self.reads = array('Q', bytes(8 * RAM_SIZE)) #RAM reads per address, instruction fetches included
+        self.writes = array('Q', bytes(8 * RAM_SIZE))
+        self.stacks: dict[tuple, int] = {} #call stack (function addresses, outermost first) -> cycles
+        self.calls: dict[tuple, int] = {} #(caller, callee) -> calls
+        self.path = (self.pc,)
+        self.call = False #address pushed, the next instruction starts a frame
+        self.addr = self.pc #address of the running instruction
+        self.begun = self.started = self.since = self.count
+    def source(self, lexed: list[tuple], line_ptr: list[int], ops: dict[str, int]):
+        """Function labels and source lines from asm.lex(lines), Image.line_ptr and asm.OPS"""
+        code = False
+        for l, line, args, ref, valid, words in lexed:
+            self.texts[l] = line.strip()
+            if words[0].endswith(':'):
+                self.labels[0 if words[0] == "start:" else line_ptr[l]] = words[0][:-1]
+                code = True
+            elif code:
+                self.lines.setdefault(line_ptr[l], l)
+        for name, op in ops.items():
+            self.mnemonics.setdefault(op, name)
+    def name(self, addr: int) -> str:
+        return self.labels.get(addr, f"${addr:03x}")
+    def mnemonic(self, ir: int) -> str:
+        return self.mnemonics.get(ir if ir >= 0xe0 else ir & 0xf0, f"${ir:02x}")
+    #the FastCPU.run loop with the counters: an instruction is accounted for when the next one starts
+    run = run_function("GuestProfiler", globals(),
+        setup="""
+            cycles, executed, op_cycles, op_executed = self.cycles, self.executed, self.op_cycles, self.op_executed
+            reads, writes, stacks, calls = self.reads, self.writes, self.stacks, self.calls
+            path, call, addr, begun, started, since = self.path, self.call, self.addr, self.begun, self.started, self.since""",
+        top="""
+            if not step:
+                #an instruction starts, the one before ends
+                if now != started:
+                    cycles[addr] += now - begun
+                    executed[addr] += 1
+                    op_cycles[ir] += now - started
+                    op_executed[ir] += 1
+                    begun = started = now
+                addr = pc
+                if call:
+                    stacks[path] = stacks.get(path, 0) + now - since
+                    since = now
+                    calls[path[-1], pc] = calls.get((path[-1], pc), 0) + 1
+                    path += (pc,)
+                    call = False""",
+        ram_write="writes[mar] += 1",
+        ram_read="reads[mar] += 1",
+        ret="""
+            if len(path) > 1: #return, a return without a call stays in the outermost frame
+                stacks[path] = stacks.get(path, 0) + now + 1 - since
+                since = now + 1
+                path = path[:-1]""",
+        call="call = True",
+        finish="""
+            #cycles per address and stack are up to date whenever run() returns, the instruction
+            #running (or halted) is only added to the instruction and opcode counts once it ends
+            cycles[addr] += now - begun
+            stacks[path] = stacks.get(path, 0) + now - since
+            self.path, self.call, self.addr, self.begun, self.started, self.since = path, call, addr, now, started, now""")
+    def functions(self) -> list[tuple[str, int, int, int, int]]:
+        """(name, address, calls, inclusive cycles, exclusive cycles) of each function run, most inclusive first"""
+        inclusive, exclusive, called = {}, {}, {}
+        for path, n in self.stacks.items():
+            exclusive[path[-1]] = exclusive.get(path[-1], 0) + n
+            for addr in set(path): #recursion counts once
+                inclusive[addr] = inclusive.get(addr, 0) + n
+        for (caller, callee), n in self.calls.items():
+            called[callee] = called.get(callee, 0) + n
+        rows = [(self.name(addr), addr, called.get(addr, 0), n, exclusive.get(addr, 0)) for addr, n in inclusive.items()]
+        return sorted(rows, key=lambda row: (-row[3], row[1]))
+    def hot_lines(self, count: int = 10) -> list[tuple[int, int, int, str]]:
+        """(address, instructions, cycles, source line) of the count addresses with the most cycles"""
+        addrs = sorted((addr for addr in range(RAM_SIZE) if self.cycles[addr]), key=lambda addr: -self.cycles[addr])
+        rows = []
+        for addr in addrs[:count]:
+            l = self.lines.get(addr)
+            executed = self.executed[addr] + (addr == self.addr and self.count > self.started) #running instruction
+            rows.append((addr, executed, self.cycles[addr], "" if l is None else f"[line {l+1}] {self.texts[l]}"))
+        return rows
+    def opcodes(self) -> list[tuple[str, int, int]]:
+        """(mnemonic, instructions, cycles) of each opcode run, most cycles first"""
+        op_executed, op_cycles = self.op_executed[:], self.op_cycles[:]
+        if self.count > self.started: #running instruction
+            op_executed[self.ir] += 1
+            op_cycles[self.ir] += self.count - self.started
+        totals = {}
+        for ir in range(256):
+            if op_executed[ir]:
+                name = self.mnemonic(ir)
+                executed, cycles = totals.get(name, (0, 0))
+                totals[name] = (executed + op_executed[ir], cycles + op_cycles[ir])
+        return sorted(((name, *counts) for name, counts in totals.items()), key=lambda row: -row[2])
+    def folded(self) -> str:
+        """Call stacks in the folded format of flamegraph.pl: "start;outer;inner 42" per line"""
+        return "".join(f"{';'.join(self.name(addr) for addr in path)} {n}\n"
+                       for path, n in sorted(self.stacks.items()) if n)
+    def heatmap(self, counts: array, width: int = 64) -> str:
+        """One character per address (SHADES, log scale), rows of width addresses, unused rows left out"""
+        top = max(counts).bit_length() or 1
+        lines = []
+        for start in range(0, RAM_SIZE, width):
+            row = counts[start:start + width]
+            if any(row):
+                shades = "".join(SHADES[(n.bit_length() * (len(SHADES) - 1) + top - 1) // top] for n in row)
+                lines.append(f"${start:03x} |{shades}|")
+        return "\n".join(lines)
+    def report(self, count: int = 10) -> str:
+        total = sum(self.stacks.values()) or 1
+        lines = [f"Guest profile: {total} ticks, {sum(row[1] for row in self.opcodes())} instructions",
+                 f"{'function':<16}{'calls':>8}{'inclusive':>11}{'exclusive':>11}{'share':>8}"]
+        for name, addr, called, inclusive, exclusive in self.functions()[:count]:
+            lines.append(f"{name:<16}{called:>8}{inclusive:>11}{exclusive:>11}{inclusive / total:>8.1%}")
+        lines.append(f"\n{'address':<9}{'runs':>8}{'cycles':>10}  source")
+        for addr, executed, cycles, text in self.hot_lines(count):
+            lines.append(f"${addr:03x}{'':<5}{executed:>8}{cycles:>10}  {text}")
+        lines.append(f"\n{'opcode':<9}{'runs':>8}{'cycles':>10}{'share':>8}")
+        for name, executed, cycles in self.opcodes()[:count]:
+            lines.append(f"{name:<9}{executed:>8}{cycles:>10}{cycles / total:>8.1%}")
+        for kind, counts in (("reads", self.reads), ("writes", self.writes)):
+            if any(counts):
+                lines.append(f"\nRAM {kind} ({SHADES[1]} few to {SHADES[-1]} most)\n{self.heatmap(counts)}")
+        return "\n".join(lines)
+    def save(self, path):
+        path = Path(path)
+        if path.suffix == ".folded":
+            path.write_text(self.folded())
+            return
+        path.write_text(json.dumps({
+            "ticks": self.count,
+            "functions": [dict(zip(("name", "address", "calls", "inclusive", "exclusive"), row)) for row in self.functions()],
+            "calls": [{"caller": self.name(caller), "callee": self.name(callee), "calls": n}
+                      for (caller, callee), n in self.calls.items()],
+            "lines": [dict(zip(("address", "runs", "cycles", "source"), row)) for row in self.hot_lines(RAM_SIZE)],
+            "opcodes": [dict(zip(("mnemonic", "runs", "cycles"), row)) for row in self.opcodes()],
+            "reads": list(self.reads), "writes": list(self.writes)}))
@@ -0,0 +1,155 @@
+#Where the host time goes in the gate-level tick (Machine.step): every Nth tick is run component by
+#component with a timer around each one, the other ticks run untouched
+#   profiler = HostProfiler(machine, every=64); profiler.attach(); machine.run(); profiler.detach()
+#   profiler.table()                    summary, slowest first
+#   profiler.save("run.speedscope.json")   speedscope file (https://www.speedscope.app), any other suffix: pstats
+import json
+import marshal
+from pathlib import Path
+from time import perf_counter_ns
+from cpu import Machine
+
+#ALU operation of each optype (see Alu.__call__), 0 and 13-15 leave the bus as is
+OPTYPES = ("none", "add", "sub", "inc", "dec", "and", "or", "not", "rsh", "lsh", "multl", "multh", "xor",
+           "unused 13", "unused 14", "unused 15")
+STEP = "Machine.step"
+
+class HostProfiler:
+    """Sampling profiler of the components of one Machine
+
+    attach() shadows machine.step, so Machine.run and every clock loop using
+    machine.step go through it. Times are those of the sampled ticks only,
+    multiply by every for an estimate of the whole run."""
+    EVERY = 64
+
+    def __init__(self, machine: Machine, every: int = EVERY):
+        assert every >= 1, "Sampling period must be at least 1 tick"
+        self.machine = machine
+        self.every = every
+        self.countdown = every
+        self.ticks = 0 #ticks seen, sampled or not
+        self.sampled = 0
+        self.step_ns = 0 #whole sampled ticks, profiling included
+        self.stats: dict[str, list[int]] = {} #component -> [calls, ns], in step order
+        self.optypes = [[0, 0] for optype in OPTYPES] #ALU calls and ns per optype
+        m = machine
+        #components in Machine.step order, after the control unit and the halt check
+        self.reads = [("alu", m.alu), ("pc.read", m.pc.read), ("rega.read", m.rega.read), ("regb.read", m.regb.read),
+                      ("ir2.read", m.ir2.read), ("cu.read", m.cu.read), ("ram", m.ram), ("st", m.st)]
+        self.writes = [("rega.write", m.rega.write), ("regb.write", m.regb.write), ("ir.write", m.ir.write),
+                       ("ir2.write", m.ir2.write), ("out.write", m.out.write), ("pc.write", m.pc.write)]
+        self.functions = {"cu": m.cu, "screen": m.screen.refresh, **dict(self.reads + self.writes)}
+    def attach(self):
+        self.step_unprofiled = Machine.step.__get__(self.machine)
+        self.machine.step = self.step
+    def detach(self):
+        self.machine.__dict__.pop("step", None)
+    def step(self, display = True, ends = True, debug = False, screen = False) -> bool:
+        self.ticks += 1
+        self.countdown -= 1
+        if self.countdown:
+            return self.step_unprofiled(display, ends, debug, screen)
+        self.countdown = self.every
+        return self.sample(display, ends, debug, screen)
+    def add(self, name: str, ns: int):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = [0, 0]
+        entry[0] += 1
+        entry[1] += ns
+    def sample(self, display, ends, debug, screen) -> bool:
+        #Machine.step with a timer around each component
+        m = self.machine
+        clock = perf_counter_ns
+        first = clock()
+        m.cu()
+        self.add("cu", clock() - first)
+        if m.hlt() or not m.screen.power:
+            m.halted = True
+            return False
+        optype = m.alu.optype()
+        for name, component in self.reads:
+            start = clock()
+            component()
+            ns = clock() - start
+            self.add(name, ns)
+            if component is m.alu:
+                self.optypes[optype][0] += 1
+                self.optypes[optype][1] += ns
+        for name, component in self.writes:
+            start = clock()
+            component()
+            self.add(name, clock() - start)
+        if screen:
+            start = clock()
+            m.screen.refresh(m.rfh())
+            self.add("screen", clock() - start)
+        self.sampled += 1
+        self.step_ns += clock() - first
+        if display or debug:
+            m.show(display, debug and ends)
+        m.count += 1
+        return True
+    def rows(self) -> list[tuple[str, int, int]]:
+        """(name, calls, ns) of each component then each ALU optype used, slowest first"""
+        rows = sorted(((name, calls, ns) for name, (calls, ns) in self.stats.items()), key=lambda row: -row[2])
+        optypes = [(f"alu {OPTYPES[i]}", calls, ns) for i, (calls, ns) in enumerate(self.optypes) if calls]
+        return rows + sorted(optypes, key=lambda row: -row[2])
+    def table(self) -> str:
+        total = self.step_ns or 1
+        lines = [f"Host profile: {self.sampled} of {self.ticks} ticks sampled (every {self.every}), "
+                 f"{self.step_ns / max(self.sampled, 1) / 1000:.1f}us per sampled tick",
+                 f"{'component':<14}{'calls':>10}{'total ms':>12}{'us/call':>10}{'share':>8}"]
+        for name, calls, ns in self.rows():
+            lines.append(f"{name:<14}{calls:>10}{ns / 1e6:>12.2f}{ns / calls / 1000:>10.2f}{ns / total:>8.1%}")
+        other = self.step_ns - sum(ns for calls, ns in self.stats.values())
+        lines.append(f"{'(step, timers)':<14}{self.sampled:>10}{other / 1e6:>12.2f}{'':>10}{other / total:>8.1%}")
+        return "\n".join(lines)
+    def speedscope(self) -> dict:
+        """Profile in speedscope's file format, one weighted sample per component (and per ALU optype)"""
+        frames = [STEP]
+        samples, weights = [], []
+        def sample(stack: list[str], ns: int):
+            for name in stack:
+                if name not in frames:
+                    frames.append(name)
+            samples.append([frames.index(name) for name in stack])
+            weights.append(ns)
+        alu = 0
+        for i, (calls, ns) in enumerate(self.optypes):
+            if calls:
+                sample([STEP, "alu", f"alu {OPTYPES[i]}"], ns)
+                alu += ns
+        for name, (calls, ns) in self.stats.items():
+            sample([STEP, name], ns - alu if name == "alu" else ns)
+        sample([STEP], self.step_ns - sum(ns for calls, ns in self.stats.values()))
+        return {"$schema": "https://www.speedscope.app/file-format-schema.json",
+                "name": "SBB host profile", "exporter": "host_profiler.py",
+                "shared": {"frames": [{"name": name} for name in frames]},
+                "profiles": [{"type": "sampled", "name": f"{STEP}, every {self.every} ticks", "unit": "nanoseconds",
+                              "startValue": 0, "endValue": self.step_ns, "samples": samples, "weights": weights}]}
+    def pstats(self) -> dict:
+        """Profile in the marshal format of pstats.Stats, Machine.step calling each component"""
+        def key(name: str, function) -> tuple:
+            function = getattr(function, "__func__", function) #bound method
+            code = getattr(function, "__code__", None) or getattr(type(function).__call__, "__code__", None)
+            return (code.co_filename, code.co_firstlineno, name) if code else ("~", 0, name)
+        step = key(STEP, Machine.step)
+        spent = sum(ns for calls, ns in self.stats.values())
+        stats = {step: (self.sampled, self.sampled, (self.step_ns - spent) / 1e9, self.step_ns / 1e9, {})}
+        alu = key("alu", self.machine.alu)
+        for name, (calls, ns) in self.stats.items():
+            own = ns - sum(optype[1] for optype in self.optypes) if name == "alu" else ns
+            stats[key(name, self.functions[name])] = (calls, calls, own / 1e9, ns / 1e9,
+                                                      {step: (calls, calls, own / 1e9, ns / 1e9)})
+        for i, (calls, ns) in enumerate(self.optypes):
+            if calls:
+                stats[("~", 0, f"alu {OPTYPES[i]}")] = (calls, calls, ns / 1e9, ns / 1e9,
+                                                        {alu: (calls, calls, ns / 1e9, ns / 1e9)})
+        return stats
+    def save(self, path):
+        path = Path(path)
+        if path.suffix == ".json":
+            path.write_text(json.dumps(self.speedscope()))
+        else:
+            path.write_bytes(marshal.dumps(self.pstats()))
@@ -0,0 +1,129 @@
+import numpy as np
+from cpu import RAM_SIZE
+from alu_tables import TABLES, AluTables, ALU_OPS, CW_BIT
+from fastcpu import MI, RI, RO, II, IO, CO, JP, CE, AI, AO, HT, BI, BO, OI, XI, SI, SO, SA, PI
+
+class LockstepCPU:
+    """N copies of the integer engine advanced together, one microstep per NumPy operation
+
+    Every machine runs the same microcode on its own registers, RAM and stack
+    (rows of the arrays below), typically one program started on many data
+    sets. Machines that halt are masked out while the others keep running."""
+    def __init__(self, rom: list[int], n: int, tables: AluTables = TABLES):
+        self.n = n
+        self.rom = np.asarray(rom, dtype=np.int32)
+        #optype -> (A << 8) | B -> entry, as in alu_tables, rows 0 and 13-15 are unused
+        self.tables = np.zeros((16, 1 << 16), dtype=np.int32)
+        for optype in ALU_OPS:
+            self.tables[optype] = tables[optype]
+        self.mem = np.zeros((n, RAM_SIZE), dtype=np.uint8)
+        self.stack = np.zeros((n, 256), dtype=np.int32)
+        self.rows = np.arange(n)
+        self.reset()
+    def reset(self):
+        n = self.n
+        self.a, self.b, self.ir, self.ir2, self.out = (np.zeros(n, dtype=np.int32) for i in range(5))
+        self.bus, self.mbus, self.mar, self.pc, self.sp = (np.zeros(n, dtype=np.int32) for i in range(5))
+        self.step = np.zeros(n, dtype=np.int32)
+        self.flags = np.zeros(n, dtype=np.int32) #carry | zero << 1 | sign << 2
+        self.scp = np.zeros(n, dtype=np.int32)
+        self.halted = np.zeros(n, dtype=bool)
+        self.count = np.zeros(n, dtype=np.int64) #ticks run by each machine
+    def load(self, mem, rows = None):
+        #mem is one RAM image (a gate-level Ram or bytes) copied to every machine, or to rows only
+        #(an index, index array, slice or boolean mask)
+        if hasattr(mem, "data"):
+            mem = mem.data
+        rows = slice(None) if rows is None else rows
+        self.mem[rows, :len(mem)] = np.frombuffer(bytes(mem), dtype=np.uint8)
+        self.stack[rows] = 0
+        self.halted[rows] = False
+    def write(self, addr: int, values, size: int = 1, rows = None):
+        """Stores one little-endian value of size bytes at addr per machine, values[k] for machine k (or for
+        rows[k]), e.g. write(0x500, operands) to start one program on many data sets"""
+        rows = self.rows if rows is None else rows
+        values = np.asarray(values, dtype=np.int64)
+        assert values.shape == self.rows[rows].shape, "One value per machine written"
+        for i in range(size):
+            self.mem[rows, addr + i] = (values >> (8 * i)) & 255
+    def read(self, addr: int, size: int = 1) -> np.ndarray:
+        """Little-endian value of size bytes at addr for every machine (ex.: read(0x500, 4) after a mult)"""
+        value = np.zeros(self.n, dtype=np.int64)
+        for i in reversed(range(size)):
+            value = (value << 8) | self.mem[:, addr + i]
+        return value
+    def tick(self) -> int:
+        """One microstep of every running machine, returns how many ran"""
+        rows = self.rows
+        running = ~self.halted
+        ir, flags, step = self.ir, self.flags, self.step
+        w = np.where(running, self.rom[step | (ir >> 4) << 3 | (ir & 15) << 7 | flags << 11], 0)
+
+        reset = running & (w == 0) #end of instruction
+        halt = (w & HT) != 0
+        self.halted |= halt
+        live = running & ~reset & ~halt
+        w = np.where(live, w, 0) #from here on signals are only raised for the live machines
+        self.step = np.where(reset, 0, np.where(running, (step + 1) & 7, step))
+        self.count += running & ~halt
+
+        optype = (w >> 10) & 15
+        bus = self.bus
+        if optype.any():
+            alu = optype != 0
+            entry = self.tables[optype, (self.a << 8) | self.b]
+            bus = np.where(alu & (optype < 13), entry & 255, bus) #unused optypes leave the bus as is
+            carry = np.where((entry & CW_BIT) != 0, (entry >> 8) & 1, flags & 1)
+            self.flags = np.where(alu, carry | (bus == 0) << 1 | (bus >> 7) << 2, flags)
+
+        mbus = self.mbus
+        if w.any():
+            mbus = np.where(w & CO, self.pc, mbus)
+            bus = np.where(w & AO, self.a, bus)
+            bus = np.where(w & BO, self.b, bus)
+            io = (w & IO) != 0
+            bus = np.where(io, self.ir2, bus)
+            mbus = np.where(io, (ir & 15) << 8 | self.ir2, mbus)
+
+            mar = self.mar
+            ri = np.flatnonzero(w & RI)
+            if len(ri):
+                self.mem[ri, mar[ri]] = bus[ri]
+            bus = np.where(w & RO, self.mem[rows, mar], bus)
+            self.mar = np.where(w & MI, mbus, mar)
+
+            so = (w & SO) != 0
+            si = ((w & SI) != 0) & ~so
+            sa = (w & SA) != 0
+            sp = np.where(so, (self.sp - 1) & 255, self.sp)
+            if so.any():
+                entry = self.stack[rows, sp]
+                mbus = np.where(so & sa, entry, mbus)
+                bus = np.where(so & ~sa, entry & 255, bus)
+            if si.any():
+                push = np.flatnonzero(si)
+                old = self.stack[push, sp[push]]
+                self.stack[push, sp[push]] = np.where(sa[push], mbus[push], (old & 0xf00) | bus[push])
+                sp = np.where(si, (sp + 1) & 255, sp)
+            self.sp = sp
+
+            self.a = np.where(w & AI, bus, self.a)
+            self.b = np.where(w & BI, bus, self.b)
+            self.ir = np.where(w & II, bus, ir)
+            self.ir2 = np.where(w & XI, bus, self.ir2)
+            self.out = np.where(w & OI, bus, self.out)
+            pc = np.where(w & CE, (self.pc + 1) & (RAM_SIZE - 1), self.pc)
+            self.pc = np.where(w & JP, mbus, pc)
+            self.scp = np.where(w & PI, bus, self.scp)
+        self.bus, self.mbus = bus, mbus
+        return int(running.sum())
+    def run(self, max_ticks = -1) -> np.ndarray:
+        """Runs until every machine halted or max_ticks microsteps, returns the ticks run by each machine
+
+        Machines that halted stay halted (run again to continue the others)
+        until they are loaded again or reset."""
+        start = self.count.copy()
+        ticks = 0
+        while ticks != max_ticks and self.tick():
+            ticks += 1
+        return self.count - start
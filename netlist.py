@@ -0,0 +1,335 @@
+#Gate-level parts of cpu.py compiled once: the gates of the ALU, program counter, control unit step
+#counter and decoders are built as a graph, sorted and generated as flat Python over local variables,
+#so a tick evaluates the same gates as cpu.py without building and calling gate objects
+#   netlist.attach(machine)     the machine's ALU, PC and control unit run compiled gates
+#   netlist.detach(machine)     back to the gate objects
+#Each gate belongs to a component (alu, adder, pc counter...), probes (see activity.py) count the gates
+#evaluated and the outputs that toggled per component from the generated code
+import heapq
+from functools import cache
+
+GATES = {"and": " & ", "or": " | ", "xor": " ^ "}
+LEAVES = ("input", "const")
+CONTROL_WIRES = 24
+
+class Netlist:
+    """Gate graph over bools
+
+    Nodes are inputs (a Python expression read when evaluating), constants
+    or gates (and, or, xor, not, nor) over other nodes. Outputs are assignment
+    targets, written once every gate has been evaluated. New gates belong
+    to the current component, and to the current pass when the component is
+    one circuit used several times per call (the adder in a multiply)."""
+    def __init__(self, name: str, component: str):
+        self.name = name
+        self.component = component
+        self.nodes: list[tuple[str, tuple]] = [] #(op, operands), ("input", (expression,)), ("const", (value,))
+        self.tags: list[str | None] = [] #component of each node, None for inputs
+        self.passes: list[int] = [] #pass of each node through its component, 0 outside of a reused circuit
+        self.run = 0 #pass of the new gates
+        self.outputs: dict[str, int] = {} #target -> node
+    def input(self, expression: str) -> int:
+        self.nodes.append(("input", (expression,)))
+        self.tags.append(None)
+        self.passes.append(0)
+        return len(self.nodes) - 1
+    def const(self, value: bool) -> int:
+        self.nodes.append(("const", (bool(value),)))
+        self.tags.append(None)
+        self.passes.append(0)
+        return len(self.nodes) - 1
+    def gate(self, op: str, *operands: int) -> int:
+        assert op in GATES or op in ("not", "nor"), f"Unknown gate <{op}>"
+        assert all(0 <= node < len(self.nodes) for node in operands), "Gate input not in the netlist"
+        self.nodes.append((op, operands))
+        self.tags.append(self.component)
+        self.passes.append(self.run)
+        return len(self.nodes) - 1
+    def AND(self, *operands): return self.gate("and", *operands)
+    def OR(self, *operands): return self.gate("or", *operands)
+    def XOR(self, *operands): return self.gate("xor", *operands)
+    def NOT(self, operand): return self.gate("not", operand)
+    def NOR(self, *operands): return self.gate("nor", *operands)
+    def output(self, target: str, node: int):
+        self.outputs[target] = node
+    def order(self) -> list[int]:
+        """Nodes the outputs depend on, each after its operands (Kahn's algorithm, lowest node first)"""
+        needed = set()
+        stack = list(self.outputs.values())
+        while stack:
+            node = stack.pop()
+            if node not in needed:
+                needed.add(node)
+                op, operands = self.nodes[node]
+                if op not in LEAVES:
+                    stack.extend(operands)
+        users = {node: [] for node in needed}
+        waiting = {}
+        for node in needed:
+            op, operands = self.nodes[node]
+            operands = set(operands) if op not in LEAVES else set()
+            waiting[node] = len(operands)
+            for operand in operands:
+                users[operand].append(node)
+        ready = [node for node, count in waiting.items() if count == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            node = heapq.heappop(ready)
+            order.append(node)
+            for user in users[node]:
+                waiting[user] -= 1
+                if waiting[user] == 0:
+                    heapq.heappush(ready, user)
+        assert len(order) == len(needed), f"Netlist <{self.name}> has a loop"
+        return order
+    def gates(self) -> dict[str, int]:
+        """Gates evaluated per call, by op"""
+        count = {}
+        for node in self.order():
+            op = self.nodes[node][0]
+            if op not in LEAVES:
+                count[op] = count.get(op, 0) + 1
+        return count
+    def components(self) -> dict[str, list[int]]:
+        """Gates evaluated per call, by component, in evaluation order"""
+        groups = {}
+        for node in self.order():
+            if self.tags[node] is not None:
+                groups.setdefault(self.tags[node], []).append(node)
+        return groups
+    def activity(self, probe) -> list[str]:
+        """Lines adding the gates evaluated and the gate outputs that toggled to probe.evaluations and
+        probe.toggles
+
+        The outputs of a component are packed in one int of probe.state, the
+        slot of that component whatever netlist or optype branch drives it, and
+        toggles are counted against what the component held last (outputs a
+        branch doesn't drive count as 0). Each pass through a reused circuit
+        is compared with the pass before it."""
+        lines = []
+        for component, nodes in self.components().items():
+            i, slot = probe.index(component), probe.slot(component)
+            runs = {}
+            for node in sorted(nodes): #gates in creation order, the same in every pass
+                runs.setdefault(self.passes[node], []).append(node)
+            for run in sorted(runs):
+                packed = runs[run]
+                lines.append("v = " + " | ".join(f"n{node} << {k}" if k else f"n{node}" for k, node in enumerate(packed)))
+                lines.append(f"toggles[{i}] += (v ^ state[{slot}]).bit_count()")
+                lines.append(f"state[{slot}] = v")
+            lines.append(f"evaluations[{i}] += {len(nodes)}")
+        return lines
+    def lines(self, probe = None, ones: str | None = None, assign = "{target} = {node}") -> list[str]:
+        """One assignment per node, then the outputs (and the probe counters)
+
+        Nodes are bools, or bit-sliced ints when ones names the all lanes mask:
+        not becomes a xor with it and the constants are 0 and ones. assign
+        formats the output assignments."""
+        lines = []
+        for node in self.order():
+            op, operands = self.nodes[node]
+            names = [f"n{operand}" for operand in operands]
+            if op == "input":
+                expression = operands[0]
+            elif op == "const":
+                expression = str(operands[0]) if ones is None else ones if operands[0] else "0"
+            elif op == "not":
+                expression = f"not {names[0]}" if ones is None else f"{names[0]} ^ {ones}"
+            elif op == "nor":
+                expression = f"not ({' | '.join(names)})" if ones is None else f"({' | '.join(names)}) ^ {ones}"
+            else:
+                expression = GATES[op].join(names)
+            lines.append(f"n{node} = {expression}")
+        lines += [assign.format(target=target, node=f"n{node}") for target, node in self.outputs.items()]
+        if probe is not None:
+            assert ones is None, "Probes count bool netlists only"
+            lines += self.activity(probe)
+        return lines
+
+def define(name: str, source: str, namespace: dict | None = None):
+    namespace = {} if namespace is None else namespace
+    exec(compile(source, f"<netlist {name}>", "exec"), namespace)
+    function = namespace[name]
+    function.source = source
+    return function
+
+def indent(lines: list[str], depth = 1) -> str:
+    return "".join("    " * depth + line + "\n" for line in lines)
+
+#    CIRCUITS    #
+def full_adder(net: Netlist, a: int, b: int, carry: int) -> tuple[int, int]:
+    #FullAdder: sum is one 3-input xor, carry recomputes a xor b
+    sum = net.XOR(a, b, carry)
+    carry = net.OR(net.AND(net.XOR(a, b), carry), net.AND(a, b))
+    return sum, carry
+
+def adder(net: Netlist, A: list[int], B: list[int], carry: int) -> tuple[list[int], int]:
+    #one pass through the ALU's single Adder
+    component, net.component = net.component, "adder"
+    net.run = max(net.passes) + 1
+    sum = []
+    for i in range(8):
+        bit, carry = full_adder(net, A[i], B[i], carry)
+        sum.append(bit)
+    net.component, net.run = component, 0
+    return sum, carry
+
+def counter(net: Netlist, bits: list[int], carry: int) -> list[int]:
+    """bin_counter: each bit is xored with the carry, which goes on while the new bit is 0"""
+    new = []
+    for bit in bits:
+        bit = net.XOR(bit, carry)
+        carry = net.AND(net.NOT(bit), carry)
+        new.append(bit)
+    return new
+
+def multiply(net: Netlist, A: list[int], B: list[int], zero: int) -> tuple[list[int], list[int]]:
+    """Alu.multiply as (low byte, high byte), the adder keeps its carry from one pass to the next"""
+    low = [net.AND(A[0], B[0])]
+    high = [net.AND(A[0], B[j]) for j in range(1, 8)] + [zero]
+    carry = zero
+    for i in range(1, 8):
+        sum, carry = adder(net, high, [net.AND(A[i], B[j]) for j in range(8)], carry)
+        low.append(sum[0])
+        high = sum[1:] + [carry]
+    return low, high
+
+def alu_netlist(optype: int, bit = "{}.state") -> Netlist:
+    """Gates of Alu.__call__ for one optype (1-15), writing bus, CF, ZF and SF (bit formats each wire)"""
+    net = Netlist(f"alu {optype}", "alu")
+    A = [net.input(bit.format(f"A[{i}]")) for i in range(8)]
+    B = [net.input(bit.format(f"B[{i}]")) for i in range(8)]
+    zero, one = net.const(False), net.const(True)
+    carry = None #new CF, None leaves it as is
+    match optype:
+        case 1:
+            bus, carry = adder(net, A, B, zero)
+        case 2:
+            bus, carry = adder(net, A, [net.NOT(bit) for bit in B], one)
+        case 3:
+            bus, carry = [], one
+            for i in range(8):
+                bus.append(net.XOR(A[i], carry))
+                carry = net.AND(A[i], carry)
+        case 4:
+            bus, carry = [], one
+            for i in range(8):
+                bus.append(net.XOR(A[i], carry))
+                carry = net.AND(net.NOT(A[i]), carry)
+        case 5:
+            bus = [net.AND(A[i], B[i]) for i in range(8)]
+        case 6:
+            bus = [net.OR(A[i], B[i]) for i in range(8)]
+        case 7:
+            bus = [net.NOT(A[i]) for i in range(8)]
+        case 8:
+            bus = A[1:] + [zero]
+        case 9:
+            bus, carry = [zero] + A[:7], A[7]
+        case 10:
+            bus, high = multiply(net, A, B, zero)
+            carry = high[0]
+        case 11:
+            low, bus = multiply(net, A, B, zero)
+        case 12:
+            bus = [net.XOR(A[i], B[i]) for i in range(8)]
+        case _: #unused optypes only set the flags
+            bus = [net.input(bit.format(f"bus[{i}]")) for i in range(8)]
+    if optype < 13:
+        for i in range(8):
+            net.output(bit.format(f"bus[{i}]"), bus[i])
+    if carry is not None:
+        net.output(bit.format("self.CF"), carry)
+    net.output(bit.format("self.ZF"), net.NOR(*bus))
+    net.output(bit.format("self.SF"), bus[7])
+    return net
+
+def counter_netlist(width: int, component: str = "counter", bit = "{}.state", carry: str | None = None) -> Netlist:
+    """bin_counter over counter[0] to counter[width - 1], counting when the carry expression is set (always if None)"""
+    net = Netlist(f"{component} {width}", component)
+    carry = net.const(True) if carry is None else net.input(carry)
+    bits = counter(net, [net.input(bit.format(f"counter[{i}]")) for i in range(width)], carry)
+    for i in range(width):
+        net.output(bit.format(f"counter[{i}]"), bits[i])
+    return net
+
+def decoder_netlist(width: int, component: str = "decoder") -> Netlist:
+    """Ram.decoder and ControlUnit.decoder: one and gate per output over the address bits or their inverse"""
+    net = Netlist(f"{component} {width}", component)
+    bits = [net.input(f"address[{j}].state") for j in range(width)]
+    inverse = [net.NOT(bit) for bit in bits]
+    for i in range(1 << width):
+        net.output(f"outputs[{i}]", net.AND(*(bits[j] if i & (1 << j) else inverse[j] for j in range(width))))
+    return net
+
+#    COMPILED FUNCTIONS    #
+#each source function takes an optional probe counting the activity of the gates it generates
+def alu_source(probe = None) -> str:
+    """alu(alu, optype) doing Alu.__call__ for that optype"""
+    source = "def alu(self, optype):\n"
+    source += "    if optype == 0:\n        return\n"
+    source += "    A, B, bus = self.A.byte, self.B.byte, self.bus.byte\n"
+    for optype in range(1, 16):
+        source += f"    {'if' if optype == 1 else 'elif'} optype == {optype}:\n"
+        source += indent(alu_netlist(optype).lines(probe), 2)
+    return source
+
+def pc_write_source(probe = None) -> str:
+    """pc_write(pc) doing ProgCounter.write: 12-bit count then jump"""
+    source = "def pc_write(self):\n"
+    source += "    counter = self.counter\n"
+    source += "    if self.CE.state:\n"
+    source += indent(counter_netlist(12, "pc counter").lines(probe), 2)
+    source += "    if self.JP.state:\n"
+    source += "        mbus = self.mbus\n"
+    source += indent([f"counter[{i}].state = mbus[{i}].state" for i in range(12)], 2)
+    return source
+
+def control_unit_source(probe = None) -> str:
+    """control_unit(cu) doing ControlUnit.__call__: ROM lookup then 3-bit step count"""
+    address = ["counter[0].state", "counter[1].state << 1", "counter[2].state << 2"]
+    address += [f"ins[{i}].state << {i + 3}" for i in range(4)]
+    address += [f"addr[{i + 8}].state << {i + 7}" for i in range(4)]
+    address += [f"cond[{i}].state << {i + 11}" for i in range(3)]
+    source = "def control_unit(self):\n"
+    source += "    counter, ins, addr, cond, controls = self.counter.byte, self.ins, self.addr, self.cond, self.controls\n"
+    source += f"    word = self.rom[{' | '.join(address)}]\n"
+    source += "    if word == 0:\n"
+    source += indent([f"counter[{i}].state = False" for i in range(8)], 2)
+    source += indent([f"controls[{i}].state = False" for i in range(CONTROL_WIRES)], 2)
+    source += "    else:\n"
+    source += indent([f"controls[{i}].state = word & {1 << i} != 0" for i in range(CONTROL_WIRES)], 2)
+    source += indent(counter_netlist(3, "step counter").lines(probe), 2)
+    return source
+
+@cache
+def compile_alu():
+    return define("alu", alu_source())
+
+@cache
+def compile_pc_write():
+    return define("pc_write", pc_write_source())
+
+@cache
+def compile_control_unit():
+    return define("control_unit", control_unit_source())
+
+@cache
+def compile_decoder(width: int):
+    """decoder(address) -> output states of the width-bit decoder"""
+    net = decoder_netlist(width)
+    source = "def decoder(address):\n"
+    source += f"    outputs = [False] * {1 << width}\n"
+    source += indent(net.lines())
+    source += "    return outputs\n"
+    return define("decoder", source)
+
+def attach(machine):
+    assert len(machine.control_wires) == CONTROL_WIRES, "Control unit compiled for 24 control wires"
+    machine.alu.netlist = compile_alu()
+    machine.pc.netlist = compile_pc_write()
+    machine.cu.netlist = compile_control_unit()
+
+def detach(machine):
+    machine.alu.netlist = machine.pc.netlist = machine.cu.netlist = None
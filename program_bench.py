@@ -0,0 +1,128 @@
+#Program benchmark: runs every workload of benchmarks/ on each engine, reports ticks/s, instructions/s,
+#assembling time and peak memory, and fails when a run got slower than a saved baseline
+#   python program_bench.py [--engines int block] [--runs 3] [--save results.json]
+#                           [--baseline results.json] [--threshold 0.1] [--no-memory] [workload.sbbasm ...]
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+import asm
+from cpu import Machine
+from guest_profiler import GuestProfiler
+
+WORKLOADS = Path(__file__).parent / "benchmarks"
+QUIET = [False] * 7 #no special mode while assembling
+ROM = Machine().cu.rom
+
+def engine_run(engine: str, mem: bytearray):
+    """(ticks, OUT) of the program run to its halt"""
+    if engine == "gate":
+        cpu = Machine(ROM)
+        cpu.load(mem)
+        return cpu.run(), cpu.out.data.uint()
+    cpu = asm.ENGINES[engine](ROM)
+    cpu.load(mem)
+    return cpu.run(), cpu.out
+
+def instructions(image: asm.Image) -> int:
+    #the same on every engine, counted once on the profiling engine
+    profiler = GuestProfiler(ROM)
+    profiler.load(image.mem)
+    profiler.run()
+    return sum(row[1] for row in profiler.opcodes())
+
+def peak_memory(engine: str, mem: bytearray) -> int:
+    """Most bytes allocated at once while building the engine and running (tracemalloc, so timed apart)"""
+    tracemalloc.start()
+    try:
+        engine_run(engine, mem)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench(path: Path, engines: list[str], runs: int = 3, memory = True) -> dict:
+    """Results of one workload per engine, best time of runs"""
+    lines = path.read_text().splitlines(keepends=True)
+    asm_time = float("inf")
+    for i in range(runs):
+        start = perf_counter()
+        image = asm.assemble(lines, *QUIET)
+        asm_time = min(asm_time, perf_counter() - start)
+    assert image.program_ends, f"{path.name} doesn't halt"
+    count = instructions(image)
+    results = {}
+    for engine in engines:
+        best = float("inf")
+        for i in range(runs):
+            start = perf_counter()
+            ticks, out = engine_run(engine, image.mem)
+            best = min(best, perf_counter() - start)
+        results[engine] = {"ticks": ticks, "out": out, "instructions": count, "seconds": best,
+                           "ticks_per_s": ticks / best, "instructions_per_s": count / best,
+                           "asm_ms": asm_time * 1000, "peak_kb": peak_memory(engine, image.mem) / 1024 if memory else None}
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Runs slower than the baseline by more than threshold (0.1: 10% fewer ticks/s)"""
+    regressions = []
+    for workload, engines in results.items():
+        for engine, result in engines.items():
+            base = baseline.get(workload, {}).get(engine)
+            if base is None:
+                continue
+            ratio = result["ticks_per_s"] / base["ticks_per_s"]
+            if ratio < 1 - threshold:
+                regressions.append(f"{workload} on {engine}: {result['ticks_per_s']/1000:.2f}kHz, "
+                                   f"{base['ticks_per_s']/1000:.2f}kHz in the baseline ({ratio - 1:+.1%})")
+    return regressions
+
+def outcomes(engines: dict) -> set:
+    #(ticks, OUT) of each engine, a single one when they agree
+    return {(result["ticks"], result["out"]) for result in engines.values()}
+
+def table(results: dict, header = True) -> str:
+    lines = [f"{'workload':<12}{'engine':<9}{'ticks':>9}{'kHz':>10}{'kinstr/s':>10}{'asm ms':>8}{'peak KB':>9}"] if header else []
+    for workload, engines in results.items():
+        outs = outcomes(engines)
+        for engine, result in engines.items():
+            peak = "" if result["peak_kb"] is None else f"{result['peak_kb']:.0f}"
+            lines.append(f"{workload:<12}{engine:<9}{result['ticks']:>9}{result['ticks_per_s']/1000:>10.2f}"
+                         f"{result['instructions_per_s']/1000:>10.2f}{result['asm_ms']:>8.2f}{peak:>9}")
+        if len(outs) > 1:
+            lines.append(f"[Error] {workload}: engines disagree on (ticks, OUT): {sorted(outs)}")
+    return "\n".join(lines)
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark SBBasm workloads on every engine")
+    parser.add_argument("workloads", nargs="*", type=Path, help=f"programs to run (default: {WORKLOADS.name}/*.sbbasm)")
+    parser.add_argument("--engines", nargs="+", choices=list(asm.ENGINES), default=list(asm.ENGINES))
+    parser.add_argument("--runs", type=int, default=3, help="best time of this many runs")
+    parser.add_argument("--save", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown failing the comparison (0.1: 10%%)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory runs")
+    args = parser.parse_args(argv)
+    paths = args.workloads or sorted(WORKLOADS.glob("*.sbbasm"))
+    results = {}
+    for path in paths:
+        results[path.stem] = bench(path, args.engines, args.runs, not args.no_memory)
+        print(table({path.stem: results[path.stem]}, len(results) == 1), flush=True)
+    if args.save:
+        args.save.write_text(json.dumps({"python": platform.python_version(), "machine": platform.machine(),
+                                         "results": results}, indent=1))
+        print(f"Results saved to {args.save}")
+    mismatches = [workload for workload, engines in results.items() if len(outcomes(engines)) > 1]
+    regressions = []
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text())["results"], args.threshold)
+        for regression in regressions:
+            print(f"[Regression] {regression}")
+        if not regressions:
+            print(f"No regression past {args.threshold:.0%} against {args.baseline}")
+    return 1 if regressions or mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
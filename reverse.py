@@ -0,0 +1,147 @@
+from array import array
+from collections import deque
+import snapshot
+from fastcpu import FastCPU, AluTables, TABLES, RI, STACK_MASK, run_function
+
+#Undo log entry of one tick, the registers before the tick and what it overwrote in memory:
+#   regs:  a | b << 8 | ir << 16 | ir2 << 24 | out << 32 | bus << 40 | scp << 48 | sp << 56
+#   ctrl:  mbus | mar << 12 | pc << 24 | step << 36 | flags << 39 | refresh << 42
+#   write: old value | address << 12 | kind << 24 (0 nothing, 1 RAM, 2 stack)
+RAM_WRITE = 1
+STACK_WRITE = 2
+
+class ReverseCPU(FastCPU):
+    """Integer engine that can also run backwards
+
+    Every tick appends an undo entry to a ring buffer holding the last `history`
+    ticks, and a full snapshot (keyframe) is kept every `interval` ticks, the
+    last `keyframes` of them. Going back within the ring undoes ticks one by
+    one, further back a keyframe is restored and run forward. Memory stays
+    bounded however long the program runs."""
+    def __init__(self, rom: list[int], tables: AluTables = TABLES,
+                 history: int = 2**20, interval: int = 2**18, keyframes: int = 256):
+        assert history & (history - 1) == 0 and interval & (interval - 1) == 0, "Sizes must be powers of 2"
+        assert interval <= history, "The ring must hold a whole keyframe interval"
+        assert not any(w & RI and w & STACK_MASK for w in rom), "A tick can only write RAM or the stack"
+        self.history = history
+        self.interval = interval
+        self.regs = array('Q', bytes(8 * history))
+        self.ctrl = array('Q', bytes(8 * history))
+        self.writes = array('I', bytes(4 * history))
+        self.keyframes = deque(maxlen=keyframes) #(count, snapshot)
+        super().__init__(rom, tables)
+    def reset(self):
+        super().reset()
+        self.forget()
+    def load(self, mem):
+        super().load(mem)
+        self.forget()
+    def forget(self):
+        #the undo log starts over from the current tick
+        self.start = self.recorded = self.count #ticks start to recorded are in the ring
+        self.keyframes.clear()
+    def ring_start(self) -> int:
+        #going back and forth rewrites the same entries, so the ring ends at the furthest tick reached
+        return max(self.start, self.recorded - self.history)
+    def oldest(self) -> int:
+        """Earliest tick reachable going back (count at that point)"""
+        oldest = self.ring_start()
+        if self.keyframes:
+            oldest = min(oldest, self.keyframes[0][0])
+        return oldest
+    #undo log and keyframes recorded by the FastCPU.run loop, written to by every tick that doesn't halt
+    run = run_function("ReverseCPU", globals(),
+        setup="""
+            regs, ctrl, writes = self.regs, self.ctrl, self.writes
+            mask = self.history - 1
+            every = self.interval - 1""",
+        top="""
+            if not now & every:
+                #keyframe, once per interval
+                if not self.keyframes or self.keyframes[-1][0] < now:
+                    self.a, self.b, self.ir, self.ir2, self.out = a, b, ir, ir2, out
+                    self.bus, self.mbus, self.mar, self.pc, self.sp = bus, mbus, mar, pc, sp
+                    self.step, self.scp, self.flags, self.refresh, self.count = step, scp, flags >> 11, refresh, now
+                    self.keyframes.append((now, snapshot.dumps(self)))""",
+        tick="""
+            pos = now & mask
+            regs[pos] = a | b << 8 | ir << 16 | ir2 << 24 | out << 32 | bus << 40 | scp << 48 | sp << 56
+            ctrl[pos] = mbus | mar << 12 | pc << 24 | step << 36 | flags << 28 | refresh << 42 #flags is shifted by 11
+            writes[pos] = 0""",
+        ram_write="writes[pos] = RAM_WRITE << 24 | mar << 12 | mem[mar]",
+        push="writes[pos] = STACK_WRITE << 24 | sp << 12 | stack[sp]",
+        finish="self.recorded = max(self.recorded, now)")
+    def undo(self):
+        #reverts the last tick from the ring buffer
+        self.count -= 1
+        pos = self.count & (self.history - 1)
+        regs, ctrl, write = self.regs[pos], self.ctrl[pos], self.writes[pos]
+        self.a, self.b, self.ir, self.ir2 = regs & 255, (regs >> 8) & 255, (regs >> 16) & 255, (regs >> 24) & 255
+        self.out, self.bus, self.scp, self.sp = (regs >> 32) & 255, (regs >> 40) & 255, (regs >> 48) & 255, regs >> 56
+        self.mbus, self.mar, self.pc = ctrl & 4095, (ctrl >> 12) & 4095, (ctrl >> 24) & 4095
+        self.step, self.flags, self.refresh = (ctrl >> 36) & 7, (ctrl >> 39) & 7, bool(ctrl >> 42)
+        if write >> 24 == RAM_WRITE:
+            self.mem[(write >> 12) & 4095] = write & 255
+        elif write >> 24 == STACK_WRITE:
+            self.stack[(write >> 12) & 255] = write & 4095
+    def replay(self, target: int):
+        #runs forward to tick target, through the halts the program was resumed from
+        while self.count < target:
+            self.run(target - self.count)
+    def step_back(self, n: int = 1) -> int:
+        """Goes back n ticks (fewer if the history doesn't go that far), returns how many"""
+        self.halted = False
+        target = max(self.count - n, self.oldest())
+        n = self.count - target
+        if target >= self.ring_start():
+            for i in range(n):
+                self.undo()
+            return n
+        #too far for the ring: restart from the last keyframe before target and run forward
+        while self.keyframes[-1][0] > target:
+            self.keyframes.pop()
+        count, data = self.keyframes[-1]
+        keyframes = list(self.keyframes)
+        snapshot.loads(self, data)
+        self.keyframes.extend(keyframes) #loading forgot them
+        self.start = self.recorded = count
+        self.replay(target)
+        return n
+    def last_write(self, addr: int) -> int | None:
+        """Ticks since the last write to RAM address addr within the ring buffer, None if not found"""
+        mask = self.history - 1
+        key = RAM_WRITE << 24 | addr << 12
+        for tick in range(self.count - 1, self.ring_start() - 1, -1):
+            if self.writes[tick & mask] & 0xffff000 == key:
+                return self.count - tick
+        return None
+    def back_to_write(self, addr: int) -> int | None:
+        """Goes back to just before the last write to RAM address addr, returns the ticks gone back
+
+        Searches the ring buffer, then each keyframe interval before it (running
+        it forward again). Nothing changes and None is returned if addr was
+        never written within the history."""
+        self.halted = False
+        n = self.last_write(addr)
+        if n is not None:
+            return self.step_back(n)
+        count = self.count
+        here = snapshot.dumps(self)
+        keyframes = list(self.keyframes)
+        end = self.ring_start()
+        for frame, data in reversed(keyframes):
+            if frame >= end:
+                continue
+            snapshot.loads(self, data)
+            self.keyframes.extend(k for k in keyframes if k[0] <= frame)
+            self.start = self.recorded = frame
+            self.replay(end)
+            n = self.last_write(addr)
+            if n is not None:
+                self.step_back(n)
+                return count - self.count
+            end = frame
+        #the ring now holds older ticks, going back from here goes through the keyframes
+        snapshot.loads(self, here)
+        self.keyframes.extend(keyframes)
+        return None
@@ -0,0 +1,82 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+from functools import cache
+from pathlib import Path
+
+ROM_SIZE = 2**14
+#next to this file, whatever the working directory of the process loading them
+ROM_TEXT = Path(__file__).parent / "control_signals.rom" #legacy format, one word per line in ascii binary
+ROM_BIN  = Path(__file__).parent / "control_signals.bin"
+
+#Binary format: header then ROM_SIZE little-endian uint32 words
+#   magic, version, bytes per word, word count, crc32 of the words
+ROM_MAGIC = b"SBBROM"
+ROM_VERSION = 1
+HEADER = struct.Struct("<6sBBII")
+WORD_TYPE = 'I'
+
+def read_text_rom(path = ROM_TEXT) -> array:
+    rom = array(WORD_TYPE)
+    with open(path, "r") as control_signals:
+        for i in range(ROM_SIZE):
+            rom.append(int(control_signals.readline(), 2))
+    return rom
+
+def write_rom(words, path = ROM_BIN):
+    data = array(WORD_TYPE, words)
+    assert len(data) == ROM_SIZE, f"ROM has {len(data)} words, expected {ROM_SIZE}"
+    if sys.byteorder == "big":
+        data.byteswap()
+    data = data.tobytes()
+    header = HEADER.pack(ROM_MAGIC, ROM_VERSION, array(WORD_TYPE).itemsize, ROM_SIZE, zlib.crc32(data))
+    #write then rename so other processes never read half a ROM
+    temp = Path(path).with_suffix(f".{os.getpid()}.tmp")
+    temp.write_bytes(header + data)
+    os.replace(temp, path)
+
+def read_rom(path = ROM_BIN) -> array | None:
+    """Returns None if the file is missing, from another version or corrupted"""
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError:
+        return None
+    if len(data) < HEADER.size:
+        return None
+    magic, version, word_size, count, checksum = HEADER.unpack_from(data)
+    rom = array(WORD_TYPE)
+    if magic != ROM_MAGIC or version != ROM_VERSION or word_size != rom.itemsize or count != ROM_SIZE \
+       or len(data) != HEADER.size + count * word_size or zlib.crc32(data[HEADER.size:]) != checksum:
+        return None
+    rom.frombytes(data[HEADER.size:])
+    if sys.byteorder == "big":
+        rom.byteswap()
+    return rom
+
+def load_rom(text_path = ROM_TEXT, bin_path = ROM_BIN) -> array:
+    #the binary ROM is stale if the text ROM was rewritten after it
+    try:
+        stale = os.stat(text_path).st_mtime > os.stat(bin_path).st_mtime
+    except OSError:
+        stale = False
+    rom = None if stale else read_rom(bin_path)
+    if rom is None:
+        rom = read_text_rom(text_path)
+        try:
+            write_rom(rom, bin_path)
+        except OSError:
+            pass #read-only install, convert again next time
+    return rom
+
+@cache
+def shared_rom() -> array:
+    """The ROM loaded once per process, shared (read only) by every machine"""
+    return load_rom()
+
+if __name__ == '__main__':
+    #convert the legacy text ROM
+    write_rom(read_text_rom())
+    print(f"Wrote {ROM_BIN}")
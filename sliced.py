@@ -0,0 +1,256 @@
+#Bit-sliced gate-level machines: every wire is one int whose bit k is its value in machine (lane) k, so the
+#compiled netlists run the gates of all the lanes at once as bitwise operations. RAM, stack and control
+#unit ROM are looked up per lane and each lane halts on its own, for fault injection sweeps and the like
+#   machines = SlicedMachine(rom, lanes=64); machines.load(image.mem)
+#   machines.flip("rega", 3, 1 << 5)    lane 5: bit 3 of register A inverted
+#   machines.run(); machines.value("out", 5), machines.ticks(5)
+from functools import cache
+from cpu import RAM_SIZE, StackMemory
+from rom import shared_rom
+import netlist
+
+LANES = 64
+#control wires, numbered as cpu.Machine.control_wires
+MI, RI, RO, II, IO, CO, JP, CE, AI, AO, L1, L2, L3, L4, HT, BI, BO, OI, XI, SI, SO, SA, RF, PI = range(24)
+#wires of each register, a list of planes (counter: control unit step counter)
+WIDTHS = {"bus": 8, "mbus": 12, "rega": 8, "regb": 8, "ir": 8, "ir2": 8, "out": 8, "pc": 12, "mar": 12, "sp": 8,
+          "counter": 3}
+FLAGS = ("CF", "ZF", "SF")
+MERGE = "{target} = {target} & keep | {node} & sel" #netlist outputs only written in the selected lanes
+
+def groups(planes: list[int], lanes: int) -> list[tuple[int, int]]:
+    """(value, lanes) pairs splitting lanes by the value the planes hold in them, one per distinct value"""
+    parts = [(0, lanes)]
+    for j, plane in enumerate(planes):
+        split = []
+        for value, mask in parts:
+            high = mask & plane
+            if high:
+                split.append((value | 1 << j, high))
+            if high != mask:
+                split.append((value, mask ^ high))
+        parts = split
+    return parts
+
+#    COMPILED FUNCTIONS    #
+def alu_source() -> str:
+    """alu(machines) doing Alu.__call__ in every lane, each with the optype of its control wires"""
+    source = "def alu(self):\n"
+    source += "    ones, controls = self.ones, self.controls\n"
+    source += "    L1, L2, L3, L4 = controls[10], controls[11], controls[12], controls[13]\n"
+    source += "    if not (L1 | L2 | L3 | L4):\n        return\n"
+    source += "    N1, N2, N3, N4 = L1 ^ ones, L2 ^ ones, L3 ^ ones, L4 ^ ones\n"
+    source += "    A, B, bus = self.rega, self.regb, self.bus\n"
+    for optype in range(1, 16):
+        source += f"    sel = {' & '.join(f'L{i + 1}' if optype >> i & 1 else f'N{i + 1}' for i in range(4))}\n"
+        source += "    if sel:\n        keep = ones ^ sel\n"
+        source += netlist.indent(netlist.alu_netlist(optype, "{}").lines(ones="ones", assign=MERGE), 2)
+    return source
+
+def counter_source(name: str, register: str, width: int, component: str) -> str:
+    """name(machines, lanes) counting register up by one in lanes (bin_counter)"""
+    source = f"def {name}(self, lanes):\n"
+    source += f"    ones, counter = self.ones, self.{register}\n"
+    source += netlist.indent(netlist.counter_netlist(width, component, "{}", "lanes").lines(ones="ones"))
+    return source
+
+@cache
+def compiled() -> tuple:
+    """(alu, pc count, step count) functions"""
+    return (netlist.define("alu", alu_source()), netlist.define("pc_count", counter_source("pc_count", "pc", 12, "pc counter")),
+            netlist.define("step_count", counter_source("step_count", "counter", 3, "step counter")))
+
+class SlicedMachine:
+    """lanes independent gate-level Machines run together, without screen
+
+    Registers are lists of planes (see WIDTHS), flags and control wires single
+    planes, RAM and stack one plane per bit of each entry. A tick does what
+    Machine.step does in every running lane: lanes whose ROM address or RAM
+    address differ are looked up apart, lanes that halted keep their state
+    and ticks(lane) gives what Machine.run would have returned for it."""
+    def __init__(self, rom = None, lanes: int = LANES):
+        assert lanes >= 1, "At least one lane"
+        self.lanes = lanes
+        self.ones = (1 << lanes) - 1
+        self.rom = shared_rom() if rom is None else rom
+        self.alu, self.pc_count, self.step_count = (function.__get__(self) for function in compiled())
+        self.reset()
+    def reset(self):
+        """Every lane cleared and running, the ROM stays loaded"""
+        for name, width in WIDTHS.items():
+            setattr(self, name, [0] * width)
+        self.CF = self.ZF = self.SF = 0
+        self.controls = [0] * 24
+        self.mem = [0] * (RAM_SIZE * 8) #address * 8 + bit
+        self.stack = [0] * (StackMemory.SIZE * 12) #entry * 12 + bit
+        self.overflow = self.underflow = 0 #lanes whose stack wrapped around
+        self.live = self.ones #lanes not halted
+        self.halted_at: dict[int, int] = {} #lane -> ticks run before its halt
+        self.count = 0
+    def mask(self, lanes) -> int:
+        #lanes as a mask, from a mask, an iterable of lane numbers or None (all lanes)
+        if lanes is None:
+            return self.ones
+        if isinstance(lanes, int):
+            return lanes & self.ones
+        return sum(1 << lane for lane in set(lanes)) & self.ones
+    def load(self, mem, lanes = None):
+        """RAM image (bytes or any buffer) loaded from address 0 in lanes"""
+        lanes = self.mask(lanes)
+        keep = self.ones ^ lanes
+        planes = self.mem
+        for address, value in enumerate(bytes(mem)):
+            base = address * 8
+            for j in range(8):
+                planes[base + j] = planes[base + j] & keep | (lanes if value >> j & 1 else 0)
+    def ram(self, lane: int) -> bytearray:
+        data = bytearray(RAM_SIZE)
+        planes = self.mem
+        for address in range(RAM_SIZE):
+            base = address * 8
+            data[address] = sum((planes[base + j] >> lane & 1) << j for j in range(8))
+        return data
+    def value(self, name: str, lane: int) -> int:
+        """Register (WIDTHS) or flag (FLAGS) of one lane, unsigned"""
+        if name in FLAGS:
+            return getattr(self, name) >> lane & 1
+        return sum((plane >> lane & 1) << j for j, plane in enumerate(getattr(self, name)))
+    def set(self, name: str, value: int, lanes = None):
+        lanes = self.mask(lanes)
+        keep = self.ones ^ lanes
+        if name in FLAGS:
+            setattr(self, name, getattr(self, name) & keep | (lanes if value else 0))
+            return
+        planes = getattr(self, name)
+        for j in range(len(planes)):
+            planes[j] = planes[j] & keep | (lanes if value >> j & 1 else 0)
+    def flip(self, name: str, bit: int, lanes = None):
+        """Inverts one wire in lanes: a register (WIDTHS) bit, a flag (bit 0) or "mem" bit address * 8 + bit"""
+        lanes = self.mask(lanes)
+        if name in FLAGS:
+            setattr(self, name, getattr(self, name) ^ lanes)
+        else:
+            planes = self.mem if name == "mem" else getattr(self, name)
+            planes[bit] ^= lanes
+    def ticks(self, lane: int) -> int:
+        return self.halted_at.get(lane, self.count)
+    def halted(self, lane: int) -> bool:
+        return not self.live >> lane & 1
+    def copy(self, target: list[int], source: list[int], lanes: int):
+        #register transfer in lanes
+        keep = self.ones ^ lanes
+        for j in range(len(target)):
+            target[j] = target[j] & keep | source[j] & lanes
+    def halt(self, lanes: int):
+        self.live ^= lanes
+        while lanes:
+            lane = (lanes & -lanes).bit_length() - 1
+            self.halted_at[lane] = self.count
+            lanes &= lanes - 1
+    def count_sp(self, lanes: int, down = False):
+        sp, carry = self.sp, lanes
+        for j in range(8):
+            bit = sp[j]
+            sp[j] = bit ^ carry
+            carry &= (bit ^ self.ones) if down else bit
+    def control_unit(self):
+        #ControlUnit.__call__, one ROM lookup per distinct address among the running lanes
+        controls = self.controls
+        for i in range(24):
+            controls[i] = 0
+        counter, ir = self.counter, self.ir
+        counting = 0
+        for address, lanes in groups(counter + ir[4:] + ir[:4] + [self.CF, self.ZF, self.SF], self.live):
+            word = self.rom[address]
+            if word:
+                counting |= lanes
+                while word:
+                    controls[(word & -word).bit_length() - 1] |= lanes
+                    word &= word - 1
+        reset = self.live ^ counting
+        if reset:
+            keep = self.ones ^ reset
+            for j in range(3):
+                counter[j] &= keep
+        if counting:
+            self.step_count(counting)
+    def ram_access(self, write: int, read: int):
+        #Ram.__call__ data side, lanes grouped by address
+        mem, bus = self.mem, self.bus
+        if write:
+            for address, lanes in groups(self.mar, write):
+                keep = self.ones ^ lanes
+                for j in range(8):
+                    mem[address * 8 + j] = mem[address * 8 + j] & keep | bus[j] & lanes
+        if read:
+            values = [0] * 8
+            for address, lanes in groups(self.mar, read):
+                for j in range(8):
+                    values[j] |= mem[address * 8 + j] & lanes
+            self.copy(bus, values, read)
+    def stack_access(self, pop: int, push: int, address: int):
+        #StackMemory.__call__: pop lanes then push lanes, entries on mbus in address lanes, on the bus otherwise
+        stack, sp = self.stack, self.sp
+        if pop:
+            self.underflow |= pop & ~(sp[0] | sp[1] | sp[2] | sp[3] | sp[4] | sp[5] | sp[6] | sp[7])
+            self.count_sp(pop, True)
+            entry = [0] * 12
+            for value, lanes in groups(sp, pop):
+                for j in range(12):
+                    entry[j] |= stack[value * 12 + j] & lanes
+            self.copy(self.mbus, entry, pop & address)
+            self.copy(self.bus, entry, pop & ~address)
+        if push:
+            self.overflow |= push & sp[0] & sp[1] & sp[2] & sp[3] & sp[4] & sp[5] & sp[6] & sp[7]
+            for value, lanes in groups(sp, push):
+                wide, narrow = lanes & address, lanes & ~address
+                for j in range(12):
+                    keep = self.ones ^ lanes if j < 8 else self.ones ^ wide
+                    new = self.mbus[j] & wide | (self.bus[j] & narrow if j < 8 else 0)
+                    stack[value * 12 + j] = stack[value * 12 + j] & keep | new
+            self.count_sp(push)
+    def step(self) -> bool:
+        """One clock tick of every running lane, returns False once they all halted"""
+        if not self.live:
+            return False
+        self.control_unit()
+        c = self.controls
+        if c[HT]:
+            halting = c[HT]
+            self.halt(halting)
+            if not self.live:
+                return False
+            keep = self.ones ^ halting
+            for i in range(24):
+                c[i] &= keep
+        self.alu()
+        if c[CO]:
+            self.copy(self.mbus, self.pc, c[CO])
+        if c[AO]:
+            self.copy(self.bus, self.rega, c[AO])
+        if c[BO]:
+            self.copy(self.bus, self.regb, c[BO])
+        if c[IO]: #ir2 out, then the control unit's address out
+            self.copy(self.bus, self.ir2, c[IO])
+            self.copy(self.mbus, self.ir2 + self.ir[:4], c[IO])
+        if c[RI] | c[RO]:
+            self.ram_access(c[RI], c[RO])
+        if c[MI]:
+            self.copy(self.mar, self.mbus, c[MI])
+        if c[SI] | c[SO]:
+            self.stack_access(c[SO], c[SI] & ~c[SO], c[SA])
+        for wire, register in ((AI, self.rega), (BI, self.regb), (II, self.ir), (XI, self.ir2), (OI, self.out)):
+            if c[wire]:
+                self.copy(register, self.bus, c[wire])
+        if c[CE]:
+            self.pc_count(c[CE])
+        if c[JP]:
+            self.copy(self.pc, self.mbus, c[JP])
+        self.count += 1
+        return True
+    def run(self, max_ticks = -1) -> int:
+        """Runs until every lane halted or max_ticks, returns the ticks executed (ticks(lane) per lane)"""
+        ticks = 0
+        while ticks != max_ticks and self.step():
+            ticks += 1
+        return ticks
@@ -0,0 +1,105 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+from pathlib import Path
+from cpu import RAM_SIZE, Machine, StackMemory
+
+#Binary format: header, registers, RAM, stack (little-endian)
+#   header: magic, version, crc32 of everything after the header
+#   registers: see FIELDS
+#   RAM_SIZE bytes of RAM then StackMemory.SIZE uint16 stack entries
+SNAPSHOT_MAGIC = b"SBBSNP"
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct("<6sBI")
+FIELDS = ("a", "b", "ir", "ir2", "out", "bus", "mbus", "mar", "pc", "sp", "step", "flags", "scp", "refresh", "count")
+REGISTERS = struct.Struct("<6B3H4B?Q")
+SIZE = HEADER.size + REGISTERS.size + RAM_SIZE + 2 * StackMemory.SIZE
+
+class SnapshotError(Exception):
+    pass
+
+def bits(values: list) -> int:
+    sum = 0
+    for i, bit in enumerate(values):
+        sum |= int(bit.state) << i
+    return sum
+
+def set_bits(values: list, value: int):
+    for i, bit in enumerate(values):
+        bit.state = bool((value >> i) & 1)
+
+def registers(cpu) -> tuple:
+    """Register values in FIELDS order, from a Machine or an integer engine"""
+    if not isinstance(cpu, Machine):
+        return tuple(getattr(cpu, field) for field in FIELDS)
+    flags = bits(cpu.flags)
+    return (cpu.rega.data.uint(), cpu.regb.data.uint(), cpu.ir.data.uint(), cpu.ir2.data.uint(),
+            cpu.out.data.uint(), cpu.bus.uint(), bits(cpu.mbus), cpu.ram.value(), cpu.pc.uint(),
+            cpu.st.sp, cpu.cu.counter.uint() & 7, flags, cpu.screen.scp.uint(), cpu.rfh(), cpu.count)
+
+def set_registers(cpu, values: tuple):
+    if not isinstance(cpu, Machine):
+        for field, value in zip(FIELDS, values):
+            setattr(cpu, field, value)
+        cpu.halted = False
+        return
+    a, b, ir, ir2, out, bus, mbus, mar, pc, sp, step, flags, scp, refresh, count = values
+    for register, value in ((cpu.rega, a), (cpu.regb, b), (cpu.ir, ir), (cpu.ir2, ir2), (cpu.out, out)):
+        register.data.equal(value)
+    cpu.bus.equal(bus)
+    set_bits(cpu.mbus, mbus)
+    set_bits(cpu.ram.A, mar)
+    set_bits(cpu.pc.counter, pc)
+    cpu.st.sp = sp
+    cpu.cu.counter.equal(step)
+    set_bits(cpu.flags, flags)
+    cpu.screen.scp.equal(scp)
+    cpu.rfh.equal(refresh)
+    cpu.count = count
+    cpu.halted = False
+
+def dumps(cpu) -> bytes:
+    """Snapshot of a Machine or an integer engine (FastCPU and subclasses)"""
+    if isinstance(cpu, Machine):
+        mem, stack = cpu.ram.data, array('H', cpu.st.mem)
+    else:
+        mem, stack = cpu.mem, array('H', cpu.stack)
+    if sys.byteorder == "big":
+        stack.byteswap()
+    body = REGISTERS.pack(*registers(cpu)) + bytes(mem) + stack.tobytes()
+    return HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, zlib.crc32(body)) + body
+
+def loads(cpu, data: bytes):
+    """Restores a snapshot into a Machine or an integer engine, from either kind"""
+    data = memoryview(data)
+    if len(data) != SIZE:
+        raise SnapshotError(f"Snapshot has {len(data)} bytes, expected {SIZE}")
+    magic, version, checksum = HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise SnapshotError(f"Not a version {SNAPSHOT_VERSION} snapshot")
+    if zlib.crc32(data[HEADER.size:]) != checksum:
+        raise SnapshotError("Corrupted snapshot")
+    start = HEADER.size + REGISTERS.size
+    mem = data[start:start + RAM_SIZE]
+    stack = array('H')
+    stack.frombytes(data[start + RAM_SIZE:])
+    if sys.byteorder == "big":
+        stack.byteswap()
+    set_registers(cpu, REGISTERS.unpack_from(data, HEADER.size))
+    cpu.load(mem) #after the registers: engines keeping a history restart it there, the block engine drops its blocks
+    if isinstance(cpu, Machine):
+        cpu.st.mem[:] = stack
+    else:
+        cpu.stack[:] = stack.tolist()
+
+def save(cpu, path):
+    #write then rename so a crash never leaves half a snapshot
+    temp = Path(path).with_suffix(f".{os.getpid()}.tmp")
+    temp.write_bytes(dumps(cpu))
+    os.replace(temp, path)
+
+def load(cpu, path):
+    with open(path, "rb") as file:
+        loads(cpu, file.read())
@@ -0,0 +1,279 @@
+import re
+from cpu import RAM_SIZE
+from fastcpu import FastCPU, FusedCPU, AluTables, TABLES, REGISTERS, STORE, JP, II, RI, RF, CE
+
+MAX_BLOCK = 64 #instructions per translated block
+HOT = 2 #times an address is reached before a block is built there, code run once stays tick by tick
+COLD = (None, 0, False, ()) #block of an address not hot yet
+UNLIMITED = 1 << 62 #ticks left when run() has no max_ticks
+NAME = re.compile(r"\b[a-z_][a-z0-9_]*\b")
+LOCALS = REGISTERS + ("entry",)
+CONSTANTS = {} #constant expressions folded so far -> value, most come back in every block
+
+def fold(lines: list[str], known: dict) -> list[str]:
+    """Replaces registers holding values known while translating by those values"""
+    def value(match):
+        return str(known.get(match.group(), match.group()))
+    output = []
+    for line in lines:
+        target, _, expr = line.partition(" = ")
+        if target in LOCALS:
+            expr = NAME.sub(value, expr)
+            if NAME.search(expr) is None:
+                number = CONSTANTS.get(expr)
+                if number is None:
+                    number = CONSTANTS[expr] = int(expr) if expr.isdigit() else eval(expr)
+                known[target] = number
+                expr = str(number)
+            else:
+                known.pop(target, None)
+            output.append(f"{target} = {expr}")
+        else:
+            output.append(NAME.sub(value, line))
+    return output
+
+def prune(lines: list[str]) -> list[str]:
+    """Drops register assignments overwritten before being read"""
+    statements = []
+    for line in lines:
+        if line.startswith((" ", "elif", "else")):
+            statements[-1].append(line) #body of an if
+        else:
+            statements.append([line])
+    live = set(REGISTERS) #every register is stored back at the end
+    kept = []
+    for statement in reversed(statements):
+        target, _, expr = statement[0].partition(" = ")
+        if len(statement) == 1 and target in LOCALS:
+            if target not in live:
+                continue
+            live.discard(target)
+            live |= set(NAME.findall(expr))
+        else:
+            text = "\n".join(statement)
+            live |= set(NAME.findall(text))
+            if STORE in text or "return" in text:
+                live |= set(REGISTERS)
+        kept.append(statement)
+    return [line for statement in reversed(kept) for line in statement]
+
+class BlockCPU(FusedCPU):
+    """Integer engine running loops and straight-line runs of instructions as generated Python functions
+
+    A block starts at an instruction the program reached HOT times and ends
+    after a jump, a call, a return or a halt, looping inside the function
+    while it jumps back to its start. A conditional jump leaves the block when
+    taken and the block goes on past it otherwise. The flags are carried while
+    running, so blocks are cached by start address only. Only the opcodes are
+    baked into a block (operands are read from RAM while running), so a store
+    to one of those opcodes drops every block built from it; dropped blocks
+    are kept by opcodes and used again when the same code comes back."""
+    def __init__(self, rom: list[int], tables: AluTables = TABLES):
+        self.code = bytearray(RAM_SIZE) #1 where an opcode used by a block lives
+        super().__init__(rom, tables)
+        self.flush()
+    def flush(self):
+        self.blocks = {} #start address -> (function, most ticks of one pass, halts, opcode addresses)
+        self.owners = {} #opcode address -> start addresses of the blocks using it
+        self.library = {} #start address -> [(opcodes, block)] of every block built there
+        self.heat = {} #start address -> times reached before being translated
+        self.code[:] = bytes(RAM_SIZE)
+    def load(self, mem):
+        super().load(mem)
+        self.flush()
+    def invalidate(self, addr: int, key: int = -1) -> bool:
+        """Drops the blocks using the opcode at addr, returns True if block key was one of them"""
+        keys = self.owners.pop(addr, ())
+        for k in keys:
+            for a in self.blocks.pop(k)[3]:
+                owners = self.owners.get(a)
+                if owners is not None:
+                    owners.discard(k)
+                    if not owners:
+                        del self.owners[a]
+                        self.code[a] = 0
+        self.code[addr] = 0
+        return key in keys
+    def instruction(self, words: list[int], ir: int, ticks: int, tables: dict) -> list[str]:
+        lines = []
+        for step, w in enumerate(words):
+            lines += ["ir = " + str(ir) if line == "ir = bus" else line for line in self.tick_lines(w, ir, tables)]
+            ticks += 1
+            if w & RI:
+                #leave before running stale code if the store hit one of this block's opcodes
+                lines += ["if code[mar] and c.invalidate(mar, start):",
+                          f"    c.step = {(step + 1) & 7}",
+                          f"    c.refresh = {bool(w & RF)}",
+                          f"    {STORE}",
+                          f"    return {ticks}"]
+            if w & RF:
+                #leave after the refresh tick for run(until_refresh)
+                lines += ["if until_refresh:",
+                          f"    c.step = {(step + 1) & 7}",
+                          "    c.refresh = True",
+                          f"    {STORE}",
+                          f"    return {ticks}"]
+        return lines
+    def branches(self, ir: int, ticks: int, tables: dict, known: dict) -> tuple[list[str], int, list[int] | None] | None:
+        #a flag dependent instruction as one branch per microcode sequence: (lines, most ticks, words of
+        #the branch going on to the next instruction or None), the branches jumping leave the block
+        sequences = {}
+        for flags in range(8):
+            code = self.microcode(ir, flags)
+            if code is None or code[1] or any(w & RI for w in code[0]):
+                return None
+            sequences.setdefault(tuple(code[0]), []).append(flags)
+        through = [words for words in sequences if not any(w & (JP | II) for w in words[2:])]
+        through = through[0] if len(through) == 1 else None
+        if through is not None:
+            sequences[through] = sequences.pop(through) #last, the block goes on after the else
+        lines = []
+        most = 0
+        for i, (words, flags) in enumerate(sequences.items()):
+            mask = sum(1 << f for f in flags)
+            if i == 0:
+                lines.append(f"if ({mask} >> flags) & 1:")
+            elif i < len(sequences) - 1:
+                lines.append(f"elif ({mask} >> flags) & 1:")
+            else:
+                lines.append("else:")
+            if words is through:
+                body = prune(fold(self.instruction(list(words), ir, ticks, tables), known))
+            else:
+                body = fold(self.instruction(list(words), ir, ticks, tables), dict(known))
+                body = prune(body + [f"c.refresh = {bool(words[-1] & RF)}", STORE, f"return {ticks + len(words)}"])
+            lines += ["    " + line for line in body]
+            most = max(most, ticks + len(words))
+        return lines, most, None if through is None else list(through)
+    def translate(self, pc: int) -> tuple:
+        """Block starting at pc, one built before if its opcodes are back, COLD while pc isn't hot yet"""
+        mem = self.mem
+        for opcodes, block in self.library.get(pc, ()):
+            if all(mem[a] == op for a, op in zip(block[3], opcodes)):
+                return self.place(pc, block)
+        heat = self.heat[pc] = self.heat.get(pc, 0) + 1
+        if heat < HOT:
+            return COLD
+        block = self.build(pc)
+        self.library.setdefault(pc, []).append((bytes(mem[a] for a in block[3]), block))
+        return self.place(pc, block)
+    def place(self, pc: int, block: tuple) -> tuple:
+        self.blocks[pc] = block
+        for a in block[3]:
+            self.owners.setdefault(a, set()).add(pc)
+            self.code[a] = 1
+        return block
+    def build(self, start: int) -> tuple:
+        pc = start
+        known = {"pc": pc} #the flags are only known while running
+        lines = []
+        tables = {}
+        addresses = []
+        ticks = 0
+        halts = refresh = loops = False
+        while len(addresses) < MAX_BLOCK:
+            ir = self.mem[pc]
+            code = self.microcode(ir, None)
+            if code is None:
+                ending = self.branches(ir, ticks, tables, known)
+                if ending is None:
+                    break
+                addresses.append(pc)
+                lines += ending[0]
+                if ending[2] is None:
+                    #every branch leaves the block
+                    ticks = ending[1]
+                    break
+                words = ending[2]
+            else:
+                words, halts = code
+                addresses.append(pc)
+                lines += fold(self.instruction(words, ir, ticks, tables), known)
+            ticks += len(words)
+            if halts:
+                lines.append(f"c.step = {(len(words) + 1) & 7}")
+                refresh = False
+                break
+            refresh = bool(words[-1] & RF)
+            if any(w & (JP | II) for w in words[2:]):
+                loops = True #pc only known while running, the block runs again if it's back at start
+                break
+            pc = (pc + sum(1 for w in words if w & CE)) & (RAM_SIZE - 1)
+
+        if not addresses:
+            #the first instruction can't be translated, remember it so it runs tick by tick
+            return (None, 0, False, [start])
+        lines = prune(lines)
+        if loops:
+            lines = (["done = 0", "while True:"] +
+                     ["    " + re.sub(r"return (\d+)$", r"return done + \1", line) for line in lines] +
+                     [f"    done += {ticks}",
+                      f"    if pc != {start} or done + {ticks} > left:",
+                      "        break"])
+        lines.append(f"c.refresh = {refresh}")
+        function = self.function(f"block_{start:03x}", "c, mem, stack, code, start, left, until_refresh",
+                                 lines, tables, "done" if loops else ticks)
+        return (function, ticks, halts, addresses)
+    def finish(self, max_ticks = -1, until_refresh = False) -> int:
+        #runs tick by tick until the end of the current instruction (or a refresh tick with until_refresh),
+        #watching stores into translated code
+        ticks = 0
+        mem = self.mem
+        while ticks != max_ticks:
+            mar = self.mar
+            old = mem[mar]
+            if FastCPU.run(self, 1) == 0:
+                break
+            ticks += 1
+            if self.code[mar] and mem[mar] != old:
+                self.invalidate(mar)
+            if self.step == 0 or (until_refresh and self.refresh):
+                break
+        return ticks
+    def run(self, max_ticks = -1, until_refresh = False) -> int:
+        if not self.fusable:
+            return FastCPU.run(self, max_ticks, until_refresh)
+        ticks = 0
+        self.halted = False
+        self.until_refresh = until_refresh
+        if self.step:
+            ticks = self.finish(max_ticks, until_refresh)
+            if until_refresh and self.refresh:
+                return ticks
+        blocks = self.blocks
+        mem = self.mem
+        stack = self.stack
+        code = self.code
+        translated = 0
+        while ticks + translated != max_ticks and not self.halted:
+            pc = self.pc
+            block = blocks.get(pc)
+            if block is None:
+                block = self.translate(pc)
+            function, length, halts = block[:3]
+            left = max_ticks - ticks - translated if max_ticks >= 0 else UNLIMITED
+            if function is None or length + halts > left:
+                #cold or untranslatable instruction, or not enough ticks left for a whole pass
+                self.count += translated
+                ticks += translated
+                translated = 0
+                ticks += self.finish(max_ticks - ticks if max_ticks >= 0 else -1, until_refresh)
+                if until_refresh and self.refresh:
+                    break
+                continue
+            done = function(self, mem, stack, code, pc, left, until_refresh)
+            translated += done
+            if until_refresh and self.refresh:
+                break #after a refresh tick, before a halt
+            if halts and done == length:
+                self.halted = True
+            elif self.step:
+                #left in the middle of an instruction after a store into its own block
+                self.count += translated
+                ticks += translated
+                translated = 0
+                ticks += self.finish(max_ticks - ticks if max_ticks >= 0 else -1, until_refresh)
+                if until_refresh and self.refresh:
+                    break
+        self.count += translated
+        return ticks + translated